@@ -0,0 +1,82 @@
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+BENCHMARK_DB = 'benchmark'
+
+
+def get_db() -> Database:
+    return MongoClient(os.getenv('MONGO_URI_TEST', 'mongodb://localhost:27017'))[BENCHMARK_DB]
+
+
+def get_async_db() -> AsyncIOMotorDatabase:
+    """Has to be called inside the event loop the database is used in"""
+    return AsyncIOMotorClient(os.getenv('MONGO_URI_TEST', 'mongodb://localhost:27017'))[BENCHMARK_DB]
+
+
+def seed_talents(db: Database, n: int, batch_size: int = 10000) -> list:
+    db.talents.drop()
+    now = datetime.utcnow()
+    for start in range(0, n, batch_size):
+        db.talents.insert_many([{
+            'name': f'talent {i}' if i % 10 else None,
+            'short_bio': f'bio of talent {i}',
+            'slug': f'talent-{i}',
+            'email': f'talent{i}@test.com',
+            'envision_festival': i % 2 == 0,
+            'deleted': i % 20 == 0,
+            'last_modified': now,
+            'date_created': now
+        } for i in range(start, min(start + batch_size, n))])
+    return [t['_id'] for t in db.talents.find({}, {'_id': 1}).limit(1000)]
+
+
+def seed_events(db: Database, n: int, talents_ids: list, batch_size: int = 10000) -> None:
+    db.events.drop()
+    db.venues.drop()
+    venues_ids = db.venues.insert_many([{'name': f'stage {i}', 'type': 'stage', 'deleted': False}
+                                        for i in range(20)]).inserted_ids
+    start_date = datetime(2023, 3, 6)
+    for start in range(0, n, batch_size):
+        events = []
+        for i in range(start, min(start + batch_size, n)):
+            event_start = start_date + timedelta(minutes=30 * (i % 2000))
+            events.append({
+                'name': f'event {i}',
+                'type': 'show',
+                'talents_ids': random.sample(talents_ids, 2),
+                'collaborators_ids': random.sample(talents_ids, 1),
+                'stage_id': random.choice(venues_ids),
+                'start_date': event_start,
+                'end_date': event_start + timedelta(hours=1),
+                'tags': ['Music'],
+                'last_modified': datetime.utcnow(),
+                'date_created': datetime.utcnow(),
+                'deleted': i % 20 == 0
+            })
+        db.events.insert_many(events)
+
+
+def measure(db: Database, func, repeat: int = 20) -> dict:
+    """Returns the client latency and the server time (from the profiler) of `func`, in ms"""
+    db.set_profiling_level(0)
+    db.system.profile.drop()
+    db.set_profiling_level(2)
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    db.set_profiling_level(0)
+    server_ms = sum(p.get('millis', 0) for p in db.system.profile.find({'op': {'$in': ['command', 'getmore']}}))
+    return {
+        'p50_ms': round(statistics.median(latencies), 2),
+        'max_ms': round(max(latencies), 2),
+        'server_ms_per_call': round(server_ms / repeat, 2)
+    }
@@ -0,0 +1,65 @@
+"""
+Compares the event text search (`filter={"q": ...}`) running after the $lookup stages against the search on the
+denormalized fields, which runs before them, with a regex (collection scan) and with the search keywords (index).
+
+    MONGO_URI_TEST=mongodb://localhost:27017 python -m benchmarks.event_search
+"""
+import asyncio
+
+from benchmarks.common import get_db, get_async_db, seed_talents, seed_events, measure
+from service.event import Event, lookup_stages, _event_entity
+from utils.format import create_response_paginated, regex_query
+from utils.search import search_query, SEARCH_KEYWORDS_FIELD
+
+N_EVENTS = 200000
+
+
+class BenchmarkEvent(Event):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    @property
+    def collection(self):
+        return self.db.events
+
+
+async def refresh_search_fields():
+    return await BenchmarkEvent(get_async_db()).refresh_search_fields({})
+
+
+def search_after_lookup(collection, q: str):
+    pipeline = [{'$match': {'deleted': False}}] + lookup_stages
+    fields = ['name', 'stage.name', 'talents.name', 'collaborators.name']
+    pipeline.append({'$match': {'$or': [regex_query(field, q) for field in fields]}})
+    return create_response_paginated(collection, pipeline=pipeline, limit=50, format_func=_event_entity)
+
+
+def search_before_lookup(collection, q: str):
+    match_stage = {'deleted': False, '$or': [regex_query(field, q) for field in Event().q_fields]}
+    return create_response_paginated(collection, pipeline=[{'$match': match_stage}], limit=50,
+                                     format_func=_event_entity, page_stages=lookup_stages)
+
+
+def search_keywords_before_lookup(collection, q: str):
+    match_stage = {'deleted': False, '$and': [search_query(q, Event().q_fields)]}
+    return create_response_paginated(collection, pipeline=[{'$match': match_stage}], limit=50,
+                                     format_func=_event_entity, page_stages=lookup_stages)
+
+
+def main():
+    db = get_db()
+    talents_ids = seed_talents(db, 5000)
+    seed_events(db, N_EVENTS, talents_ids)
+    asyncio.run(refresh_search_fields())
+    db.events.create_index(SEARCH_KEYWORDS_FIELD)
+
+    for q in ['event 1999', 'talent 12', 'stage 3']:
+        print(f'q={q!r}')
+        print('  after lookup ', measure(db, lambda: search_after_lookup(db.events, q), repeat=3))
+        print('  before lookup', measure(db, lambda: search_before_lookup(db.events, q), repeat=3))
+        print('  keywords     ', measure(db, lambda: search_keywords_before_lookup(db.events, q), repeat=3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+Compares offset pagination against keyset (cursor) pagination on GET /talents/ at increasing depths.
+
+    MONGO_URI_TEST=mongodb://localhost:27017 python -m benchmarks.keyset_pagination
+"""
+from benchmarks.common import get_db, seed_talents, measure
+from service.talent import Talent
+from utils.format import create_response_paginated, ensure_null_last_sort
+
+N_TALENTS = 500000
+PAGE_SIZE = 50
+
+
+def page(collection, offset: int = None, cursor: str = None):
+    return create_response_paginated(collection, query={'deleted': False}, limit=PAGE_SIZE, offset=offset,
+                                     cursor=cursor, sort_by='name', null_last_fields=Talent.sort_fields)
+
+
+def main():
+    db = get_db()
+    seed_talents(db, N_TALENTS)
+    ensure_null_last_sort(db.talents, Talent.sort_fields, prefix=[('deleted', 1)])
+
+    for offset in [0, 10000, 100000, 400000]:
+        # The cursor of the page right before `offset`
+        cursor = page(db.talents, offset=offset - PAGE_SIZE).paging.next_cursor if offset else None
+        print(f'depth={offset}')
+        print('  offset', measure(db, lambda: page(db.talents, offset=offset), repeat=5))
+        print('  cursor', measure(db, lambda: page(db.talents, cursor=cursor), repeat=5))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Concurrent throughput of a single worker serving the GET /events/ query with blocking pymongo calls (as the async
+routes used to) against Motor, at several numbers of requests in flight.
+
+    MONGO_URI_TEST=mongodb://localhost:27017 python -m benchmarks.load_test
+"""
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from benchmarks.common import get_db, get_async_db, seed_talents, seed_events
+from service.event import lookup_stages, _event_entity
+from utils.format import create_response_paginated, create_response_paginated_async, ensure_null_last_sort
+
+N_EVENTS = 50000
+N_REQUESTS = 512
+CONCURRENCY = [1, 8, 32, 64]
+
+
+def create_app() -> FastAPI:
+    app = FastAPI()
+    db = get_db()
+    async_db = {}
+
+    @app.get('/sync/events')
+    async def sync_events(offset: int = 0):
+        return create_response_paginated(db.events, query={'deleted': False}, limit=50, offset=offset,
+                                         sort_by='start_date', format_func=_event_entity, page_stages=lookup_stages,
+                                         null_last_fields=['start_date'])
+
+    @app.get('/async/events')
+    async def async_events(offset: int = 0):
+        if 'db' not in async_db:
+            async_db['db'] = get_async_db()
+        return await create_response_paginated_async(async_db['db'].events, query={'deleted': False}, limit=50,
+                                                     offset=offset, sort_by='start_date', format_func=_event_entity,
+                                                     page_stages=lookup_stages, null_last_fields=['start_date'])
+
+    return app
+
+
+async def run(client: httpx.AsyncClient, path: str, concurrency: int) -> float:
+    """Returns the requests per second of N_REQUESTS requests with `concurrency` requests in flight"""
+    queue = asyncio.Queue()
+    for i in range(N_REQUESTS):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            r = await client.get(path, params={'offset': (i * 50) % 10000})
+            r.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return round(N_REQUESTS / (time.perf_counter() - start), 1)
+
+
+async def load_test():
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        for concurrency in CONCURRENCY:
+            print(f'concurrency={concurrency}')
+            print('  pymongo', await run(client, '/sync/events', concurrency), 'req/s')
+            print('  motor  ', await run(client, '/async/events', concurrency), 'req/s')
+
+
+def main():
+    db = get_db()
+    talents_ids = seed_talents(db, 5000)
+    seed_events(db, N_EVENTS, talents_ids)
+    ensure_null_last_sort(db.events, ['start_date'], prefix=[('deleted', 1)])
+    asyncio.run(load_test())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Sends a notification to 100k users through a local fake Expo server and compares recording it on the users after
+the whole push (as before) against recording it in batches while the push results arrive.
+Uses the database of the test environment.
+
+    CURRENT_ENVIRONMENT=test MONGO_URI_TEST=mongodb://localhost:27017 python -m benchmarks.notification_bookkeeping
+"""
+import time
+import tracemalloc
+from collections import deque
+
+import utils.notifications
+from config.db import conn
+from service.notification import _audience, _record_on_users, _send, _users_query, users_indexes
+from utils.notifications import send_notification
+from tests.fake_expo import FakeExpo
+
+N_USERS = 100000
+LATENCY = 0.05  # in seconds
+
+
+def record_after_push(notification: dict):
+    tokens = list(_audience(_users_query(None, notification['test']), deque()))
+    results = send_notification(notification['title'], notification['body'], notification['url'], tokens)
+    _record_on_users(notification['_id'], {False: [n['token'] for n in results if n['status'] == 'ok'],
+                                           True: [n['token'] for n in results if n['status'] == 'error']})
+
+
+def record_while_pushing(notification: dict):
+    _send(notification)
+
+
+def main():
+    conn.users.drop()
+    conn.users.create_indexes(users_indexes)
+    for start in range(0, N_USERS, 10000):
+        conn.users.insert_many([{'expo_token': f'ExponentPushToken[{i}]', 'test': True, 'deleted': False}
+                                for i in range(start, start + 10000)])
+
+    expo = FakeExpo().start()
+    expo.delay = LATENCY
+    utils.notifications.EXPO_PUSH_URL = expo.url
+    utils.notifications.rate_limiter.rate = None
+    utils.notifications.MAX_CONCURRENT_REQUESTS = 16
+
+    for name, func in [('after push  ', record_after_push), ('while pushing', record_while_pushing)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        notification = {'title': 'title', 'body': 'body', 'url': 'url', 'test': True, 'notifications_sent': 0,
+                        'notifications_error': 0}
+        notification['_id'] = conn.notifications.insert_one(notification).inserted_id
+        func(notification)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{name}: {round(elapsed, 2)}s, peak memory {round(peak / 2 ** 20, 1)}MB')
+    expo.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Compares the old two-pass pagination (a `$count` aggregation plus the page aggregation) against
+`create_response_paginated` on the GET /events/ pipeline.
+
+    MONGO_URI_TEST=mongodb://localhost:27017 python -m benchmarks.pagination
+"""
+from benchmarks.common import get_db, seed_talents, seed_events, measure
+from service.event import lookup_stages, _event_entity
+from utils.format import create_response_paginated, add_sort_stages_to_pipeline
+
+N_EVENTS = 100000
+
+
+def two_pass(collection, pipeline: list, limit: int, offset: int, sort_by: str):
+    pipeline = pipeline + lookup_stages
+    r = list(collection.aggregate(pipeline + [{'$count': 'count'}]))
+    total = r[0]['count'] if r else 0
+    pipeline = add_sort_stages_to_pipeline(pipeline, sort_by=sort_by, ascending=True)
+    pipeline.extend([{'$skip': offset}, {'$limit': limit}])
+    return total, [_event_entity(e) for e in collection.aggregate(pipeline)]
+
+
+def single_pass(collection, pipeline: list, limit: int, offset: int, sort_by: str):
+    return create_response_paginated(collection, pipeline=pipeline, limit=limit, offset=offset,
+                                     sort_by=sort_by, format_func=_event_entity, page_stages=lookup_stages)
+
+
+def main():
+    db = get_db()
+    talents_ids = seed_talents(db, 5000)
+    seed_events(db, N_EVENTS, talents_ids)
+    pipeline = [{'$match': {'deleted': False}}]
+
+    for offset in [0, 1000, 50000]:
+        args = (db.events, pipeline, 50, offset, 'start_date')
+        print(f'offset={offset}')
+        print('  two-pass   ', measure(db, lambda: two_pass(*args), repeat=5))
+        print('  single-pass', measure(db, lambda: single_pass(*args), repeat=5))
+
+
+if __name__ == '__main__':
+    main()
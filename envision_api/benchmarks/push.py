@@ -0,0 +1,35 @@
+"""
+Tokens per second of `send_notification` against a local fake Expo server with 50ms of latency,
+sending the chunks one after another (as before) and concurrently.
+
+    python -m benchmarks.push
+"""
+import time
+
+import utils.notifications
+from utils.notifications import send_notification
+from tests.fake_expo import FakeExpo
+
+N_TOKENS = 20000
+LATENCY = 0.05  # in seconds
+
+
+def main():
+    expo = FakeExpo().start()
+    expo.delay = LATENCY
+    utils.notifications.EXPO_PUSH_URL = expo.url
+    utils.notifications.rate_limiter.rate = None
+    tokens = [f'ExponentPushToken[{i}]' for i in range(N_TOKENS)]
+
+    for concurrency in [1, 4, 8, 16]:
+        utils.notifications.MAX_CONCURRENT_REQUESTS = concurrency
+        start = time.perf_counter()
+        results = send_notification('title', 'body', 'url', tokens)
+        elapsed = time.perf_counter() - start
+        assert len(results) == N_TOKENS
+        print(f'concurrency={concurrency}: {round(N_TOKENS / elapsed)} tokens/s')
+    expo.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,20 @@
-from fastapi import HTTPException, status
+import time
+from threading import Lock
+from bson import ObjectId
+from fastapi import HTTPException, Header, status
 from typing import List, Optional
 
 from config.constants import API_KEY, ENVISION_APP_API_KEY, CURRENT_ENVIRONMENT, EnvironmentEnum
 from utils.security import decode
 from models.admin import RoleEnum
-from exceptions.auth_exceptions import AdminNotAllowed
+from exceptions.auth_exceptions import AdminNotAllowed, InvalidToken
+from config.db import get_async_conn
+
+PRINCIPAL_CACHE_TTL = 30  # in seconds, short since the admins are updated outside of this API
+
+# admin id -> (talent id, expiration)
+_principals = {}
+_principals_lock = Lock()
 
 
 def verify_api_key(api_key: str):
@@ -29,3 +39,52 @@ def verify_credentials(*, api_key: str = None, token: str = None,
         return verify_role(token, allowed_roles)
 
     verify_api_key(api_key)
+
+
+async def get_talent_id(admin: dict) -> Optional[ObjectId]:
+    """
+    Returns the talent of a talent-role admin, from a cache of the admins (so the most frequent authenticated
+    requests skip the admin query). The talent_id claim of the token is not trusted, as it outlives the admin: an
+    admin that is deleted or moved to another talent keeps its access for at most PRINCIPAL_CACHE_TTL, or until
+    invalidate_principal is called.
+    """
+    admin_id = str(admin.get('_id'))
+    with _principals_lock:
+        talent_id, expiration = _principals.get(admin_id, (None, 0))
+    if expiration > time.monotonic():
+        return talent_id
+
+    admin_db = None
+    if ObjectId.is_valid(admin_id):
+        admin_db = await get_async_conn().admins.find_one({'_id': ObjectId(admin_id), 'deleted': False},
+                                                          {'talent_id': 1})
+    if not admin_db:
+        raise InvalidToken()
+    with _principals_lock:
+        _principals[admin_id] = (admin_db.get('talent_id'), time.monotonic() + PRINCIPAL_CACHE_TTL)
+    return admin_db.get('talent_id')
+
+
+async def admin_talent_id(authorization: Optional[str] = Header(None, alias='Authorization')) -> Optional[ObjectId]:
+    """
+    Dependency with the talent the request is restricted to: the talent of a talent-role admin, None for the
+    other callers
+    """
+    if not authorization:
+        return None
+    admin = decode(authorization)
+    if admin.get('role') != RoleEnum.talent:
+        return None
+    talent_id = await get_talent_id(admin)
+    if not talent_id:
+        raise AdminNotAllowed()
+    return talent_id
+
+
+def invalidate_principal(admin_id) -> None:
+    """
+    Drops the cached talent of the admin in this process. The admins are written by service.admin, which is to
+    call it on their updates and deletes; the other processes see them after PRINCIPAL_CACHE_TTL.
+    """
+    with _principals_lock:
+        _principals.pop(str(admin_id), None)
@@ -33,3 +33,5 @@ FRONTEND_URL = os.getenv('FRONTEND_URL')
 BACKEND_URL = os.getenv('BACKEND_URL')
 JWT_SECRET = os.getenv('JWT_SECRET') if CURRENT_ENVIRONMENT != EnvironmentEnum.test else 'test jwt secret'
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+IMAGE_PROCESSES = int(os.getenv('IMAGE_PROCESSES', 2))
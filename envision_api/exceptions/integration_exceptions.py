@@ -0,0 +1,6 @@
+from fastapi import HTTPException, status
+
+
+class IntegrationUnavailable(HTTPException):
+    def __init__(self, integration: str, reason: str):
+        super().__init__(status.HTTP_503_SERVICE_UNAVAILABLE, f"{integration} is unavailable. {reason}", None)
@@ -18,6 +18,11 @@ class DuplicatedKey(HTTPException):
         super().__init__(status.HTTP_400_BAD_REQUEST, f"Duplicated key {key}", None)
 
 
+class InvalidCursor(HTTPException):
+    def __init__(self):
+        super().__init__(status.HTTP_400_BAD_REQUEST, "Invalid cursor", None)
+
+
 class ResourceReference(HTTPException):
     def __init__(self, resource_to_delete, resource_reference):
         super().__init__(status.HTTP_400_BAD_REQUEST,
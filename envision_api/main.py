@@ -7,10 +7,19 @@ import pydantic
 from docs import tags_metadata
 from logging.config import dictConfig
 from config.log_conf import log_config
-from config.constants import CURRENT_ENVIRONMENT
+from config.constants import CURRENT_ENVIRONMENT, EnvironmentEnum
 
 from utils.logger import logger
+from utils.format import backfill_null_last_keys
+from utils.search import backfill_search_keywords, SEARCH_KEYWORDS_FIELD
+from utils.indexes import reconcile_indexes, log_index_report
+from utils import image
+from config.db import conn, connect_async, close_async
 from routes.talent import talent_routes
+import service
+import service.notification
+import service.jobs
+import service.ethos
 
 dictConfig(log_config)
 app = FastAPI(
@@ -43,6 +52,53 @@ app.add_middleware(
 
 app.include_router(talent_routes)
 
+
+@app.on_event('startup')
+async def connect_db():
+    connect_async()
+
+
+@app.on_event('startup')
+async def prepare_collections():
+    for collection, indexes in [(conn.talents, service.Talent.indexes),
+                                (conn.events, service.Event.indexes),
+                                (conn.notifications, service.notification.indexes),
+                                (conn.users, service.notification.users_indexes),
+                                (conn.push_tickets, service.notification.push_tickets_indexes),
+                                (conn.jobs, service.jobs.indexes + service.notification.jobs_indexes)]:
+        log_index_report(reconcile_indexes(collection, indexes))
+
+    backfill_null_last_keys(conn.talents, service.Talent.sort_fields)
+    backfill_null_last_keys(conn.events, service.Event.sort_fields)
+    backfill_search_keywords(conn.talents, service.Talent.search_fields)
+    await service.Event().refresh_search_fields({SEARCH_KEYWORDS_FIELD: {'$exists': False}})
+
+
+@app.on_event('startup')
+def start_job_workers():
+    if CURRENT_ENVIRONMENT == EnvironmentEnum.test:
+        # The tests run the jobs and loops themselves
+        return
+    service.jobs.workers.start()
+    service.notification.scheduler.start()
+    service.notification.receipts.start()
+    service.ethos.dispatcher.start()
+
+
+@app.on_event('shutdown')
+def stop_job_workers():
+    service.notification.scheduler.stop(timeout=service.jobs.POLL_INTERVAL)
+    service.notification.receipts.stop(timeout=service.jobs.POLL_INTERVAL)
+    service.ethos.dispatcher.stop(timeout=service.jobs.POLL_INTERVAL)
+    service.jobs.workers.stop(timeout=service.jobs.POLL_INTERVAL)
+    image.shutdown()
+
+
+@app.on_event('shutdown')
+async def close_db():
+    close_async()
+
+
 logger.debug('Running server on {}'.format(CURRENT_ENVIRONMENT.name.upper()))
 
 
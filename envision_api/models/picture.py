@@ -1,10 +1,26 @@
-response.pyfrom typing import Optional
+from typing import Optional, List
+from enum import Enum
 
 from models.envisionBaseModel import EnvisionBaseModel
 
 
+class PictureStatusEnum(str, Enum):
+    pending = 'pending'
+    ready = 'ready'
+    failed = 'failed'
+
+
+class RenditionModel(EnvisionBaseModel):
+    url: str
+    width: int
+    height: int
+    format: str
+
+
 class PictureModel(EnvisionBaseModel):
     original: Optional[str] = None
     thumbnail: Optional[str] = None
     local: Optional[str] = None
-    alt: Optional[str] = ''
\ No newline at end of file
+    alt: Optional[str] = ''
+    renditions: Optional[List[RenditionModel]] = None
+    status: Optional[PictureStatusEnum] = None
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from bson import ObjectId
-from typing import Generic, TypeVar, List
+from typing import Generic, TypeVar, List, Optional
 from pydantic import BaseModel
 from pydantic.generics import GenericModel
 
@@ -19,6 +19,7 @@ class Paging(BaseModel):
     total: int
     limit: int
     offset: int
+    next_cursor: Optional[str] = None
 
 
 class ListModel(GenericModel, Generic[T]):
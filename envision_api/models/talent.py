@@ -12,6 +12,19 @@ class CMSStatusEnum(str, Enum):
     review = 'Review'
 
 
+class EthosSyncStatusEnum(str, Enum):
+    pending = 'pending'
+    synced = 'synced'
+    failed = 'failed'
+
+
+class EthosSyncModel(EnvisionBaseModel):
+    status: EthosSyncStatusEnum
+    attempts: int = 0
+    error: Optional[str]
+    last_synced: Optional[datetime]
+
+
 class NameLogoModel(EnvisionBaseModel):
     has_logo: bool
     logo: Optional[str]
@@ -58,6 +71,7 @@ class TalentModel(EnvisionBaseModel):
     cms_id: Optional[str]
     cms_status: Optional[CMSStatusEnum]
     ethos_id: Optional[int]
+    ethos_sync: Optional[EthosSyncModel]
     archived: bool = Field(alias='_archived')
     draft: bool = Field(alias='_draft')
     deleted: bool
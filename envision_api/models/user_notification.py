@@ -0,0 +1,10 @@
+from datetime import datetime
+
+from models.envisionBaseModel import EnvisionBaseModel, PyObjectId
+
+
+class UserNotificationModel(EnvisionBaseModel):
+    """A notification sent to a user, as it is kept in the notifications of the user"""
+    notification_id: PyObjectId
+    error: bool
+    date: datetime
@@ -1,6 +1,8 @@
 from datetime import datetime
+from bson import ObjectId
 
-from fastapi import APIRouter, status, Header, Query
+from fastapi import APIRouter, status, Header, Query, Depends
+from fastapi.concurrency import run_in_threadpool
 from typing import Optional
 
 from models.event import EventModel, CreateEventRequest, UpdateEventRequest
@@ -14,7 +16,7 @@ import service.event
 import service.talent
 import service.venue
 from utils.logger import log_request_body
-from config.auth import verify_credentials, ENVISION_APP_API_KEY
+from config.auth import verify_credentials, admin_talent_id, ENVISION_APP_API_KEY
 from exceptions.resource_exceptions import ResourceNotFound
 
 prefix = '/events'
@@ -34,18 +36,21 @@ async def get_events(filters: EventFilters = Filter(EventFilters, alias='filter'
                      ascending: bool = True,
                      limit: int = None,
                      offset: int = None,
+                     cursor: str = Query(default=None,
+                                         description='Return the page after this cursor (paging.next_cursor), '
+                                                     'offset is ignored'),
                      x_api_key: Optional[str] = Header(None),
-                     authorization: str = Header(None, alias='Authorization')):
-    admin = verify_credentials(api_key=x_api_key,
-                               token=authorization,
-                               allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff, RoleEnum.talent])
-    if admin and admin.get('role') == RoleEnum.talent:
-        admin = service.Admin().get(admin.get('_id'))
-        filters.talent_id = [admin['talent_id']]
+                     authorization: str = Header(None, alias='Authorization'),
+                     admin_talent: Optional[ObjectId] = Depends(admin_talent_id)):
+    verify_credentials(api_key=x_api_key,
+                       token=authorization,
+                       allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff, RoleEnum.talent])
+    if admin_talent:
+        filters.talent_id = [admin_talent]
     if x_api_key == ENVISION_APP_API_KEY:
         limit, offset = None, None
-    return service.Event().find(filters=filters, last_modified=last_modified,
-                                sort_by=sort_by, ascending=ascending, limit=limit, offset=offset)
+    return await service.Event().find(filters=filters, last_modified=last_modified, sort_by=sort_by,
+                                      ascending=ascending, limit=limit, offset=offset, cursor=cursor)
 
 
 @event_routes.get('/tags', response_model=ListModel[str], status_code=status.HTTP_200_OK)
@@ -56,7 +61,7 @@ async def get_event_tags(limit: int = None,
     verify_credentials(api_key=x_api_key,
                        token=authorization,
                        allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff, RoleEnum.talent])
-    return service.Event().get_tags(limit=limit, offset=offset)
+    return await service.Event().get_tags(limit=limit, offset=offset)
 
 
 @event_routes.get('/{event_id}', response_model=EventModel, status_code=status.HTTP_200_OK)
@@ -66,7 +71,7 @@ async def get_event(event_id: PyObjectId,
     verify_credentials(api_key=x_api_key,
                        token=authorization,
                        allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff, RoleEnum.talent])
-    event = service.Event().get(event_id)
+    event = await service.Event().get(event_id)
     if event is None:
         raise ResourceNotFound(event_id, 'Event')
     return event
@@ -79,14 +84,14 @@ async def create_event(event: CreateEventRequest,
     verify_credentials(token=authorization,
                        allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff])
 
-    for talent_id in event.talents_ids + event.collaborators_ids:
-        if not service.Talent().exists(talent_id):
-            raise ResourceNotFound(talent_id, 'Talent')
-    if event.stage_id and not service.Venue().exists(event.stage_id, venue_types=[VenueTypeEnum.stage,
-                                                                                  VenueTypeEnum.theme_camp]):
+    missing_talents = await service.Talent().find_missing(event.talents_ids + event.collaborators_ids)
+    if missing_talents:
+        raise ResourceNotFound(', '.join(map(str, missing_talents)), 'Talent')
+    if event.stage_id and not await run_in_threadpool(service.Venue().exists, event.stage_id,
+                                                       venue_types=[VenueTypeEnum.stage, VenueTypeEnum.theme_camp]):
         raise ResourceNotFound(event.stage_id, 'Stage')
 
-    return service.Event().create(event.dict())
+    return await service.Event().create(event.dict())
 
 
 @event_routes.put('/{event_id}', response_model=EventModel)
@@ -101,14 +106,14 @@ async def update_event(event_id: PyObjectId,
     talents_ids = [t for t in talents_ids if t]
     collaborators_ids = event.collaborators_ids if event.collaborators_ids else []
     collaborators_ids = [t for t in collaborators_ids if t]
-    for talent_id in talents_ids + collaborators_ids:
-        if not service.Talent().exists(talent_id):
-            raise ResourceNotFound(talent_id, 'Talent')
-    if event.stage_id and not service.Venue().exists(event.stage_id, venue_types=[VenueTypeEnum.stage,
-                                                                                  VenueTypeEnum.theme_camp]):
+    missing_talents = await service.Talent().find_missing(talents_ids + collaborators_ids)
+    if missing_talents:
+        raise ResourceNotFound(', '.join(map(str, missing_talents)), 'Talent')
+    if event.stage_id and not await run_in_threadpool(service.Venue().exists, event.stage_id,
+                                                       venue_types=[VenueTypeEnum.stage, VenueTypeEnum.theme_camp]):
         raise ResourceNotFound(event.stage_id, 'Stage')
 
-    updated_event = service.Event().update(event_id, event.dict(exclude_unset=True))
+    updated_event = await service.Event().update(event_id, event.dict(exclude_unset=True))
     if not updated_event:
         raise ResourceNotFound(event_id, 'Event')
 
@@ -120,6 +125,6 @@ async def delete_event(event_id: PyObjectId,
                        authorization: str = Header(alias='Authorization')):
     verify_credentials(token=authorization,
                        allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff])
-    r = service.Event().delete(event_id)
+    r = await service.Event().delete(event_id)
     if not r:
         raise ResourceNotFound(event_id, 'Event')
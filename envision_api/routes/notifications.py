@@ -1,17 +1,17 @@
 from fastapi import APIRouter, status, Header, Path
+from fastapi.concurrency import run_in_threadpool
 from typing import Optional
 from datetime import datetime
 import pytz
-from threading import Thread
 
-from models.notification import (NotificationModel, CreateNotificationRequest, UpdateNotificationRequest,
-                                 NotificationStatusEnum)
+from models.notification import NotificationModel, CreateNotificationRequest, UpdateNotificationRequest
 from models.admin import RoleEnum
 from models.response import ListModel, Paging
 from models.envisionBaseModel import PyObjectId
 import service.notification
 from config.auth import verify_credentials, ENVISION_APP_API_KEY
 from utils.logger import log_request_body
+from utils.notifications import push_metrics
 from exceptions.resource_exceptions import ResourceNotFound
 from exceptions.notification_exceptions import SendAtPast
 
@@ -34,7 +34,7 @@ async def get_notifications(limit: int = None,
     verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
     if x_api_key == ENVISION_APP_API_KEY:
         limit, offset = None, None
-    return service.notification.find(limit=limit, offset=offset)
+    return await service.notification.find(limit=limit, offset=offset)
 
 
 @notification_routes.post('/send_scheduled', response_model=ListModel[NotificationModel],
@@ -42,19 +42,26 @@ async def get_notifications(limit: int = None,
 async def send_scheduled_notifications(x_api_key: Optional[str] = Header(None),
                                        authorization: str = Header(None, alias='Authorization')):
     verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    notifications = service.notification.send_scheduled()
+    notifications = await run_in_threadpool(service.notification.send_scheduled)
     return ListModel[NotificationModel](
         results=notifications,
         paging=Paging(total=len(notifications), limit=len(notifications), offset=0)
     )
 
 
+@notification_routes.get('/push_metrics', status_code=status.HTTP_200_OK)
+async def get_push_metrics(x_api_key: Optional[str] = Header(None),
+                           authorization: str = Header(None, alias='Authorization')):
+    verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
+    return {**push_metrics(), **service.notification.receipts.metrics()}
+
+
 @notification_routes.get('/{notification_id}', response_model=NotificationModel, status_code=status.HTTP_200_OK)
 async def get_notification(notification_id: PyObjectId = Path(title='The ID of the Notification to get'),
                            x_api_key: Optional[str] = Header(None),
                            authorization: str = Header(None, alias='Authorization')):
     verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    notification = service.notification.get(notification_id)
+    notification = await service.notification.get(notification_id)
     if notification is None:
         raise ResourceNotFound(notification_id, 'Notification')
     return notification
@@ -72,20 +79,9 @@ async def create_notification(notification: CreateNotificationRequest,
         if send_at_utc < datetime.utcnow().replace(tzinfo=pytz.utc):
             raise SendAtPast()
 
-    t = Thread(target=service.notification.create, args=(notification.title, notification.body, notification.url,
-                                                         notification.test, notification.users_filter, send_at_utc))
-    t.start()
-    return NotificationModel(
-        title=notification.title,
-        body=notification.body,
-        url=notification.url,
-        send_at=notification.send_at,
-        status=NotificationStatusEnum.sent if notification.send_at is None else NotificationStatusEnum.canceled,
-        notifications_sent=0,
-        notifications_error=0,
-        date_created=datetime.utcnow(),
-        test=notification.test
-    )
+    # The notification is sent by the job workers, its progress is shown by GET /notifications/{id}
+    return await run_in_threadpool(service.notification.create, notification.title, notification.body,
+                                   notification.url, notification.test, notification.users_filter, send_at_utc)
 
 
 @notification_routes.put('/{notification_id}', response_model=NotificationModel)
@@ -100,7 +96,7 @@ async def update_notification(notification_id: PyObjectId,
         if send_at_utc < datetime.utcnow().replace(tzinfo=pytz.utc):
             raise SendAtPast()
 
-    updated_notification = service.notification.update(notification_id, notification.dict(exclude_unset=True))
+    updated_notification = await service.notification.update(notification_id, notification.dict(exclude_unset=True))
     if not updated_notification:
         raise ResourceNotFound(notification_id, 'Notification')
 
@@ -113,7 +109,7 @@ async def cancel_scheduled_notification(notification_id: PyObjectId = Path(title
                                         x_api_key: Optional[str] = Header(None),
                                         authorization: str = Header(None, alias='Authorization')):
     verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    notification = service.notification.cancel(notification_id)
+    notification = await service.notification.cancel(notification_id)
     if notification is None:
         raise ResourceNotFound(notification_id, 'Notification')
     return notification
@@ -1,6 +1,8 @@
 from datetime import datetime
+from bson import ObjectId
 
-from fastapi import APIRouter, status, Header, Query
+from fastapi import APIRouter, status, Header, Query, Depends
+from fastapi.concurrency import run_in_threadpool
 from typing import Optional
 
 from models.talent import TalentModel, CreateTalentRequest, UpdateTalentRequest
@@ -13,9 +15,10 @@ from models.filters import Filter
 import service.admin
 import service.event
 import service.talent
+import service.ethos
 import service.venue
 from utils.logger import log_request_body
-from config.auth import verify_credentials, ENVISION_APP_API_KEY
+from config.auth import verify_credentials, admin_talent_id, ENVISION_APP_API_KEY
 from exceptions.resource_exceptions import ResourceNotFound, ResourceReference
 from exceptions.auth_exceptions import AdminNotAllowed
 
@@ -36,18 +39,21 @@ async def get_talents(filters: TalentFilters = Filter(TalentFilters, alias='filt
                       ascending: Optional[bool] = True,
                       limit: int = None,
                       offset: int = None,
+                      cursor: str = Query(default=None,
+                                          description='Return the page after this cursor (paging.next_cursor), '
+                                                      'offset is ignored'),
                       x_api_key: Optional[str] = Header(None),
-                      authorization: str = Header(None, alias='Authorization')):
-    admin = verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    if admin and admin.get('role') == RoleEnum.talent:
-        admin = service.Admin().get(admin.get('_id'))
-        filters.ids = [admin['talent_id']]
+                      authorization: str = Header(None, alias='Authorization'),
+                      admin_talent: Optional[ObjectId] = Depends(admin_talent_id)):
+    verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
+    if admin_talent:
+        filters.ids = [admin_talent]
     if x_api_key == ENVISION_APP_API_KEY:
         limit, offset = None, None
         if filters.envision_festival is None:
             filters.envision_festival = True
-    return service.Talent().find(filters=filters, last_modified=last_modified, sort_by=sort_by, ascending=ascending,
-                                 limit=limit, offset=offset)
+    return await service.Talent().find(filters=filters, last_modified=last_modified, sort_by=sort_by,
+                                       ascending=ascending, limit=limit, offset=offset, cursor=cursor)
 
 
 @talent_routes.get('/categories', response_model=ListModel[str], status_code=status.HTTP_200_OK)
@@ -56,7 +62,7 @@ async def get_talent_categories(limit: int = None,
                                 x_api_key: Optional[str] = Header(None),
                                 authorization: str = Header(None, alias='Authorization')):
     verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    return service.Talent().get_categories(limit=limit, offset=offset)
+    return await service.Talent().get_categories(limit=limit, offset=offset)
 
 
 @talent_routes.get('/pillars', response_model=ListModel[str], status_code=status.HTTP_200_OK)
@@ -65,20 +71,19 @@ async def get_talent_pillars(limit: int = None,
                              x_api_key: Optional[str] = Header(None),
                              authorization: str = Header(None, alias='Authorization')):
     verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    return service.Talent().get_pillars(limit=limit, offset=offset)
+    return await service.Talent().get_pillars(limit=limit, offset=offset)
 
 
 @talent_routes.get('/{talent_id}', response_model=TalentModel, status_code=status.HTTP_200_OK)
 async def get_talent(talent_id: PyObjectId,
                      x_api_key: Optional[str] = Header(None),
-                     authorization: str = Header(None, alias='Authorization')):
-    admin = verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    if admin and admin.get('role') == RoleEnum.talent:
-        admin = service.Admin().get(admin.get('_id'))
-        if str(admin['talent_id']) != talent_id:
-            raise AdminNotAllowed()
-
-    talent = service.Talent().get(talent_id)
+                     authorization: str = Header(None, alias='Authorization'),
+                     admin_talent: Optional[ObjectId] = Depends(admin_talent_id)):
+    verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
+    if admin_talent and admin_talent != talent_id:
+        raise AdminNotAllowed()
+
+    talent = await service.Talent().get(talent_id)
     if talent is None:
         raise ResourceNotFound(talent_id, 'Talent')
     return talent
@@ -87,14 +92,13 @@ async def get_talent(talent_id: PyObjectId,
 @talent_routes.get('/{talent_id}/generate_bio', status_code=status.HTTP_200_OK)
 async def generate_talent_bio(talent_id: PyObjectId,
                               x_api_key: Optional[str] = Header(None),
-                              authorization: str = Header(None, alias='Authorization')):
-    admin = verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
-    if admin and admin.get('role') == RoleEnum.talent:
-        admin = service.Admin().get(admin.get('_id'))
-        if str(admin['talent_id']) != talent_id:
-            raise AdminNotAllowed()
-
-    bio = service.Talent().generate_bio(talent_id)
+                              authorization: str = Header(None, alias='Authorization'),
+                              admin_talent: Optional[ObjectId] = Depends(admin_talent_id)):
+    verify_credentials(api_key=x_api_key, token=authorization, allowed_roles=allowed_roles)
+    if admin_talent and admin_talent != talent_id:
+        raise AdminNotAllowed()
+
+    bio = await service.Talent().generate_bio(talent_id)
     if bio is None:
         raise ResourceNotFound(talent_id, 'Talent')
     return {'result': bio}
@@ -106,11 +110,30 @@ async def create_talent(talent: CreateTalentRequest,
     log_request_body(f'POST {prefix}', talent)
     verify_credentials(token=authorization, allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff])
 
-    if talent.main_stage and not service.Venue().exists(talent.main_stage,
-                                                        venue_types=[VenueTypeEnum.stage, VenueTypeEnum.theme_camp]):
+    if talent.main_stage and not await run_in_threadpool(service.Venue().exists, talent.main_stage,
+                                                         venue_types=[VenueTypeEnum.stage, VenueTypeEnum.theme_camp]):
         raise ResourceNotFound(talent.main_stage, 'Stage')
 
-    return service.Talent().create(talent.dict())
+    return await service.Talent().create(talent.dict())
+
+
+@talent_routes.post('/ethos/reconcile', status_code=status.HTTP_202_ACCEPTED)
+async def reconcile_ethos_instructors(dry_run: bool = Query(default=True,
+                                                            description='Only report the differences with Thinkific'),
+                                      authorization: str = Header(alias='Authorization')):
+    verify_credentials(token=authorization, allowed_roles=[RoleEnum.superadmin, RoleEnum.admin])
+    job_id = await service.ethos.enqueue_reconcile(dry_run)
+    return {'id': str(job_id)}
+
+
+@talent_routes.get('/ethos/reconcile/{job_id}', status_code=status.HTTP_200_OK)
+async def get_ethos_reconcile(job_id: PyObjectId,
+                              authorization: str = Header(alias='Authorization')):
+    verify_credentials(token=authorization, allowed_roles=[RoleEnum.superadmin, RoleEnum.admin])
+    reconcile = await service.ethos.get_reconcile(job_id)
+    if reconcile is None:
+        raise ResourceNotFound(job_id, 'Reconcile')
+    return reconcile
 
 
 @talent_routes.put('/{talent_id}', response_model=TalentModel)
@@ -120,13 +143,18 @@ async def update_talent(talent_id: PyObjectId,
     log_request_body(f'PUT {prefix}/{talent_id}', talent)
     verify_credentials(token=authorization, allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff])
 
-    if talent.main_stage and not service.Venue().exists(talent.main_stage, venue_types=[VenueTypeEnum.stage,
-                                                                                        VenueTypeEnum.theme_camp]):
+    if talent.main_stage and not await run_in_threadpool(service.Venue().exists, talent.main_stage,
+                                                         venue_types=[VenueTypeEnum.stage, VenueTypeEnum.theme_camp]):
         raise ResourceNotFound(talent.main_stage, 'Stage')
 
-    updated_talent = service.Talent().update(talent_id, talent.dict(exclude_unset=True))
+    to_update = talent.dict(exclude_unset=True)
+    updated_talent = await service.Talent().update(talent_id, to_update)
     if not updated_talent:
         raise ResourceNotFound(talent_id, 'Talent')
+    if 'name' in to_update:
+        # The talent name is denormalized on its events for the event search
+        await service.Event().refresh_search_fields({'$or': [{'talents_ids': talent_id},
+                                                            {'collaborators_ids': talent_id}]})
 
     return updated_talent
 
@@ -136,8 +164,8 @@ async def update_talent(talent_id: PyObjectId,
 async def delete_talent(talent_id: PyObjectId,
                         authorization: str = Header(None, alias='Authorization')):
     verify_credentials(token=authorization, allowed_roles=[RoleEnum.superadmin, RoleEnum.admin, RoleEnum.staff])
-    if service.Event().exists(talent_id=talent_id):
+    if await service.Event().exists(talent_id=talent_id):
         raise ResourceReference(resource_to_delete='Talent', resource_reference='Event')
-    r = service.Talent().delete(talent_id)
+    r = await service.Talent().delete(talent_id)
     if not r:
         raise ResourceNotFound(talent_id, 'Talent')
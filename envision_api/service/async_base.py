@@ -0,0 +1,82 @@
+import re
+from typing import Optional, List
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from exceptions.resource_exceptions import DuplicatedKey
+
+from config.db import get_async_conn
+from utils.format import create_response_paginated_async, regex_query
+from models.response import ListModel
+
+
+class AsyncBase:
+    """Same query surface as service.base.Base, on Motor so that the route handlers do not block the event loop"""
+    sort_fields: List[str] = []
+
+    def __init__(self, resource: str, q_fields: List[str] = None):
+        self.resource = resource
+        self.q_fields = q_fields or []
+
+    @property
+    def collection(self) -> AsyncIOMotorCollection:
+        return get_async_conn()[self.resource]
+
+    @staticmethod
+    def _format_slug(document: dict) -> None:
+        """Lowercases the slug and joins its words with hyphens, as the slugs of the CMS"""
+        if document.get('slug'):
+            document['slug'] = re.sub(r'[^a-z0-9]+', '-', document['slug'].strip().lower()).strip('-')
+
+    async def find(self, *, q: str = None, last_modified: datetime = None, sort_by: str = None,
+                   ascending: bool = True, limit: int = None, offset: int = None, cursor: str = None) -> ListModel:
+        query = {}
+        if q:
+            query['$or'] = [regex_query(field, q) for field in self.q_fields]
+        if last_modified:
+            query['last_modified'] = {'$gte': last_modified}
+        else:
+            query['deleted'] = False
+        return await create_response_paginated_async(self.collection, query=query, limit=limit, offset=offset,
+                                                     cursor=cursor, sort_by=sort_by, ascending=ascending,
+                                                     null_last_fields=self.sort_fields)
+
+    async def get(self, resource_id: ObjectId) -> Optional[dict]:
+        return await self.collection.find_one({'_id': resource_id, 'deleted': False})
+
+    async def exists(self, resource_id: ObjectId) -> bool:
+        if not ObjectId.is_valid(resource_id):
+            return False
+        return await self.collection.count_documents({'_id': ObjectId(resource_id), 'deleted': False}, limit=1) > 0
+
+    async def create(self, document: dict) -> dict:
+        now = datetime.utcnow()
+        document.update({'date_created': now, 'last_modified': now, 'deleted': False})
+        try:
+            r = await self.collection.insert_one(document)
+        except DuplicateKeyError as e:
+            raise DuplicatedKey(e.details.get('keyValue'))
+        document['_id'] = r.inserted_id
+        return document
+
+    async def update(self, resource_id: ObjectId, document: dict) -> Optional[dict]:
+        to_update = document.copy()
+        to_update['last_modified'] = datetime.utcnow()
+        try:
+            return await self.collection.find_one_and_update(
+                {'_id': resource_id, 'deleted': False},
+                {'$set': to_update},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError as e:
+            raise DuplicatedKey(e.details.get('keyValue'))
+
+    async def delete(self, resource_id: ObjectId) -> bool:
+        r = await self.collection.update_one(
+            {'_id': resource_id, 'deleted': False},
+            {'$set': {'deleted': True, 'last_modified': datetime.utcnow()}}
+        )
+        return r.modified_count > 0
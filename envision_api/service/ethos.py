@@ -0,0 +1,308 @@
+from typing import Optional, Tuple
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import ReturnDocument, ASCENDING, UpdateOne
+
+from config.db import conn, get_async_conn
+from utils import thinkific
+from utils.format import format_dict
+from utils.logger import logger
+from models.talent import EthosSyncStatusEnum
+
+from service import jobs
+
+THINKIFIC_COLLECTION = 'instructors'
+SYNC_FIELD = 'ethos_sync'
+SYNC_LEASE = 60  # in seconds, a sync is claimed again if it did not finish by then
+SYNC_CONCURRENCY = 4
+SYNC_MAX_SLEEP = 30  # in seconds, for the talents written by other processes
+MAX_ATTEMPTS = 8
+RETRY_DELAY = 30  # in seconds, doubled on every attempt
+RECONCILE_BATCH_SIZE = 1000
+RECONCILE_FIELDS = ['name', 'short_bio', 'email', 'slug', 'title', 'deleted', 'ethos_id', SYNC_FIELD]
+RECONCILE_JOB = 'reconcile_ethos'
+CASE_INSENSITIVE_FIELDS = {'email', 'slug', 'last_name'}
+
+
+class ThinkificSyncError(Exception):
+    """Thinkific rejected the instructor, so it is not retried"""
+
+
+def format_thinkific_dict(talent_dict: dict) -> dict:
+    to_keep = {'name', 'short_bio', 'email', 'slug', 'title'}
+    to_delete = list(set(talent_dict.keys()) - to_keep)
+    to_rename = {'name': 'first_name', 'short_bio': 'bio'}
+    to_extend = {'user_id': None}
+
+    if talent_dict.get('picture.original'):
+        to_extend['avatar_url'] = talent_dict.get('picture.original')
+
+    if 'slug' in talent_dict:
+        to_extend['last_name'] = talent_dict['slug']
+
+    return format_dict(talent_dict, to_delete=to_delete, to_rename=to_rename, to_extend=to_extend)
+
+
+def pending_sync() -> dict:
+    """
+    The fields to set, in the same write as the talent, for the talent to be synced to Thinkific.
+    A new version is set on every write, so a sync only completes if the talent was not written meanwhile.
+    """
+    return {
+        f'{SYNC_FIELD}.status': EthosSyncStatusEnum.pending,
+        f'{SYNC_FIELD}.version': ObjectId(),
+        f'{SYNC_FIELD}.run_at': datetime.utcnow(),
+        f'{SYNC_FIELD}.attempts': 0,
+        f'{SYNC_FIELD}.error': None
+    }
+
+
+def new_sync() -> dict:
+    """The sync of a talent to create in Thinkific"""
+    return {**{k.split('.')[1]: v for k, v in pending_sync().items()}, 'lease_until': None}
+
+
+def _not_leased(now: datetime) -> dict:
+    return {'$or': [{f'{SYNC_FIELD}.lease_until': None}, {f'{SYNC_FIELD}.lease_until': {'$lt': now}}]}
+
+
+def claim() -> Optional[dict]:
+    """
+    Atomically takes the next talent to sync, with a lease, so a talent is synced by a single dispatcher at a time.
+    It is claimed again if the dispatcher dies and the lease expires.
+    """
+    now = datetime.utcnow()
+    return conn.talents.find_one_and_update(
+        {
+            f'{SYNC_FIELD}.status': EthosSyncStatusEnum.pending,
+            f'{SYNC_FIELD}.run_at': {'$lte': now},
+            **_not_leased(now)
+        },
+        {'$set': {f'{SYNC_FIELD}.lease_until': now + timedelta(seconds=SYNC_LEASE)}},
+        sort=[(f'{SYNC_FIELD}.run_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _push(talent: dict) -> dict:
+    """
+    Sends the current state of the talent to Thinkific: it is deleted, updated or created depending on the talent
+    (not on the write that made it pending), so the writes made while it was pending are sent once.
+    Returns the fields to set on the talent.
+    """
+    ethos_id = talent.get('ethos_id')
+    if talent.get('deleted'):
+        if not ethos_id:
+            return {}
+        r = thinkific.delete_item(THINKIFIC_COLLECTION, ethos_id)
+        if r['status'] >= 400 and r['status'] != 404:
+            raise ThinkificSyncError(r.get('error'))
+        return {'ethos_id': None}
+
+    item = format_thinkific_dict(talent)
+    if ethos_id:
+        r = thinkific.update_item(THINKIFIC_COLLECTION, ethos_id, item)
+        if r['status'] < 400:
+            return {}
+        if r['status'] != 404:
+            raise ThinkificSyncError(r.get('error'))
+        # The instructor was deleted in Thinkific, so it is created again
+        logger.info(f'Thinkific: instructor {ethos_id} of talent {talent["_id"]} not found, creating it again')
+
+    r = thinkific.create_item(THINKIFIC_COLLECTION, item)
+    if r['status'] >= 400:
+        raise ThinkificSyncError(r.get('error'))
+    return {'ethos_id': r['response']['id']}
+
+
+def sync(talent: dict) -> None:
+    """Syncs a claimed talent, and retries it later (with backoff) if Thinkific is unavailable"""
+    sync_state = talent[SYNC_FIELD]
+    now = datetime.utcnow()
+    try:
+        to_set = _push(talent)
+    except Exception as e:
+        attempts = sync_state.get('attempts', 0) + 1
+        error = str(getattr(e, 'detail', e))
+        retry = not isinstance(e, ThinkificSyncError) and attempts < MAX_ATTEMPTS
+        logger.warning(f'Thinkific: could not sync talent {talent["_id"]} ({error}), attempt {attempts}')
+        status = EthosSyncStatusEnum.pending if retry else EthosSyncStatusEnum.failed
+        to_set = {
+            f'{SYNC_FIELD}.attempts': attempts,
+            f'{SYNC_FIELD}.run_at': now + timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1)),
+            f'{SYNC_FIELD}.error': error
+        }
+    else:
+        status = EthosSyncStatusEnum.synced
+        to_set[f'{SYNC_FIELD}.last_synced'] = now
+        to_set[f'{SYNC_FIELD}.error'] = None
+        if 'ethos_id' in to_set:
+            # The id is kept even if the talent was written meanwhile, so it is not created twice
+            conn.talents.update_one({'_id': talent['_id']},
+                                    {'$set': {'ethos_id': to_set.pop('ethos_id'), 'last_modified': now}})
+
+    to_set[f'{SYNC_FIELD}.status'] = status
+    to_set[f'{SYNC_FIELD}.lease_until'] = None
+    r = conn.talents.update_one({'_id': talent['_id'], f'{SYNC_FIELD}.version': sync_state['version']},
+                                {'$set': to_set})
+    if not r.matched_count:
+        # The talent was written during the sync, so it is still pending and is synced again
+        conn.talents.update_one({'_id': talent['_id']}, {'$set': {f'{SYNC_FIELD}.lease_until': None}})
+
+
+def _normalized(field: str, value):
+    """The value as it is compared with Thinkific: trimmed, and lowercased for the emails and slugs"""
+    if isinstance(value, str):
+        value = value.strip()
+        if field in CASE_INSENSITIVE_FIELDS:
+            value = value.lower()
+    return value or None
+
+
+def _email(item: dict) -> Optional[str]:
+    return _normalized('email', item.get('email'))
+
+
+def _differs(talent: dict, instructor: dict) -> bool:
+    item = format_thinkific_dict(talent)
+    item.pop('user_id', None)
+    return any(_normalized(k, v) != _normalized(k, instructor.get(k)) for k, v in item.items())
+
+
+def _diff(talent: dict, instructors: dict, by_email: dict, linked: set) -> Tuple[Optional[dict], list]:
+    """
+    Returns the instructor of the talent (by its ethos_id and then by its email) and the actions to bring it in
+    line with the talent
+    """
+    ethos_id = talent.get('ethos_id')
+    # ethos_instructor is not stored: the instructor talents are the ones with an ethos_id or a sync
+    instructor_talent = bool(ethos_id) or SYNC_FIELD in talent
+    instructor = instructors.get(ethos_id) if ethos_id else None
+    if not instructor and not talent['deleted'] and instructor_talent:
+        instructor = by_email.get(_email(talent))
+        if instructor and instructor['id'] in linked:
+            instructor = None
+    if instructor:
+        linked.add(instructor['id'])
+
+    if talent['deleted']:
+        if instructor:
+            return instructor, ['delete']
+        return None, ['unlink'] if ethos_id else []
+    if not instructor:
+        return None, ['create'] if instructor_talent else []
+    actions = ['link'] if instructor['id'] != ethos_id else []
+    return instructor, (actions + ['update'] if _differs(talent, instructor) else actions)
+
+
+def _reconcile_op(talent: dict, instructor: Optional[dict], actions: list) -> UpdateOne:
+    to_set = {}
+    if {'link', 'unlink', 'create'}.intersection(actions):
+        to_set['ethos_id'] = instructor['id'] if instructor else None
+        to_set['last_modified'] = datetime.utcnow()
+    if {'create', 'update', 'delete'}.intersection(actions):
+        to_set.update(pending_sync())
+    # The talents written meanwhile are pending, and left to the dispatcher
+    return UpdateOne({'_id': talent['_id'], f'{SYNC_FIELD}.status': {'$ne': EthosSyncStatusEnum.pending}},
+                     {'$set': to_set})
+
+
+def reconcile(dry_run: bool = False) -> dict:
+    """
+    Compares the instructor talents with the Thinkific instructors, by ethos_id and then by email, in a single pass
+    over the talents. The talents are linked to their instructors in bulk and the ones to create, update or delete in
+    Thinkific are marked pending, so the dispatcher syncs them SYNC_CONCURRENCY at a time.
+    Returns the report of the differences (by action, the talent ids), which are only fixed if not `dry_run`.
+    """
+    instructors, by_email = {}, {}
+    for instructor in thinkific.iter_items(THINKIFIC_COLLECTION):
+        instructors[instructor['id']] = instructor
+        if _email(instructor):
+            by_email.setdefault(_email(instructor), instructor)
+    # The instructors of other talents are not matched by email
+    linked = set(conn.talents.distinct('ethos_id', {'ethos_id': {'$ne': None}})).intersection(instructors)
+
+    report = {'dry_run': dry_run, 'talents': 0, 'instructors': len(instructors), 'in_sync': 0, 'pending': [],
+              'create': [], 'update': [], 'delete': [], 'link': [], 'unlink': []}
+    ops, applied = [], 0
+    query = {'$or': [{'ethos_id': {'$ne': None}}, {SYNC_FIELD: {'$exists': True}}]}
+    for talent in conn.talents.find(query, RECONCILE_FIELDS, batch_size=RECONCILE_BATCH_SIZE):
+        report['talents'] += 1
+        if talent.get(SYNC_FIELD, {}).get('status') == EthosSyncStatusEnum.pending:
+            report['pending'].append(str(talent['_id']))
+            continue
+        instructor, actions = _diff(talent, instructors, by_email, linked)
+        if not actions:
+            report['in_sync'] += 1
+            continue
+        for action in actions:
+            report[action].append(str(talent['_id']))
+        if dry_run:
+            continue
+        ops.append(_reconcile_op(talent, instructor, actions))
+        if len(ops) >= RECONCILE_BATCH_SIZE:
+            applied += conn.talents.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        applied += conn.talents.bulk_write(ops, ordered=False).modified_count
+
+    report['orphans'] = sorted(set(instructors) - linked)
+    report['applied'] = applied
+    logger.info(f'Thinkific: reconciled {report["talents"]} talents with {report["instructors"]} instructors, '
+                f'{applied} talents fixed (dry_run={dry_run})')
+    if applied:
+        dispatcher.wake()
+    return report
+
+
+async def enqueue_reconcile(dry_run: bool = True) -> ObjectId:
+    """Enqueues the reconcile, which pages every instructor of Thinkific, so it runs in the job workers"""
+    return await jobs.enqueue_async(RECONCILE_JOB, {'dry_run': dry_run})
+
+
+@jobs.handler(RECONCILE_JOB)
+def _reconcile_job(payload: dict) -> dict:
+    return reconcile(dry_run=payload['dry_run'])
+
+
+async def get_reconcile(job_id: ObjectId) -> Optional[dict]:
+    """The status of a reconcile job and, once it is done, its report"""
+    job = await get_async_conn().jobs.find_one({'_id': job_id, 'type': RECONCILE_JOB})
+    if not job:
+        return
+    return {'id': str(job['_id']), 'status': job['status'], 'dry_run': job['payload']['dry_run'],
+            'report': job.get('result'), 'error': job['error'], 'date_created': job['date_created']}
+
+
+class _Dispatcher(jobs.Loop):
+    """
+    Syncs the pending talents to Thinkific, SYNC_CONCURRENCY at a time. It is woken up by the talent writes of
+    this process and polls every SYNC_MAX_SLEEP for the others (and the retries).
+    """
+    name = 'Thinkific dispatcher'
+    max_sleep = SYNC_MAX_SLEEP
+
+    def _drain(self) -> None:
+        while talent := claim():
+            sync(talent)
+
+    def _tick(self) -> float:
+        with ThreadPoolExecutor(max_workers=SYNC_CONCURRENCY) as executor:
+            for f in [executor.submit(self._drain) for _ in range(SYNC_CONCURRENCY)]:
+                f.result()
+        return self._next_timeout()
+
+    @staticmethod
+    def _next_timeout() -> float:
+        # The talents being synced by other dispatchers are left to them
+        talent = conn.talents.find_one({f'{SYNC_FIELD}.status': EthosSyncStatusEnum.pending,
+                                        **_not_leased(datetime.utcnow())},
+                                       {f'{SYNC_FIELD}.run_at': 1}, sort=[(f'{SYNC_FIELD}.run_at', ASCENDING)])
+        if not talent:
+            return SYNC_MAX_SLEEP
+        seconds = (talent[SYNC_FIELD]['run_at'] - datetime.utcnow()).total_seconds()
+        return min(max(seconds, 0), SYNC_MAX_SLEEP)
+
+
+dispatcher = _Dispatcher()
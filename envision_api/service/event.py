@@ -1,20 +1,27 @@
 from typing import Optional, Union
 from bson import ObjectId
 from datetime import datetime
+from pymongo import UpdateOne, IndexModel, ASCENDING
 import pytz
 
 from exceptions.events_exceptions import (EventsOverlap, EventDatesInverted, MissingDate,
                                           EventTooShortDuration, EventTooLongDuration)
+from exceptions.resource_exceptions import InvalidCursor
 
-from utils.format import create_response_paginated, paginate_list, regex_query
+from utils.format import create_response_paginated_async, paginate_list, set_null_last_keys, null_last_indexes
+from utils.search import search_keywords, search_query, relevance_stages, SEARCH_KEYWORDS_FIELD, RELEVANCE_SORT
 
 from models.event import EventModel
 from models.response import ListModel
 from models.filters import EventFilters
-from service.base import Base
+from service.async_base import AsyncBase
 
 EVENT_MINIMUM_DURATION = 15  # in minutes
 EVENT_MAXIMUM_DURATION = 23  # in hours
+SEARCH_FIELDS_BATCH_SIZE = 1000
+
+# Fields the denormalized search fields (talent_name, stage_name and the search keywords) are computed from
+search_references = ['name', 'talents_ids', 'collaborators_ids', 'stage_id']
 
 lookup_stages = [
     {
@@ -49,6 +56,9 @@ lookup_stages = [
 ]
 
 
+lookup_fields = ['talents', 'collaborators', 'stage']
+
+
 def _event_entity(event: dict) -> dict:
     if not event:
         return event
@@ -82,12 +92,23 @@ def _dates_verifications(start_date: datetime, end_date: datetime) -> None:
         raise EventTooLongDuration(EVENT_MAXIMUM_DURATION)
 
 
-class Event(Base):
+class Event(AsyncBase):
+    sort_fields = ['start_date']
+    indexes = [
+        IndexModel([('stage_id', ASCENDING), ('start_date', ASCENDING), ('end_date', ASCENDING)]),
+        IndexModel([('talents_ids', ASCENDING)]),
+        IndexModel([('collaborators_ids', ASCENDING)]),
+        IndexModel([('tags', ASCENDING)]),
+        IndexModel([('last_modified', ASCENDING)]),
+        IndexModel([(SEARCH_KEYWORDS_FIELD, ASCENDING)]),
+        *null_last_indexes('start_date', prefix=[('deleted', ASCENDING)])
+    ]
+
     def __init__(self):
         super().__init__(resource='events', q_fields=['name', 'stage_name', 'talent_name'])
 
-    def _create_pipeline(self, filters: EventFilters, last_modified: datetime = None, sort_by: str = None,
-                         ascending: bool = True, offset: int = None, limit: int = None) -> list:
+    def _create_pipeline(self, filters: EventFilters, last_modified: datetime = None,
+                         with_lookup: bool = True) -> list:
         match_stage = {}
         end_date_filter = {}
         if filters.ids:
@@ -118,27 +139,65 @@ class Event(Base):
             match_stage['type'] = filters.type
         if filters.tags:
             match_stage['tags'] = {'$in': filters.tags}
-
-        pipeline = [{'$match': match_stage}]
-        pipeline.extend(lookup_stages)
         if filters.q:
-            match_stage_2 = {'$or': [regex_query(field, filters.q) for field in self.q_fields]}
-            pipeline.append({'$match': match_stage_2})
+            # stage_name and talent_name are denormalized on the event, so the search runs before the lookups
+            match_stage['$and'] = [search_query(filters.q, self.q_fields)]
 
-        if sort_by:
-            pipeline.append({'$sort': {sort_by: 1 if ascending else -1}})
-        if offset:
-            pipeline.append({'$skip': offset})
-        if limit:
-            pipeline.append({'$limit': limit})
+        pipeline = [{'$match': match_stage}]
+        if with_lookup:
+            pipeline.extend(lookup_stages)
 
         return pipeline
 
-    def _find_overlap(self, start_date: datetime, end_date: datetime, stage_id: ObjectId,
-                      exclude_event: ObjectId = None) -> list:
+    async def _search_fields(self, events: list) -> list:
+        """Returns the denormalized search fields (talent_name, stage_name and the search keywords) of each event"""
+        talents_ids = {t for e in events for t in (e.get('talents_ids') or []) + (e.get('collaborators_ids') or [])}
+        stages_ids = {e['stage_id'] for e in events if e.get('stage_id')}
+        db = self.collection.database
+        talents = {t['_id']: t.get('name')
+                   async for t in db.talents.find({'_id': {'$in': list(talents_ids)}}, {'name': 1})}
+        stages = {s['_id']: s.get('name')
+                  async for s in db.venues.find({'_id': {'$in': list(stages_ids)}}, {'name': 1})}
+
+        search_fields = []
+        for e in events:
+            event_talents = (e.get('talents_ids') or []) + (e.get('collaborators_ids') or [])
+            fields = {
+                'talent_name': [talents[t] for t in event_talents if talents.get(t)],
+                'stage_name': stages.get(e.get('stage_id'))
+            }
+            fields[SEARCH_KEYWORDS_FIELD] = search_keywords([e.get('name'), fields['stage_name'], fields['talent_name']])
+            search_fields.append(fields)
+        return search_fields
+
+    async def refresh_search_fields(self, query: dict) -> int:
+        """
+        Recomputes the search fields of the events that match the query, e.g. after a talent or a stage is renamed.
+        Returns the number of events updated.
+        """
+        cursor = self.collection.find(query, search_references).batch_size(SEARCH_FIELDS_BATCH_SIZE)
+        updated = 0
+        batch = []
+        async for event in cursor:
+            batch.append(event)
+            if len(batch) == SEARCH_FIELDS_BATCH_SIZE:
+                updated += await self._write_search_fields(batch)
+                batch = []
+        if batch:
+            updated += await self._write_search_fields(batch)
+        return updated
+
+    async def _write_search_fields(self, events: list) -> int:
+        search_fields = await self._search_fields(events)
+        r = await self.collection.bulk_write([UpdateOne({'_id': event['_id']}, {'$set': fields})
+                                        for event, fields in zip(events, search_fields)], ordered=False)
+        return r.modified_count
+
+    async def _find_overlap(self, start_date: datetime, end_date: datetime, stage_id: ObjectId,
+                            exclude_event: ObjectId = None) -> list:
         if not stage_id:
             return []
-        return [e['name'] for e in self.collection.find(
+        return [e['name'] async for e in self.collection.find(
             {
                 'start_date': {'$lt': end_date},
                 'end_date': {'$gt': start_date},
@@ -149,19 +208,30 @@ class Event(Base):
             {'name': 1}
         )]
 
-    def find(self, *, filters: EventFilters, last_modified: datetime = None, sort_by: str = None,
-             ascending: bool = True, limit: int = None, offset: int = None) -> ListModel[EventModel]:
-        pipeline = self._create_pipeline(filters=filters, last_modified=last_modified, sort_by=sort_by,
-                                         ascending=ascending, limit=limit, offset=offset)
-
-        response = create_response_paginated(self.collection,
-                                             pipeline=pipeline,
-                                             limit=limit, offset=offset,
-                                             sort_by=sort_by, ascending=ascending,
-                                             format_func=_event_entity)
+    async def find(self, *, filters: EventFilters, last_modified: datetime = None, sort_by: str = None,
+                   ascending: bool = True, limit: int = None, offset: int = None,
+                   cursor: str = None) -> ListModel[EventModel]:
+        # The lookups are only needed before sorting when the sort uses the joined fields,
+        # otherwise they are applied to the returned page only
+        lookup_first = (sort_by or '').split('.')[0] in lookup_fields
+        pipeline = self._create_pipeline(filters=filters, last_modified=last_modified, with_lookup=lookup_first)
+        if sort_by == RELEVANCE_SORT:
+            if cursor:
+                raise InvalidCursor()
+            if filters.q:
+                pipeline.extend(relevance_stages(filters.q, 'name'))
+            sort_by = None
+
+        response = await create_response_paginated_async(self.collection,
+                                                         pipeline=pipeline,
+                                                         limit=limit, offset=offset, cursor=cursor,
+                                                         sort_by=sort_by, ascending=ascending,
+                                                         format_func=_event_entity,
+                                                         page_stages=None if lookup_first else lookup_stages,
+                                                         null_last_fields=self.sort_fields)
         return response
 
-    def get(self, event_id: ObjectId) -> Optional[dict]:
+    async def get(self, event_id: ObjectId) -> Optional[dict]:
         pipeline = [{
             '$match': {
                 '_id': event_id,
@@ -169,11 +239,11 @@ class Event(Base):
             }
         }]
         pipeline.extend(lookup_stages)
-        response = list(self.collection.aggregate(pipeline))
+        response = await self.collection.aggregate(pipeline).to_list(None)
 
         return _event_entity(response[0]) if len(response) > 0 else None
 
-    def create(self, event: dict) -> dict:
+    async def create(self, event: dict) -> dict:
         if type(event['start_date']) != type(event['end_date']):
             raise MissingDate()
 
@@ -183,15 +253,17 @@ class Event(Base):
         if event['start_date'] and event['end_date']:
             _dates_verifications(event['start_date'], event['end_date'])
 
-        events_overlap = self._find_overlap(event['start_date'], event['end_date'], event['stage_id'])
+        events_overlap = await self._find_overlap(event['start_date'], event['end_date'], event['stage_id'])
         if events_overlap:
             raise EventsOverlap(events_overlap)
 
-        mongo_event = super().create(event)
+        set_null_last_keys(event, self.sort_fields)
+        event.update((await self._search_fields([event]))[0])
+        mongo_event = await super().create(event)
         return _event_entity(mongo_event)
 
-    def update(self, event_id: ObjectId, event: dict) -> Optional[dict]:
-        event_db = self.get(event_id)
+    async def update(self, event_id: ObjectId, event: dict) -> Optional[dict]:
+        event_db = await self.get(event_id)
 
         if not event_db or not event:
             return event_db
@@ -213,16 +285,21 @@ class Event(Base):
             if start_date and end_date:
                 _dates_verifications(start_date, end_date)
 
-            events_overlap = self._find_overlap(start_date, end_date, stage_id, event_id)
+            events_overlap = await self._find_overlap(start_date, end_date, stage_id, event_id)
             if events_overlap:
                 raise EventsOverlap(events_overlap)
 
-        super().update(event_id, to_update)
-        return self.get(event_id)
-
-    def exists(self, event_id: Union[str, ObjectId] = None,
-               talent_id: Union[str, ObjectId] = None,
-               stage_id: Union[str, ObjectId] = None) -> bool:
+        set_null_last_keys(to_update, self.sort_fields)
+        if any(f in to_update for f in search_references):
+            event_references = await self.collection.find_one({'_id': event_id}, search_references)
+            event_references.update({f: to_update[f] for f in search_references if f in to_update})
+            to_update.update((await self._search_fields([event_references]))[0])
+        await super().update(event_id, to_update)
+        return await self.get(event_id)
+
+    async def exists(self, event_id: Union[str, ObjectId] = None,
+                     talent_id: Union[str, ObjectId] = None,
+                     stage_id: Union[str, ObjectId] = None) -> bool:
         q = {'deleted': False}
 
         for v in [event_id, talent_id, stage_id]:
@@ -236,8 +313,8 @@ class Event(Base):
         if stage_id:
             q['stage_id'] = ObjectId(stage_id)
 
-        return self.collection.count_documents(q) > 0
+        return await self.collection.count_documents(q, limit=1) > 0
 
-    def get_tags(self, limit: int = None, offset: int = None) -> ListModel:
-        tags = [tag for tag in self.collection.distinct('tags', filter={'deleted': False}) if tag]
+    async def get_tags(self, limit: int = None, offset: int = None) -> ListModel:
+        tags = [tag for tag in await self.collection.distinct('tags', filter={'deleted': False}) if tag]
         return paginate_list(tags, limit=limit, offset=offset)
@@ -0,0 +1,204 @@
+import os
+import socket
+from typing import Optional, Callable
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from bson import ObjectId
+from pymongo import ReturnDocument, IndexModel, ASCENDING
+
+from config.db import conn, get_async_conn
+from config.constants import JOB_WORKERS
+from utils.logger import logger
+
+JOB_LEASE = 60  # in seconds, a running job is claimed again if its lease is not renewed
+HEARTBEAT_INTERVAL = 20  # in seconds
+POLL_INTERVAL = 1  # in seconds
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30  # in seconds, multiplied by the number of attempts
+
+indexes = [
+    IndexModel([('status', ASCENDING), ('run_at', ASCENDING)]),
+    IndexModel([('worker', ASCENDING), ('status', ASCENDING)])
+]
+
+_handlers = {}
+_failed_handlers = {}
+
+
+def handler(job_type: str) -> Callable:
+    """
+    Registers the function that runs the jobs of a type. It receives the payload of the job, and what it returns
+    (if not None) is saved as the result of the job.
+    """
+    def register(func: Callable) -> Callable:
+        _handlers[job_type] = func
+        return func
+    return register
+
+
+def failed_handler(job_type: str) -> Callable:
+    """
+    Registers the function that is called when a job of a type fails for good (after MAX_ATTEMPTS).
+    It receives the payload and the error of the job.
+    """
+    def register(func: Callable) -> Callable:
+        _failed_handlers[job_type] = func
+        return func
+    return register
+
+
+def _job(job_type: str, payload: dict, run_at: datetime = None) -> dict:
+    now = datetime.utcnow()
+    return {
+        'type': job_type,
+        'payload': payload,
+        'status': 'pending',
+        'attempts': 0,
+        'run_at': run_at or now,
+        'worker': None,
+        'lease_until': None,
+        'error': None,
+        'date_created': now,
+        'last_modified': now
+    }
+
+
+def enqueue(job_type: str, payload: dict, run_at: datetime = None) -> ObjectId:
+    return conn.jobs.insert_one(_job(job_type, payload, run_at)).inserted_id
+
+
+async def enqueue_async(job_type: str, payload: dict, run_at: datetime = None) -> ObjectId:
+    """enqueue on Motor, for the services that run in the event loop"""
+    return (await get_async_conn().jobs.insert_one(_job(job_type, payload, run_at))).inserted_id
+
+
+def claim(worker: str) -> Optional[dict]:
+    """Atomically takes the next pending job, or a running job whose lease expired (its worker died)"""
+    now = datetime.utcnow()
+    return conn.jobs.find_one_and_update(
+        {
+            'type': {'$in': list(_handlers)},
+            '$or': [
+                {'status': 'pending', 'run_at': {'$lte': now}},
+                {'status': 'running', 'lease_until': {'$lt': now}}
+            ]
+        },
+        {
+            '$set': {'status': 'running', 'worker': worker, 'lease_until': now + timedelta(seconds=JOB_LEASE),
+                     'last_modified': now},
+            '$inc': {'attempts': 1}
+        },
+        sort=[('run_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def run(job: dict, worker: str) -> None:
+    now = datetime.utcnow()
+    try:
+        result = _handlers[job['type']](job['payload'])
+    except Exception as e:
+        logger.exception(f'Jobs: {job["type"]} {job["_id"]} failed (attempt {job["attempts"]})')
+        if job['attempts'] >= MAX_ATTEMPTS:
+            to_update = {'status': 'failed'}
+        else:
+            to_update = {'status': 'pending', 'run_at': now + timedelta(seconds=RETRY_DELAY * job['attempts'])}
+        to_update['error'] = str(e)
+    else:
+        to_update = {'status': 'done', 'error': None}
+        if result is not None:
+            to_update['result'] = result
+    to_update.update(worker=None, lease_until=None, last_modified=datetime.utcnow())
+    # The job is only updated if it was not claimed by another worker after losing its lease
+    r = conn.jobs.update_one({'_id': job['_id'], 'worker': worker, 'status': 'running'}, {'$set': to_update})
+    if r.modified_count and to_update['status'] == 'failed' and job['type'] in _failed_handlers:
+        try:
+            _failed_handlers[job['type']](job['payload'], to_update['error'])
+        except Exception:
+            logger.exception(f'Jobs: the failure of {job["type"]} {job["_id"]} could not be handled')
+
+
+class Workers:
+    """Runs the jobs in `concurrency` threads and renews the leases of the running jobs"""
+
+    def __init__(self, concurrency: int = JOB_WORKERS):
+        self.concurrency = concurrency
+        self.name = f'{socket.gethostname()}-{os.getpid()}-{ObjectId()}'
+        self._stop = Event()
+        self._threads = []
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._threads = [Thread(target=self._work, daemon=True) for _ in range(self.concurrency)]
+        self._threads.append(Thread(target=self._heartbeat, daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def stop(self, timeout: float = None) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = claim(self.name)
+            except Exception:
+                logger.exception('Jobs: could not claim a job')
+                job = None
+            if not job:
+                self._stop.wait(POLL_INTERVAL)
+                continue
+            run(job, self.name)
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                conn.jobs.update_many(
+                    {'worker': self.name, 'status': 'running'},
+                    {'$set': {'lease_until': datetime.utcnow() + timedelta(seconds=JOB_LEASE)}}
+                )
+            except Exception:
+                logger.exception('Jobs: could not renew the leases')
+
+
+class Loop:
+    """A daemon thread that runs `_tick` until it is stopped, sleeping the seconds returned or until woken up"""
+    name = ''
+    max_sleep = 60  # in seconds, after a failure
+
+    def __init__(self):
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                timeout = self._tick()
+            except Exception:
+                logger.exception(f'Jobs: the {self.name} failed')
+                timeout = self.max_sleep
+            self._wake.wait(timeout)
+
+    def _tick(self) -> float:
+        raise NotImplementedError
+
+
+workers = Workers()
+
@@ -1,113 +1,420 @@
-from typing import Optional
-from datetime import datetime
+from typing import Optional, Iterator
+from collections import deque, Counter
+from datetime import datetime, timedelta
 from bson import ObjectId
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, IndexModel, ASCENDING, UpdateMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from exceptions.notification_exceptions import CancelNotificationException, UpdateNotificationException
 
-from config.db import conn
-from utils.notifications import send_notification
-from utils.format import create_response_paginated
+from config.db import conn, get_async_conn
+from utils.notifications import stream_notification, experience_ids, get_receipts
+from utils.format import create_response_paginated_async
+from utils.logger import logger
 
 from models.notification import NotificationStatusEnum, UsersFilterModel, NotificationModel
 from models.response import ListModel
+from models.user_notification import UserNotificationModel
 
-import service.user
+from service import jobs
 
+USERS_BATCH_SIZE = 1000
+BOOKKEEPING_BATCH_SIZE = 1000
+SEND_NOTIFICATION_JOB = 'send_notification'
+SCHEDULER_MAX_SLEEP = 60  # in seconds
+EXPERIENCE_ID_FIELD = 'expo_experience_id'
+USER_NOTIFICATIONS_FIELD = 'notifications'
+SENDING = 'sending'  # a notification with status sent and no sent_at, its send did not finish
+FAILED = 'failed'  # a notification with status sent whose send job failed for good (failed_at)
+RECEIPTS_DELAY = 15 * 60  # in seconds, Expo recommends to wait 15 minutes before fetching the receipts
+RECEIPTS_POLL_INTERVAL = 60  # in seconds
+RECEIPTS_BATCH_SIZE = 10000
+RECEIPTS_LEASE = 10 * 60  # in seconds, the tickets claimed by a process that stopped are checked again after it
+PUSH_TICKETS_TTL = 24 * 60 * 60  # in seconds, Expo keeps the receipts for a day
 
-def find(limit: int = None, offset: int = None) -> ListModel[NotificationModel]:
-    return create_response_paginated(conn.notifications, query={}, limit=limit, offset=offset)
+indexes = [
+    IndexModel([('status', ASCENDING), ('send_at', ASCENDING)]),
+    IndexModel([('status', ASCENDING), ('sent_at', ASCENDING)])
+]
 
+# A notification has a single send job, so enqueuing its send again does nothing
+jobs_indexes = [
+    IndexModel([('payload.notification_id', ASCENDING)], unique=True,
+               partialFilterExpression={'type': SEND_NOTIFICATION_JOB})
+]
 
-def get(notification_id: ObjectId) -> Optional[dict]:
-    return conn.notifications.find_one({'_id': notification_id})
+# The notifications are recorded on the users by expo token
+users_indexes = [
+    IndexModel([('expo_token', ASCENDING)])
+]
 
+# The tickets whose receipt was not fetched in a day are dropped
+push_tickets_indexes = [
+    IndexModel([('check_after', ASCENDING)]),
+    IndexModel([('date_created', ASCENDING)], expireAfterSeconds=PUSH_TICKETS_TTL)
+]
 
-def create(title: str, body: str, url: str, test: bool = False, users_filter: UsersFilterModel = None,
-           send_at: datetime = None) -> dict:
+
+def _users_query(users_filter: Optional[dict], test: bool) -> dict:
     q = {}
     if users_filter:
-        if expo_token := users_filter.expo_token:
+        if expo_token := users_filter.get('expo_token'):
             q['expo_token'] = expo_token
-        if favourite_talents := users_filter.favourite_talents:
+        if favourite_talents := users_filter.get('favourite_talents'):
             q['favourite_talents'] = favourite_talents
-        if favourite_events := users_filter.favourite_events:
+        if favourite_events := users_filter.get('favourite_events'):
             q['favourite_events'] = favourite_events
     if test:
         q['test'] = True
+    return q
+
+
+def _audience(q: dict, users: deque) -> Iterator[tuple]:
+    """
+    Streams the expo tokens (and experience ids) of the users that match the query, reading the users in batches
+    (sorted by _id). The _id and the token of each user read are appended to `users`.
+    """
+    q = q.copy()
+    if 'expo_token' not in q:
+        q['expo_token'] = {'$nin': [None, '']}
+    cursor = conn.users.find(q, {'expo_token': 1, EXPERIENCE_ID_FIELD: 1}).sort('_id', ASCENDING)
+    for user in cursor.batch_size(USERS_BATCH_SIZE):
+        users.append((user['_id'], user['expo_token']))
+        yield user['expo_token'], user.get(EXPERIENCE_ID_FIELD)
+
+
+def _record_on_users(notification_id: ObjectId, tokens: dict) -> None:
+    """
+    Records the notification on the users of the tokens (by error) with a single unordered bulk write. A user that
+    already has it (from a resumed send) is skipped.
+    """
+    now = datetime.utcnow()
+    ops = [
+        UpdateMany({'expo_token': {'$in': error_tokens},
+                    f'{USER_NOTIFICATIONS_FIELD}.notification_id': {'$ne': notification_id}},
+                   {'$push': {USER_NOTIFICATIONS_FIELD: UserNotificationModel(notification_id=notification_id,
+                                                                              error=error, date=now).dict()}})
+        for error, error_tokens in tokens.items() if error_tokens
+    ]
+    if ops:
+        conn.users.bulk_write(ops, ordered=False)
+
+
+def _save_experience_ids() -> None:
+    """Saves on the users the experience ids learned from Expo, so that the next sends group them from the start"""
+    learned = experience_ids.pop_learned()
+    if learned:
+        conn.users.bulk_write([UpdateMany({'expo_token': {'$in': tokens}}, {'$set': {EXPERIENCE_ID_FIELD: e}})
+                               for e, tokens in learned.items()], ordered=False)
+
+
+class _Bookkeeping:
+    """
+    Records the notification on its users in batches, while the push results arrive.
+    Every batch also adds its counts to the notification and saves the last user sent, so that a send that is
+    interrupted can be resumed, and saves the push tickets for the receipts to be checked later.
+    """
+
+    def __init__(self, notification_id: ObjectId, batch_size: int = BOOKKEEPING_BATCH_SIZE):
+        self.notification_id = notification_id
+        self.batch_size = batch_size
+        self.tokens = {False: [], True: []}  # by error
+        self.counts = {False: 0, True: 0}
+        self.tickets = []
+        self.last_user_id = None
+
+    def add(self, results: list, last_user_id: ObjectId = None) -> None:
+        for n in results:
+            if n['status'] in ['ok', 'error']:
+                error = n['status'] == 'error'
+                self.tokens[error].append(n['token'])
+                self.counts[error] += 1
+            if n.get('id'):
+                self.tickets.append({'_id': n['id'], 'token': n['token'], 'notification_id': self.notification_id})
+        self.last_user_id = last_user_id or self.last_user_id
+        if any(len(tokens) >= self.batch_size for tokens in self.tokens.values()):
+            self.flush()
+
+    def flush(self) -> None:
+        tokens, tickets = self.tokens, self.tickets
+        self.tokens, self.tickets = {False: [], True: []}, []
+        _record_on_users(self.notification_id, tokens)
+        to_update = {'$inc': {'notifications_sent': len(tokens[False]), 'notifications_error': len(tokens[True])}}
+        if self.last_user_id:
+            to_update['$set'] = {'resume_after': self.last_user_id}
+        conn.notifications.update_one({'_id': self.notification_id}, to_update)
+        _save_experience_ids()
+        _save_tickets(tickets)
+
+
+def _save_tickets(tickets: list) -> None:
+    if not tickets:
+        return
+    now = datetime.utcnow()
+    for ticket in tickets:
+        ticket.update({'check_after': now + timedelta(seconds=RECEIPTS_DELAY), 'date_created': now})
+    try:
+        conn.push_tickets.insert_many(tickets, ordered=False)
+    except BulkWriteError as e:
+        # The tickets of a resumed send may already be saved
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+
+def _send(notification: dict) -> tuple:
+    """
+    Sends the notification to its users while they are read (from the last user sent, if it was interrupted)
+    and records it on the users. Returns the number of notifications sent and with errors.
+    """
+    q = _users_query(notification.get('filter'), notification.get('test', False))
+    if resume_after := notification.get('resume_after'):
+        q['_id'] = {'$gt': resume_after}
+
+    bookkeeping = _Bookkeeping(notification['_id'])
+    users = deque()
+    sent = Counter()
+    title, body, url = notification['title'], notification['body'], notification.get('url')
+    try:
+        for results in stream_notification(title, body, url, _audience(q, users)):
+            # The chunks are grouped by experience id, so the last user sent is the last of the users read in order
+            # whose tokens were all sent
+            sent.update(n['token'] for n in results)
+            last_user_id = None
+            while users and sent[users[0][1]]:
+                last_user_id, token = users.popleft()
+                sent.subtract([token])
+                if not sent[token]:
+                    del sent[token]
+            bookkeeping.add(results, last_user_id)
+    finally:
+        # The results so far are saved also when the send fails, so its retry resumes after them
+        bookkeeping.flush()
+    now = datetime.utcnow()
+    conn.notifications.update_one({'_id': notification['_id']},
+                                  {'$set': {'sent_at': now, 'last_modified': now}, '$unset': {'send_error': ''}})
+    return bookkeeping.counts[False], bookkeeping.counts[True]
+
+
+def _enqueue_send(notification_id: ObjectId) -> bool:
+    """Enqueues the send of the notification, unless it is already enqueued. Returns whether it was enqueued"""
+    try:
+        jobs.enqueue(SEND_NOTIFICATION_JOB, {'notification_id': notification_id})
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+@jobs.handler(SEND_NOTIFICATION_JOB)
+def _send_job(payload: dict) -> None:
+    notification = conn.notifications.find_one({'_id': payload['notification_id']})
+    if not notification:
+        return
+    try:
+        _send(notification)
+    except Exception as e:
+        # The job is retried, meanwhile the notification shows why it is not sent yet
+        conn.notifications.update_one({'_id': notification['_id']}, {'$set': {'send_error': str(e)}})
+        raise
+
+
+@jobs.failed_handler(SEND_NOTIFICATION_JOB)
+def _send_failed(payload: dict, error: str) -> None:
+    now = datetime.utcnow()
+    conn.notifications.update_one({'_id': payload['notification_id'], 'sent_at': None},
+                                  {'$set': {'failed_at': now, 'send_error': error, 'last_modified': now}})
+
+
+def _send_status(notification: dict) -> str:
+    """The status of the notification, which is sending until its send finishes or fails for good"""
+    if notification['status'] == NotificationStatusEnum.sent and not notification.get('sent_at'):
+        return FAILED if notification.get('failed_at') else SENDING
+    return notification['status']
 
-    tokens = [user['expo_token'] for user in conn.users.find(q, {'expo_token': 1})]
-    if not send_at:
-        notifications_results = send_notification(title, body, url, tokens)
-        notifications_sent = [n['token'] for n in notifications_results if n['status'] == 'ok']
-        notifications_error = [n['token'] for n in notifications_results if n['status'] == 'error']
-        status = NotificationStatusEnum.sent
-    else:
-        notifications_sent = []
-        notifications_error = []
-        status = NotificationStatusEnum.scheduled
 
+async def find(limit: int = None, offset: int = None) -> ListModel[NotificationModel]:
+    return await create_response_paginated_async(get_async_conn().notifications, query={}, limit=limit, offset=offset)
+
+
+async def get(notification_id: ObjectId) -> Optional[dict]:
+    return await get_async_conn().notifications.find_one({'_id': notification_id})
+
+
+def create(title: str, body: str, url: str, test: bool = False, users_filter: UsersFilterModel = None,
+           send_at: datetime = None) -> dict:
+    """Creates the notification and, if it is not scheduled, enqueues its send"""
     notification = {
         'title': title,
         'body': body,
         'url': url,
-        'filter': users_filter.dict(),
+        'filter': users_filter.dict() if users_filter else None,
         'send_at': send_at,
-        'status': status,
+        'status': NotificationStatusEnum.scheduled if send_at else NotificationStatusEnum.sent,
         'test': test,
-        'notifications_sent': len(notifications_sent),
-        'notifications_error': len(notifications_error),
+        'notifications_sent': 0,
+        'notifications_error': 0,
         'date_created': datetime.utcnow()
     }
     r = conn.notifications.insert_one(notification)
     notification['_id'] = r.inserted_id
 
-    service.User().new_notifications(notifications_sent, r.inserted_id, error=False)
-    service.User().new_notifications(notifications_error, r.inserted_id, error=True)
+    if not send_at:
+        _enqueue_send(r.inserted_id)
+    else:
+        scheduler.wake()
 
     return notification
 
 
 def send_scheduled() -> list:
+    """
+    Enqueues the send of the scheduled notifications that are due, and of the notifications being sent that have
+    no send job (the process that claimed or created them stopped before enqueuing it)
+    """
     notifications = []
     query = {
         'status': NotificationStatusEnum.scheduled,
         'send_at': {'$lte': datetime.utcnow()}
     }
-    for notification in conn.notifications.find(query):
-        q = {}
-        if notification.get('filter'):
-            if favourite_talents := notification.get('filter').get('favourite_talents'):
-                q['favourite_talents'] = favourite_talents
-            if favourite_events := notification.get('filter').get('favourite_events'):
-                q['favourite_events'] = favourite_events
-        if notification.get('test', False):
-            q['test'] = True
-
-        tokens = [user['expo_token'] for user in conn.users.find(q, {'expo_token': 1})]
-        title, body, url = notification['title'], notification['body'], notification.get('url')
-        notifications_results = send_notification(title, body, url, tokens)
-        notifications_sent = [n['token'] for n in notifications_results if n['status'] == 'ok']
-        notifications_error = [n['token'] for n in notifications_results if n['status'] == 'error']
-        conn.notifications.update_one(
-            {'_id': notification['_id']},
-            {
-                '$set': {
-                    'status': NotificationStatusEnum.sent,
-                    'notifications_sent': len(notifications_sent),
-                    'notifications_error': len(notifications_error),
-                }
-            }
-        )
-        service.User().new_notifications(notifications_sent, notification['_id'], error=False)
-        service.User().new_notifications(notifications_error, notification['_id'], error=True)
-        notifications.append(notification['_id'])
-
-    return list(conn.notifications.find({'_id': {'$in': notifications}}))
-
-
-def update(notification_id: ObjectId, notification: dict) -> Optional[dict]:
-    notification_db = conn.notifications.find_one({'_id': notification_id}, {'status': 1})
+    # Each notification is claimed atomically, so it is sent once even if this runs concurrently
+    while notification := conn.notifications.find_one_and_update(
+            query,
+            {'$set': {'status': NotificationStatusEnum.sent, 'last_modified': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER):
+        _enqueue_send(notification['_id'])
+        notifications.append(notification)
+
+    unsent = {n['_id']: n for n in conn.notifications.find({'status': NotificationStatusEnum.sent, 'sent_at': None,
+                                                            'failed_at': None})}
+    if unsent:
+        enqueued = conn.jobs.distinct('payload.notification_id', {'type': SEND_NOTIFICATION_JOB,
+                                                                  'payload.notification_id': {'$in': list(unsent)}})
+        for notification_id in set(unsent) - set(enqueued):
+            if _enqueue_send(notification_id):
+                logger.warning(f'Notifications: the send of {notification_id} was not enqueued, enqueuing it')
+                notifications.append(unsent[notification_id])
+
+    return notifications
+
+
+class _Scheduler(jobs.Loop):
+    """
+    Enqueues the scheduled notifications when their send_at is reached. It sleeps until the next send_at, or
+    SCHEDULER_MAX_SLEEP for the notifications scheduled by other processes, and is woken up by wake().
+    """
+    name = 'notifications scheduler'
+    max_sleep = SCHEDULER_MAX_SLEEP
+
+    def _tick(self) -> float:
+        send_scheduled()
+        return self._next_timeout()
+
+    @staticmethod
+    def _next_timeout() -> float:
+        notification = conn.notifications.find_one({'status': NotificationStatusEnum.scheduled}, {'send_at': 1},
+                                                   sort=[('send_at', ASCENDING)])
+        if not notification or not notification.get('send_at'):
+            return SCHEDULER_MAX_SLEEP
+        seconds = (notification['send_at'] - datetime.utcnow()).total_seconds()
+        return min(max(seconds, 0), SCHEDULER_MAX_SLEEP)
+
+
+scheduler = _Scheduler()
+
+
+def _device_not_registered(receipt: dict) -> bool:
+    return receipt['status'] == 'error' and (receipt.get('details') or {}).get('error') == 'DeviceNotRegistered'
+
+
+class _Receipts(jobs.Loop):
+    """
+    Fetches the receipts of the push tickets once they are due and removes the expo tokens of the devices that
+    are not registered anymore, so that they are not sent to again. The receipts that are not ready yet are
+    checked again after RECEIPTS_POLL_INTERVAL.
+    Every process polls the tickets, so each batch is claimed for RECEIPTS_LEASE (its check_after is moved) and
+    only the tickets still claimed by the process are counted.
+    """
+    name = 'notifications receipts poller'
+    max_sleep = RECEIPTS_POLL_INTERVAL
+
+    def __init__(self):
+        super().__init__()
+        self.checked = 0
+        self.errors = 0
+        self.pruned = 0
+
+    def _tick(self) -> float:
+        n = self.check()
+        # A full batch means that there may be more tickets due
+        return 0 if n == RECEIPTS_BATCH_SIZE else RECEIPTS_POLL_INTERVAL
+
+    @staticmethod
+    def _claim(now: datetime, batch_size: int) -> tuple:
+        """Claims a batch of the tickets that are due. Returns the id of the claim and its tickets"""
+        ids = [t['_id'] for t in conn.push_tickets.find({'check_after': {'$lte': now}}, {'_id': 1})
+               .sort('check_after', ASCENDING).limit(batch_size)]
+        if not ids:
+            return None, []
+        claim = ObjectId()
+        # The tickets claimed meanwhile by another process are no longer due
+        conn.push_tickets.update_many({'_id': {'$in': ids}, 'check_after': {'$lte': now}},
+                                      {'$set': {'check_after': now + timedelta(seconds=RECEIPTS_LEASE),
+                                                'claim': claim}})
+        return claim, list(conn.push_tickets.find({'_id': {'$in': ids}, 'claim': claim}, {'token': 1}))
+
+    def check(self, batch_size: int = RECEIPTS_BATCH_SIZE) -> int:
+        """Checks the receipts of a batch of the tickets that are due. Returns the number of tickets of the batch"""
+        now = datetime.utcnow()
+        claim, tickets = self._claim(now, batch_size)
+        if not tickets:
+            return 0
+
+        receipts = get_receipts([ticket['_id'] for ticket in tickets])
+        checked, errors, pending, dead_tokens = [], [], [], set()
+        for ticket in tickets:
+            receipt = receipts.get(ticket['_id'])
+            if receipt is None:
+                pending.append(ticket['_id'])
+                continue
+            if receipt['status'] != 'error':
+                checked.append(ticket['_id'])
+            else:
+                errors.append(ticket['_id'])
+                if _device_not_registered(receipt):
+                    dead_tokens.add(ticket['token'])
+                else:
+                    logger.warning(f'Notifications: receipt error for {ticket["token"]}: {receipt.get("message")}')
+
+        if dead_tokens:
+            r = conn.users.update_many({'expo_token': {'$in': list(dead_tokens)}},
+                                       {'$unset': {'expo_token': '', EXPERIENCE_ID_FIELD: ''}})
+            self.pruned += r.modified_count
+            logger.info(f'Notifications: pruned {r.modified_count} expo tokens of devices not registered')
+        # The tickets are only counted by the process that removes them, if it still has them claimed
+        for ids, is_error in [(checked, False), (errors, True)]:
+            if ids:
+                n = conn.push_tickets.delete_many({'_id': {'$in': ids}, 'claim': claim}).deleted_count
+                self.checked += n
+                self.errors += n if is_error else 0
+        if pending:
+            conn.push_tickets.update_many({'_id': {'$in': pending}, 'claim': claim},
+                                          {'$set': {'check_after': now + timedelta(seconds=RECEIPTS_POLL_INTERVAL),
+                                                    'claim': None}})
+        return len(tickets)
+
+    def metrics(self) -> dict:
+        return {
+            'receipts_checked': self.checked,
+            'receipts_error': self.errors,
+            'tokens_pruned': self.pruned
+        }
+
+
+receipts = _Receipts()
+
+
+async def update(notification_id: ObjectId, notification: dict) -> Optional[dict]:
+    notifications = get_async_conn().notifications
+    notification_db = await notifications.find_one({'_id': notification_id}, {'status': 1})
     if not notification_db:
         return
     if notification_db['status'] != NotificationStatusEnum.scheduled:
@@ -116,30 +423,39 @@ def update(notification_id: ObjectId, notification: dict) -> Optional[dict]:
     to_update = notification.copy()
     to_update["last_modified"] = datetime.utcnow()
 
-    updated_notification = conn.notifications.find_one_and_update(
-        {"_id": notification_id},
+    # The status is checked again in case the scheduler claimed the notification in the meantime
+    updated_notification = await notifications.find_one_and_update(
+        {"_id": notification_id, "status": NotificationStatusEnum.scheduled},
         {"$set": to_update},
         return_document=ReturnDocument.AFTER
     )
+    if not updated_notification:
+        raise UpdateNotificationException()
+    if 'send_at' in to_update:
+        scheduler.wake()
     return updated_notification
 
 
-def cancel(notification_id: ObjectId) -> Optional[dict]:
-    notification = conn.notifications.find_one(notification_id)
+async def cancel(notification_id: ObjectId) -> Optional[dict]:
+    notifications = get_async_conn().notifications
+    notification = await notifications.find_one(notification_id)
     if not notification:
         return
 
     if notification['status'] != NotificationStatusEnum.scheduled:
-        raise CancelNotificationException(notification['status'])
+        raise CancelNotificationException(_send_status(notification))
 
     to_update = {
         'status': NotificationStatusEnum.canceled,
         'last_modified': datetime.utcnow()
     }
-    updated_notification = conn.notifications.find_one_and_update(
-        {"_id": notification_id},
+    updated_notification = await notifications.find_one_and_update(
+        {"_id": notification_id, "status": NotificationStatusEnum.scheduled},
         {"$set": to_update},
         return_document=ReturnDocument.AFTER
     )
+    if not updated_notification:
+        # The scheduler claimed it in the meantime
+        raise CancelNotificationException(SENDING)
 
     return updated_notification
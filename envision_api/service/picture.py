@@ -0,0 +1,53 @@
+from datetime import datetime
+from bson import ObjectId
+
+from config.db import conn
+from utils.image import create_image_obj
+from models.picture import PictureStatusEnum
+
+from service import jobs
+
+PROCESS_PICTURE_JOB = 'process_picture'
+
+
+def set_pending(picture: dict) -> bool:
+    """Marks the picture as pending if it has an original to process. Returns whether it has to be processed"""
+    if not picture or not picture.get('original'):
+        return False
+    picture.update({'thumbnail': None, 'renditions': None, 'status': PictureStatusEnum.pending})
+    return True
+
+
+async def enqueue(resource: str, resource_id: ObjectId, picture: dict) -> ObjectId:
+    return await jobs.enqueue_async(PROCESS_PICTURE_JOB, {
+        'resource': resource,
+        'resource_id': resource_id,
+        'original': picture['original']
+    })
+
+
+@jobs.handler(PROCESS_PICTURE_JOB)
+def _process_job(payload: dict) -> None:
+    """
+    Uploads the picture and its renditions, and patches them on the document in a single update.
+    last_modified is bumped so that the clients that sync by last_modified get the processed picture.
+    The document is only patched if its picture was not changed in the meantime.
+    """
+    picture = create_image_obj({'original': payload['original']}, payload['resource'])
+    to_update = {'last_modified': datetime.utcnow()}
+    if picture.get('renditions'):
+        to_update.update({
+            'picture.original': picture['original'],
+            'picture.thumbnail': picture['thumbnail'],
+            'picture.renditions': picture['renditions'],
+            'picture.status': PictureStatusEnum.ready
+        })
+    else:
+        # The picture could not be downloaded or decoded
+        to_update['picture.status'] = PictureStatusEnum.failed
+
+    conn[payload['resource']].update_one(
+        {'_id': payload['resource_id'], 'picture.original': payload['original'],
+         'picture.status': PictureStatusEnum.pending},
+        {'$set': to_update}
+    )
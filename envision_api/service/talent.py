@@ -1,52 +1,49 @@
 from typing import Optional
 from bson import ObjectId
 from datetime import datetime
+from pymongo import IndexModel, ASCENDING
+from fastapi.concurrency import run_in_threadpool
 
-from exceptions.resource_exceptions import DuplicatedKey
-from exceptions.thinkific_exceptions import ThinkificCreateError, ThinkificUpdateError, ThinkificDeleteError
+from exceptions.resource_exceptions import InvalidCursor
 
-from utils import thinkific
-from utils.logger import logger
-from utils.image import create_image_obj
-from utils.format import format_dict, create_response_paginated, paginate_list, regex_query
+from utils.format import (format_dict, create_response_paginated_async, paginate_list, set_null_last_keys,
+                          null_last_indexes)
+from utils.search import search_keywords, search_query, relevance_stages, SEARCH_KEYWORDS_FIELD, RELEVANCE_SORT
 from utils.ai import generate_talent_bio
 
-from models.talent import TalentModel
+from models.talent import TalentModel, EthosSyncStatusEnum
 from models.response import ListModel
 from models.filters import TalentFilters
-from service.base import Base
+from service.async_base import AsyncBase
+from service import picture, ethos
 
 # CMS_TALENTS_COLLECTION_ID = '637e2f87ca19c0a56162d15f'
-THINKIFIC_COLLECTION = 'instructors'
 
 
-def _format_thinkific_dict(talent_dict: dict) -> dict:
-    to_keep = {'name', 'short_bio', 'email', 'slug', 'title'}
-    to_delete = list(set(talent_dict.keys()) - to_keep)
-    to_rename = {'name': 'first_name', 'short_bio': 'bio'}
-    to_extend = {'user_id': None}
+class Talent(AsyncBase):
+    sort_fields = ['name']
+    search_fields = ['name', 'description']
+    indexes = [
+        IndexModel([('slug', ASCENDING)]),
+        IndexModel([('email', ASCENDING)]),
+        IndexModel([('last_modified', ASCENDING)]),
+        IndexModel([('envision_festival', ASCENDING), ('deleted', ASCENDING)]),
+        IndexModel([(SEARCH_KEYWORDS_FIELD, ASCENDING)]),
+        IndexModel([(f'{ethos.SYNC_FIELD}.status', ASCENDING), (f'{ethos.SYNC_FIELD}.run_at', ASCENDING)]),
+        *null_last_indexes('name', prefix=[('deleted', ASCENDING)])
+    ]
 
-    if talent_dict.get('picture.original'):
-        to_extend['avatar_url'] = talent_dict.get('picture.original')
-
-    if 'slug' in talent_dict:
-        to_extend['last_name'] = talent_dict['slug']
-
-    return format_dict(talent_dict, to_delete=to_delete, to_rename=to_rename, to_extend=to_extend)
-
-
-class Talent(Base):
     def __init__(self):
         super().__init__(resource='talents', q_fields=['title', 'subtitle', 'body', 'author'])
 
-    def find(self, filters: TalentFilters, last_modified: datetime = None, sort_by: str = None,
-             ascending: bool = True, limit: int = None, offset: int = None) -> ListModel[TalentModel]:
+    async def find(self, *, filters: TalentFilters, last_modified: datetime = None, sort_by: str = None,
+                   ascending: bool = True, limit: int = None, offset: int = None,
+                   cursor: str = None) -> ListModel[TalentModel]:
         mongo_query = {}
         if filters.ids:
             mongo_query['_id'] = {'$in': filters.ids}
         if filters.q:
-            fields = ['name', 'description']
-            mongo_query['$or'] = [regex_query(field, filters.q) for field in fields]
+            mongo_query['$and'] = [search_query(filters.q, self.search_fields)]
         if filters.slug:
             mongo_query['slug'] = filters.slug
         if filters.email:
@@ -58,26 +55,46 @@ class Talent(Base):
         else:
             mongo_query['deleted'] = False
 
-        return create_response_paginated(self.collection, query=mongo_query, limit=limit, offset=offset,
-                                         sort_by=sort_by, ascending=ascending)
-
-    def generate_bio(self, talent_id: ObjectId) -> Optional[dict]:
-        talent = self.get(talent_id)
+        pipeline = [{'$match': mongo_query}]
+        if sort_by == RELEVANCE_SORT:
+            if cursor:
+                raise InvalidCursor()
+            if filters.q:
+                pipeline.extend(relevance_stages(filters.q, 'name'))
+            sort_by = None
+
+        return await create_response_paginated_async(self.collection, pipeline=pipeline, limit=limit,
+                                                     offset=offset, cursor=cursor, sort_by=sort_by,
+                                                     ascending=ascending, null_last_fields=self.sort_fields)
+
+    async def find_missing(self, talents_ids: list) -> list:
+        """Returns the ids that are not of an existing talent, with a single query"""
+        ids = [ObjectId(t) for t in talents_ids if ObjectId.is_valid(t)]
+        found = {t['_id'] async for t in self.collection.find({'_id': {'$in': ids}, 'deleted': False}, {'_id': 1})}
+        return [t for t in dict.fromkeys(talents_ids) if not ObjectId.is_valid(t) or ObjectId(t) not in found]
+
+    async def generate_bio(self, talent_id: ObjectId) -> Optional[dict]:
+        talent = await self.get(talent_id)
         if not talent:
             return
-        return generate_talent_bio(talent)
+        # The completion is a blocking request to OpenAI
+        return await run_in_threadpool(generate_talent_bio, talent)
 
-    def get_categories(self, limit: int = None, offset: int = None) -> ListModel:
-        categories = [c for c in self.collection.distinct('main_category', filter={'deleted': False}) if c]
+    async def get_categories(self, limit: int = None, offset: int = None) -> ListModel:
+        categories = [c for c in await self.collection.distinct('main_category', filter={'deleted': False}) if c]
         return paginate_list(categories, limit=limit, offset=offset)
 
-    def get_pillars(self, limit: int = None, offset: int = None) -> ListModel:
-        pillars = [c for c in self.collection.distinct('pillars', filter={'deleted': False}) if c]
+    async def get_pillars(self, limit: int = None, offset: int = None) -> ListModel:
+        pillars = [c for c in await self.collection.distinct('pillars', filter={'deleted': False}) if c]
         return paginate_list(pillars, limit=limit, offset=offset)
 
-    def create(self, talent: dict) -> dict:
-        super()._format_slug(talent)
-        talent['picture'] = create_image_obj(talent['picture'], self.resource)
+    async def create(self, talent: dict) -> dict:
+        self._format_slug(talent)
+        # The picture is processed in the background, after the talent is created
+        picture_pending = picture.set_pending(talent['picture'])
+        # The instructor is created in Thinkific by the dispatcher, after the talent is created
+        if talent['ethos_instructor']:
+            talent[ethos.SYNC_FIELD] = ethos.new_sync()
 
         # create_cms_item = talent['envision_festival']
         # if create_cms_item:
@@ -87,71 +104,62 @@ class Talent(Base):
         #         raise CMSError(cms_response['error'])
         #     talent['cms_id'] = cms_response['response']['_id']
 
-        ethos_id = None
-        if talent['ethos_instructor']:
-            thinkific_response = thinkific.create_item(THINKIFIC_COLLECTION, _format_thinkific_dict(talent))
-            if thinkific_response['status'] >= 400:
-                # if create_cms_item:
-                #     cms.delete_item(CMS_TALENTS_COLLECTION_ID, talent['cms_id'])
-                raise ThinkificCreateError(THINKIFIC_COLLECTION, thinkific_response['error'])
-            ethos_id = thinkific_response['response']['id']
-            talent['ethos_id'] = ethos_id
-
         del talent['ethos_instructor']
-
-        try:
-            return super().create(talent)
-        except DuplicatedKey as e:
-            # cms.delete_item(CMS_TALENTS_COLLECTION_ID, talent['cms_id'])
-            if ethos_id:
-                thinkific.delete_item(THINKIFIC_COLLECTION, ethos_id)
-            raise e
-
-    def update(self, talent_id: ObjectId, talent: dict) -> Optional[dict]:
-        talent_db = self.collection.find_one({'_id': talent_id, 'deleted': False})
+        set_null_last_keys(talent, self.sort_fields)
+        talent[SEARCH_KEYWORDS_FIELD] = search_keywords([talent.get(f) for f in self.search_fields])
+
+        talent = await super().create(talent)
+        if picture_pending:
+            await picture.enqueue(self.resource, talent['_id'], talent['picture'])
+        if ethos.SYNC_FIELD in talent:
+            ethos.dispatcher.wake()
+        return talent
+
+    async def update(self, talent_id: ObjectId, talent: dict) -> Optional[dict]:
+        talent_db = await self.collection.find_one({'_id': talent_id, 'deleted': False})
         to_update = talent.copy()
         if not talent_db or not to_update:
             return talent_db
 
-        if talent_db.get('ethos_id'):
-            thinkific_item = _format_thinkific_dict(to_update)
-            logger.info(f'Thinkific: Update item {thinkific_item}')
-            r = thinkific.update_item(THINKIFIC_COLLECTION, talent_db['ethos_id'], thinkific_item)
-            if r['status'] >= 400:
-                logger.error('ERROR when updating thinkific talent')
-                raise ThinkificUpdateError(THINKIFIC_COLLECTION, r['error'])
-
-        self._update_mongo(talent_id, to_update)
-    
-
-    def create_ethos_instructor(self, talent_id: ObjectId) -> Optional[dict]:
-        talent_db: dict = self.collection.find_one(talent_id)
+        set_null_last_keys(to_update, self.sort_fields)
+        if any(f in to_update for f in self.search_fields):
+            to_update[SEARCH_KEYWORDS_FIELD] = search_keywords([to_update.get(f, talent_db.get(f))
+                                                                for f in self.search_fields])
+        # The talents in Thinkific (or to be created there) are synced in the same write
+        sync_ethos = bool(talent_db.get('ethos_id') or talent_db.get(ethos.SYNC_FIELD))
+        if sync_ethos:
+            to_update.update(ethos.pending_sync())
+        updated_talent = await super().update(talent_id, to_update)
+        if sync_ethos:
+            ethos.dispatcher.wake()
+        return updated_talent
+
+    async def create_ethos_instructor(self, talent_id: ObjectId) -> Optional[dict]:
+        talent_db: dict = await self.get(talent_id)
         if not talent_db:
             return
-        if talent_db.get('ethos_id'):
+        sync_status = talent_db.get(ethos.SYNC_FIELD, {}).get('status')
+        if talent_db.get('ethos_id') or sync_status == EthosSyncStatusEnum.pending:
             return talent_db
 
-        thinkific_response = thinkific.create_item(THINKIFIC_COLLECTION, _format_thinkific_dict(talent_db))
-        if thinkific_response['status'] >= 400:
-            raise ThinkificCreateError(THINKIFIC_COLLECTION, thinkific_response['error'])
-        ethos_id = thinkific_response['response']['id']
-        to_update = {'ethos_id': ethos_id}
-        return self._update_mongo(talent_id, to_update)
+        talent = await super().update(talent_id, ethos.pending_sync())
+        ethos.dispatcher.wake()
+        return talent
 
-    def delete(self, talent_id: ObjectId) -> bool:
-        talent = self.collection.find_one({'_id': talent_id, 'deleted': False}, {'ethos_id': 1})
+    async def delete(self, talent_id: ObjectId) -> bool:
+        talent = await self.collection.find_one({'_id': talent_id, 'deleted': False},
+                                                {'ethos_id': 1, ethos.SYNC_FIELD: 1})
         if not talent:
             return False
 
-        if talent.get('ethos_id'):
-            ethos_id = talent['ethos_id']
-            r = thinkific.delete_item(THINKIFIC_COLLECTION, ethos_id)
-            if r['status'] >= 400:
-                raise ThinkificDeleteError(THINKIFIC_COLLECTION, r['error'])
-        r = self.collection.update_one(
-            {'_id': talent_id, 'deleted': False},
-            {'$set': {'deleted': True, 'slug': str(talent_id), 'last_modified': datetime.utcnow()}}
-        )
+        to_update = {'deleted': True, 'slug': str(talent_id), 'last_modified': datetime.utcnow()}
+        # The instructor is deleted from Thinkific by the dispatcher (also if its creation is in progress)
+        sync_ethos = bool(talent.get('ethos_id') or talent.get(ethos.SYNC_FIELD))
+        if sync_ethos:
+            to_update.update(ethos.pending_sync())
+        r = await self.collection.update_one({'_id': talent_id, 'deleted': False}, {'$set': to_update})
+        if sync_ethos:
+            ethos.dispatcher.wake()
         return r.modified_count > 0
 
     # def _format_cms_dict(talent_dict: dict) -> dict:
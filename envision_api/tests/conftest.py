@@ -8,6 +8,9 @@ from config.constants import CURRENT_ENVIRONMENT, EnvironmentEnum
 from utils.security import encode
 from utils.format import paginate_list
 from models.admin import RoleEnum
+from utils.notifications import ExperienceIds
+from .fake_expo import FakeExpo
+from .fake_thinkific import FakeThinkific
 
 
 def verify_environment(func):
@@ -20,6 +23,30 @@ def verify_environment(func):
     return wrapper
 
 
+def winning_plan_stages(collection_name: str, pipeline: list) -> list:
+    """Returns the stages of the winning plans of the explain of an aggregation"""
+    return plan_stages(conn.command('aggregate', collection_name, pipeline=pipeline, explain=True))
+
+
+def plan_stages(explain: dict) -> list:
+    """Returns the stages of the winning plans of an explain"""
+    stages = []
+
+    def collect(node, in_winning_plan=False):
+        if isinstance(node, dict):
+            if in_winning_plan and 'stage' in node:
+                stages.append(node['stage'])
+            for k, v in node.items():
+                if k != 'rejectedPlans':
+                    collect(v, in_winning_plan or k == 'winningPlan')
+        elif isinstance(node, list):
+            for v in node:
+                collect(v, in_winning_plan)
+
+    collect(explain)
+    return stages
+
+
 @pytest.fixture()
 @verify_environment
 def mongo_empty():
@@ -32,6 +59,9 @@ def mongo_empty():
     conn.talents.delete_many({})
     conn.users.delete_many({})
     conn.venues.delete_many({})
+    conn.notifications.delete_many({})
+    conn.jobs.delete_many({})
+    conn.push_tickets.delete_many({})
 
 
 class DummyAdmins:
@@ -500,3 +530,24 @@ def mock_thinkific(mocker):
 @verify_environment
 def mock_send_mail(mocker):
     mocker.patch('utils.mail.send_mail', return_value=None)
+
+
+@pytest.fixture()
+def fake_expo(mocker):
+    expo = FakeExpo().start()
+    mocker.patch('utils.notifications.EXPO_PUSH_URL', expo.url)
+    mocker.patch('utils.notifications.EXPO_RECEIPTS_URL', expo.receipts_url)
+    mocker.patch('utils.notifications.RETRY_BACKOFF', 0)
+    mocker.patch('utils.notifications.rate_limiter.rate', None)
+    mocker.patch('utils.notifications.experience_ids', ExperienceIds())
+    yield expo
+    expo.stop()
+
+
+@pytest.fixture()
+def fake_thinkific(mocker):
+    thinkific = FakeThinkific().start()
+    mocker.patch('utils.thinkific.client.base_url', thinkific.url)
+    mocker.patch('utils.thinkific.client.rate_limiter.rate', None)
+    yield thinkific
+    thinkific.stop()
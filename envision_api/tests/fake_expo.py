@@ -0,0 +1,115 @@
+import json
+import time
+import uuid
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+
+class FakeExpo:
+    """
+    Local Expo push server. Responds ok for every token, except for the `rejected_tokens`.
+    A request with any of the `invalid_tokens` is rejected as a whole (without data nor errors), and a request
+    with tokens of several `experience_ids` (token -> project) with PUSH_TOO_MANY_EXPERIENCE_IDS.
+    `responses` are (status, body, headers) returned, in order, before the default response.
+    `delay` (in seconds) simulates the latency of Expo, and `max_in_flight` is the most requests handled at once.
+    Every ticket gets a receipt, which is a DeviceNotRegistered error for the `unregistered_tokens`.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+        self.rejected_tokens = set()
+        self.invalid_tokens = set()
+        self.experience_ids = {}
+        self.unregistered_tokens = set()
+        self.tickets = {}  # ticket id -> token
+        self.receipts_requests = []
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/--/api/v2/push/send'
+        self.receipts_url = f'http://127.0.0.1:{self.server.server_port}/--/api/v2/push/getReceipts'
+
+    def _handler(self):
+        expo = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                content = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                if self.path.endswith('/getReceipts'):
+                    status, body, headers = expo.respond_receipts(json.loads(content)['ids'])
+                else:
+                    with expo.lock:
+                        expo.in_flight += 1
+                        expo.max_in_flight = max(expo.max_in_flight, expo.in_flight)
+                    try:
+                        status, body, headers = expo.respond(parse_qs(content).get('to', []))
+                    finally:
+                        with expo.lock:
+                            expo.in_flight -= 1
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, tokens: list) -> tuple:
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.requests.append(tokens)
+            if self.responses:
+                return self.responses.pop(0)
+        if self.invalid_tokens.intersection(tokens):
+            return 400, {'message': 'Invalid push tokens'}, {}
+        projects = {}
+        for t in tokens:
+            projects.setdefault(self.experience_ids.get(t), []).append(t)
+        if len(projects) > 1:
+            return 400, {'errors': [{'code': 'PUSH_TOO_MANY_EXPERIENCE_IDS', 'details': projects}]}, {}
+        data = []
+        with self.lock:
+            for t in tokens:
+                if t in self.rejected_tokens:
+                    data.append({'status': 'error'})
+                else:
+                    ticket_id = str(uuid.uuid4())
+                    self.tickets[ticket_id] = t
+                    data.append({'status': 'ok', 'id': ticket_id})
+        return 200, {'data': data[0] if len(data) == 1 else data}, {}
+
+    def respond_receipts(self, ticket_ids: list) -> tuple:
+        with self.lock:
+            self.receipts_requests.append(ticket_ids)
+            receipts = {}
+            for ticket_id in ticket_ids:
+                if ticket_id not in self.tickets:
+                    continue
+                if self.tickets[ticket_id] in self.unregistered_tokens:
+                    receipts[ticket_id] = {'status': 'error', 'message': 'The device is not registered',
+                                           'details': {'error': 'DeviceNotRegistered'}}
+                else:
+                    receipts[ticket_id] = {'status': 'ok'}
+        return 200, {'data': receipts}, {}
+
+    def start(self) -> 'FakeExpo':
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,89 @@
+import json
+import math
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeThinkific:
+    """
+    Local Thinkific API with a single collection of `instructors` (id -> instructor), which are listed by pages
+    and created, updated and deleted like in Thinkific. Every request is recorded in `requests` as (method, path).
+    """
+
+    def __init__(self):
+        self.instructors = {}
+        self.requests = []
+        self.next_id = 1000
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/public/v1'
+
+    def add(self, **instructor) -> dict:
+        with self.lock:
+            instructor.setdefault('id', self.next_id)
+            self.next_id = max(self.next_id, instructor['id']) + 1
+            self.instructors[instructor['id']] = instructor
+        return instructor
+
+    def _handler(self):
+        thinkific = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                url = urlparse(self.path)
+                status, response = thinkific.respond(self.command, url.path.split('/')[4:], parse_qs(url.query), body)
+                content = json.dumps(response).encode() if response is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, method: str, path: list, query: dict, body: dict) -> tuple:
+        with self.lock:
+            self.requests.append((method, '/'.join(path)))
+            if path[0] != 'instructors':
+                return 404, {'error': 'Not found'}
+            if len(path) == 1 and method == 'GET':
+                limit, page = int(query['limit'][0]), int(query['page'][0])
+                items = sorted(self.instructors.values(), key=lambda i: i['id'])
+                return 200, {'items': items[(page - 1) * limit:page * limit],
+                             'meta': {'pagination': {'current_page': page,
+                                                     'total_pages': max(math.ceil(len(items) / limit), 1),
+                                                     'total_items': len(items)}}}
+            if len(path) == 1 and method == 'POST':
+                instructor = {**body, 'id': self.next_id}
+                self.next_id += 1
+                self.instructors[instructor['id']] = instructor
+                return 201, instructor
+            instructor_id = int(path[1])
+            if instructor_id not in self.instructors:
+                return 404, {'error': 'Instructor not found'}
+            if method == 'PUT':
+                self.instructors[instructor_id].update(body)
+                return 204, None
+            if method == 'DELETE':
+                del self.instructors[instructor_id]
+                return 204, None
+            return 200, self.instructors[instructor_id]
+
+    def start(self) -> 'FakeThinkific':
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
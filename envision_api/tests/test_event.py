@@ -0,0 +1,36 @@
+import asyncio
+
+from .conftest import verify_environment, winning_plan_stages
+from config.db import conn, connect_async, close_async
+from utils.format import add_sort_stages_to_pipeline, ensure_null_last_sort
+import service
+
+
+@verify_environment
+def test_find_events_sort_uses_index(mongo_empty, mongo_insert_dummy_events):
+    ensure_null_last_sort(conn.events, service.Event.sort_fields, prefix=[('deleted', 1)])
+    for ascending in [True, False]:
+        pipeline = add_sort_stages_to_pipeline([{'$match': {'deleted': False}}], sort_by='start_date',
+                                               ascending=ascending, null_last_fields=service.Event.sort_fields)
+        stages = winning_plan_stages('events', pipeline + [{'$limit': 10}])
+        assert 'IXSCAN' in stages
+        assert 'SORT' not in stages
+
+
+@verify_environment
+def test_refresh_search_fields(mongo_empty, mongo_insert_dummy_talents, mongo_insert_dummy_events):
+    talent = conn.talents.find_one({'deleted': False})
+    event_id = conn.events.find_one({'deleted': False}, {'_id': 1})['_id']
+    conn.events.update_one({'_id': event_id}, {'$set': {'talents_ids': [talent['_id']]}})
+
+    async def refresh_search_fields():
+        connect_async()
+        try:
+            return await service.Event().refresh_search_fields({'_id': event_id})
+        finally:
+            close_async()
+
+    assert asyncio.run(refresh_search_fields()) == 1
+    event = conn.events.find_one({'_id': event_id})
+    assert event['talent_name'] == [talent['name']]
+    assert event['stage_name'] is None
@@ -0,0 +1,112 @@
+import time
+import pytest
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils.http import IntegrationClient, CircuitBreaker, iter_pages
+from exceptions.integration_exceptions import IntegrationUnavailable
+
+
+@pytest.fixture()
+def server():
+    """Local API that returns the `statuses` in order, then 200. `delay` (in seconds) is applied to every request"""
+    class Server(ThreadingHTTPServer):
+        statuses = []
+        requests = []
+        delay = 0
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self.server.requests.append((self.command, self.path))
+            time.sleep(self.server.delay)
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        do_GET = do_POST = do_PUT = do_DELETE = respond
+
+        def log_message(self, *args):
+            pass
+
+    s = Server(('127.0.0.1', 0), Handler)
+    s.daemon_threads = True
+    s.url = f'http://127.0.0.1:{s.server_port}/api'
+    Thread(target=s.serve_forever, daemon=True).start()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+def test_retries(server):
+    client = IntegrationClient('Test', server.url, retry_backoff=0)
+    server.statuses = [503, 429]
+    assert client.get('/items').status_code == 200
+    assert server.requests == [('GET', '/api/items')] * 3
+
+    # A POST is retried when it is rate limited, but not after a server error
+    server.requests = []
+    server.statuses = [429, 500]
+    with pytest.raises(IntegrationUnavailable):
+        client.post('/items', json={})
+    assert len(server.requests) == 2
+
+    # Client errors are returned to the caller
+    server.statuses = [404]
+    assert client.get('/items/1').status_code == 404
+
+
+def test_timeout(server):
+    client = IntegrationClient('Test', server.url, timeout=0.1, max_retries=1, retry_backoff=0)
+    server.delay = 0.5
+    start = time.monotonic()
+    with pytest.raises(IntegrationUnavailable):
+        client.get('/items')
+    assert time.monotonic() - start < 0.5
+
+
+def test_circuit_breaker(server):
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    client = IntegrationClient('Test', server.url, max_retries=0, circuit_breaker=circuit_breaker)
+    server.statuses = [500, 500]
+    for _ in range(2):
+        with pytest.raises(IntegrationUnavailable):
+            client.get('/items')
+    assert circuit_breaker.open
+
+    # The requests fail without reaching the API until the reset timeout
+    with pytest.raises(IntegrationUnavailable):
+        client.get('/items')
+    assert len(server.requests) == 2
+
+    time.sleep(0.2)
+    assert client.get('/items').status_code == 200
+    assert not circuit_breaker.open
+
+
+def test_iter_pages():
+    fetched = []
+
+    def fetch_page(page):
+        time.sleep(0.05)
+        fetched.append(page)
+        return {'page': page, 'total_pages': 20}
+
+    start = time.monotonic()
+    pages = iter_pages(fetch_page, lambda r: r['total_pages'], max_workers=4)
+    assert next(pages)['page'] == 0
+    assert fetched == [0]
+    assert [r['page'] for r in pages] == list(range(1, 20))
+    # The 19 pages after the first are fetched 4 at a time
+    assert time.monotonic() - start < 0.05 * 10
+
+
+def test_iter_pages_stops_at_failed_page():
+    pages = iter_pages(lambda page: None if page == 3 else {'page': page}, lambda r: 10, max_workers=2)
+    assert [r['page'] for r in pages] == [0, 1, 2]
+    assert list(iter_pages(lambda page: None, lambda r: 10)) == []
@@ -0,0 +1,113 @@
+import io
+import pytest
+import boto3
+from threading import Thread, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from moto import mock_s3
+from PIL import Image
+
+import utils.image
+from utils.image import create_image_obj, exists_in_s3, S3_REGION, RENDITION_FORMATS
+
+TEST_BUCKET = 'test-bucket'
+
+
+@pytest.fixture()
+def s3(mocker):
+    with mock_s3():
+        mocker.patch('utils.image.AWS_S3_BUCKET', TEST_BUCKET)
+        mocker.patch('utils.image._s3', None)
+        client = boto3.client('s3', region_name=S3_REGION)
+        client.create_bucket(Bucket=TEST_BUCKET, CreateBucketConfiguration={'LocationConstraint': S3_REGION})
+        yield client
+
+
+@pytest.fixture()
+def image_url():
+    buffer = io.BytesIO()
+    Image.new('RGB', (1200, 800), 'purple').save(buffer, format='JPEG')
+    content = buffer.getvalue()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/picture.jpg'
+    server.shutdown()
+    server.server_close()
+
+
+def test_create_image_obj(s3, image_url):
+    picture = create_image_obj({'original': image_url, 'alt': 'alt'}, 'talents')
+    original_key = picture['original'].split('.amazonaws.com/')[1]
+    assert original_key.startswith('originals/talents/')
+    assert exists_in_s3(original_key)
+
+    renditions = picture['renditions']
+    assert {(r['width'], r['format']) for r in renditions} == {(w, f.lower()) for w in [320, 480, 960, 1200]
+                                                              for f in RENDITION_FORMATS}
+    for r in renditions:
+        key = r['url'].split('.amazonaws.com/')[1]
+        img = Image.open(io.BytesIO(s3.get_object(Bucket=TEST_BUCKET, Key=key)['Body'].read()))
+        assert img.size == (r['width'], r['height'])
+        assert img.format.lower() == r['format']
+    assert picture['thumbnail'] == next(r['url'] for r in renditions if r['width'] == 480 and r['format'] == 'jpeg')
+
+
+def test_create_image_obj_same_content(s3, image_url, mocker):
+    picture = create_image_obj({'original': image_url}, 'talents')
+
+    # The objects are named by content, so the same picture is found in S3 and nothing is processed again
+    upload = mocker.spy(utils.image, 'upload_to_s3')
+    processes = mocker.spy(utils.image, '_get_processes')
+    assert create_image_obj({'original': image_url}, 'talents') == picture
+    assert upload.call_count == 0
+    assert processes.call_count == 0
+
+
+def test_download_image_too_large(image_url):
+    assert utils.image.download_image(image_url, max_size=1024) is None
+    assert utils.image.download_image(image_url) is not None
+
+
+def test_renditions_large_jpeg():
+    buffer = io.BytesIO()
+    Image.new('RGB', (6000, 4000), 'purple').save(buffer, format='JPEG')
+    [rendition] = utils.image.create_renditions(buffer.getvalue(), widths=[480], formats=['JPEG'])
+    thumbnail = Image.open(io.BytesIO(rendition['content']))
+    assert thumbnail.format == 'JPEG'
+    assert thumbnail.size == (480, 320)
+
+
+def test_s3_client_is_shared(s3):
+    assert utils.image._get_s3() is utils.image._get_s3()
+    assert not exists_in_s3('originals/talents/missing.jpg')
+
+
+def test_shutdown_cancels_pending_work(mocker):
+    mocker.patch('utils.image.IMAGE_THREADS', 1)
+    mocker.patch('utils.image._threads', None)
+    started, release = Event(), Event()
+
+    def work():
+        started.set()
+        return release.wait()
+
+    running = utils.image._submit(utils.image._get_threads(), work)
+    started.wait()
+    pending = utils.image._submit(utils.image._get_threads(), release.wait)
+
+    utils.image.shutdown()
+    release.set()
+    assert pending.cancelled()
+    assert running.result()
+    assert not utils.image._futures
@@ -0,0 +1,65 @@
+import pytest
+from datetime import datetime
+from bson import ObjectId
+
+from .conftest import verify_environment, plan_stages
+from config.db import conn
+from utils.indexes import reconcile_indexes
+import service
+import service.notification
+import service.jobs
+
+declared_indexes = [
+    (conn.talents, service.Talent.indexes),
+    (conn.events, service.Event.indexes),
+    (conn.notifications, service.notification.indexes),
+    (conn.users, service.notification.users_indexes),
+    (conn.push_tickets, service.notification.push_tickets_indexes),
+    (conn.jobs, service.jobs.indexes + service.notification.jobs_indexes)
+]
+
+service_queries = [
+    (conn.talents, {'deleted': False}, [('_has_name', -1), ('name', 1), ('_id', 1)]),
+    (conn.talents, {'deleted': False, 'slug': 'talent-1'}, None),
+    (conn.talents, {'deleted': False, 'email': 'asd@asd.com'}, None),
+    (conn.talents, {'deleted': False, 'envision_festival': True}, None),
+    (conn.talents, {'last_modified': {'$gte': datetime(2023, 1, 1)}}, None),
+    (conn.talents, {'ethos_sync.status': 'pending', 'ethos_sync.run_at': {'$lte': datetime.utcnow()}},
+     [('ethos_sync.run_at', 1)]),
+    (conn.talents, {'deleted': False, 'search_keywords': {'$all': ['tal']}}, None),
+    (conn.events, {'deleted': False}, [('_has_start_date', -1), ('start_date', -1), ('_id', -1)]),
+    (conn.events, {'stage_id': ObjectId(), 'start_date': {'$lt': datetime(2023, 3, 7)},
+                   'end_date': {'$gt': datetime(2023, 3, 6)}, 'deleted': False}, None),
+    (conn.events, {'deleted': False, '$or': [{'talents_ids': {'$in': [ObjectId()]}},
+                                             {'collaborators_ids': {'$in': [ObjectId()]}}]}, None),
+    (conn.events, {'deleted': False, 'tags': {'$in': ['Music']}}, None),
+    (conn.notifications, {'status': 'scheduled', 'send_at': {'$lte': datetime.utcnow()}}, None),
+    (conn.notifications, {'status': 'sent', 'sent_at': None, 'failed_at': None}, None),
+    (conn.users, {'expo_token': {'$in': ['test expo token']}}, None),
+    (conn.push_tickets, {'check_after': {'$lte': datetime.utcnow()}}, [('check_after', 1)]),
+    (conn.jobs, {'status': 'pending', 'run_at': {'$lte': datetime.utcnow()}}, [('run_at', 1)]),
+]
+
+
+@verify_environment
+def test_reconcile_indexes(mongo_empty):
+    for collection, indexes in declared_indexes:
+        reconcile_indexes(collection, indexes)
+        report = reconcile_indexes(collection, indexes)
+        assert report['missing'] == []
+        assert report['conflicts'] == []
+
+
+@verify_environment
+@pytest.mark.parametrize('collection,query,sort', service_queries)
+def test_service_queries_use_index(mongo_empty, mongo_insert_dummy_talents, mongo_insert_dummy_events,
+                                   collection, query, sort):
+    for c, indexes in declared_indexes:
+        reconcile_indexes(c, indexes)
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    stages = plan_stages(cursor.explain())
+    assert 'IXSCAN' in stages
+    assert 'COLLSCAN' not in stages
+    assert 'SORT' not in stages
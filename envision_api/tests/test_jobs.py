@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from .conftest import verify_environment
+from config.db import conn
+from service import jobs
+
+
+@verify_environment
+def test_job_retries(mongo_empty, mocker):
+    calls = []
+
+    def failing_job(payload):
+        calls.append(payload)
+        raise Exception('failed')
+
+    failed = []
+    mocker.patch.dict('service.jobs._handlers', {'test': failing_job})
+    mocker.patch.dict('service.jobs._failed_handlers', {'test': lambda payload, error: failed.append(error)})
+    job_id = jobs.enqueue('test', {'n': 1})
+    for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+        job = jobs.claim('test worker')
+        assert job['_id'] == job_id
+        assert job['attempts'] == attempt
+        jobs.run(job, 'test worker')
+        conn.jobs.update_one({'_id': job_id}, {'$set': {'run_at': datetime.utcnow()}})
+
+    job = conn.jobs.find_one({'_id': job_id})
+    assert job['status'] == 'failed'
+    assert job['error'] == 'failed'
+    assert calls == [{'n': 1}] * jobs.MAX_ATTEMPTS
+    assert failed == ['failed']
+    assert jobs.claim('test worker') is None
+
+
+@verify_environment
+def test_job_lease_expired(mongo_empty, mocker):
+    mocker.patch.dict('service.jobs._handlers', {'test': lambda payload: {'done_by': 'worker 2'}})
+    job_id = jobs.enqueue('test', {})
+    assert jobs.claim('worker 1')['_id'] == job_id
+    assert jobs.claim('worker 2') is None
+
+    # The lease of the first worker expires (it died), so the job is claimed again
+    conn.jobs.update_one({'_id': job_id}, {'$set': {'lease_until': datetime.utcnow() - timedelta(seconds=1)}})
+    job = jobs.claim('worker 2')
+    assert job['worker'] == 'worker 2'
+
+    # The first worker can no longer complete it
+    jobs.run({**job, 'worker': 'worker 1'}, 'worker 1')
+    assert conn.jobs.find_one({'_id': job_id})['status'] == 'running'
+    jobs.run(job, 'worker 2')
+    job = conn.jobs.find_one({'_id': job_id})
+    assert job['status'] == 'done'
+    assert job['result'] == {'done_by': 'worker 2'}
@@ -0,0 +1,337 @@
+import time
+import pytest
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+from .conftest import verify_environment
+from config.db import conn
+from service import jobs
+from service.notification import _Bookkeeping
+import utils.notifications
+import service.notification
+from utils.notifications import (send_notification, stream_notification, push_metrics, get_receipts,
+                                 ExpoUnavailable, MAX_CONCURRENT_REQUESTS, EXPO_CHUNK_SIZE)
+
+
+def test_send_notification(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(250)]
+    fake_expo.rejected_tokens = {tokens[10], tokens[200]}
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert [r['token'] for r in results] == tokens
+    assert [r['token'] for r in results if r['status'] == 'error'] == [tokens[10], tokens[200]]
+    assert sorted(len(r) for r in fake_expo.requests) == [50, 100, 100]
+
+
+def test_send_notification_retries(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(10)]
+    fake_expo.responses = [(429, {'errors': [{'code': 'TOO_MANY_REQUESTS'}]}, {'Retry-After': '0'}),
+                           (503, {}, {})]
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert [r['status'] for r in results] == ['ok'] * 10
+    assert len(fake_expo.requests) == 3
+
+
+def test_send_notification_retry_after_too_long(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(10)]
+    fake_expo.responses = [(429, {'errors': [{'code': 'TOO_MANY_REQUESTS'}]}, {'Retry-After': '3600'})]
+
+    with pytest.raises(ExpoUnavailable, match='retry after 3600 seconds'):
+        send_notification('title', 'body', 'url', tokens)
+    assert len(fake_expo.requests) == 1
+
+
+def test_stream_notification(fake_expo):
+    read = []
+
+    def tokens():
+        for i in range(5000):
+            read.append(i)
+            yield f'ExponentPushToken[{i}]'
+
+    sent, read_ahead = 0, 0
+    for results in stream_notification('title', 'body', 'url', tokens()):
+        sent += len(results)
+        read_ahead = max(read_ahead, len(read) - sent)
+    assert sent == 5000
+    assert read_ahead <= (MAX_CONCURRENT_REQUESTS + 1) * EXPO_CHUNK_SIZE
+
+
+def test_send_notification_invalid_tokens(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(250)]
+    fake_expo.invalid_tokens = {tokens[17], tokens[203]}
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert [r['token'] for r in results] == tokens
+    assert [r['token'] for r in results if r['status'] == 'error'] == [tokens[17], tokens[203]]
+    # The chunks with an invalid token are bisected instead of sent token by token
+    assert len(fake_expo.requests) < 3 + 2 * 2 * 7
+
+
+def test_send_notification_invalid_tokens_concurrency(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(800)]
+    fake_expo.invalid_tokens = set(tokens[::25])
+    fake_expo.delay = 0.02
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert [r['token'] for r in results if r['status'] == 'error'] == tokens[::25]
+    # The bisections are sent by the worker of the chunk
+    assert fake_expo.max_in_flight <= MAX_CONCURRENT_REQUESTS
+
+
+def test_send_notification_groups_experience_ids(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(200)]
+    fake_expo.experience_ids = {t: '@envision/app' if i % 2 else '@envision/ethos' for i, t in enumerate(tokens)}
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert sorted(r['token'] for r in results if r['status'] == 'ok') == sorted(tokens)
+    assert len(fake_expo.requests) == 2 + 4
+
+    assert len(results) == len(tokens)
+
+    # The experience ids learned from the errors are used to group the tokens from the start
+    fake_expo.requests = []
+    send_notification('title', 'body', 'url', tokens)
+    assert len(fake_expo.requests) == 2
+    metrics = push_metrics()
+    assert metrics['experience_id_misses'] == len(tokens)
+    assert metrics['mixed_chunks'] == 2
+
+
+def test_send_notification_mixed_chunks_concurrency(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(2000)]
+    fake_expo.experience_ids = {t: f'@envision/app-{i % 4}' for i, t in enumerate(tokens)}
+    fake_expo.delay = 0.05
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert sorted(r['token'] for r in results if r['status'] == 'ok') == sorted(tokens)
+    # The chunks split by project are sent by the worker of the chunk
+    assert fake_expo.max_in_flight <= MAX_CONCURRENT_REQUESTS
+
+
+def test_send_notification_errors(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(10)]
+    fake_expo.responses = [(400, {'errors': [{'code': 'VALIDATION_ERROR'}, {'code': 'VALIDATION_ERROR'}]}, {})]
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert [r['token'] for r in results] == tokens
+    assert [r['status'] for r in results] == ['error'] * 10
+
+
+def test_send_notification_duplicate_tokens(fake_expo):
+    tokens = ['ExponentPushToken[a]', 'ExponentPushToken[a]', 'ExponentPushToken[b]']
+
+    results = send_notification('title', 'body', 'url', tokens)
+    assert [r['token'] for r in results] == tokens
+    assert fake_expo.requests == [['ExponentPushToken[a]', 'ExponentPushToken[b]']]
+
+
+@verify_environment
+def test_bookkeeping_batches(mongo_empty, mocker):
+    conn.users.insert_many([{'expo_token': f'token {i}-{j}'} for i in range(25) for j in range(10)])
+    notification_id = conn.notifications.insert_one({'notifications_sent': 0, 'notifications_error': 0}).inserted_id
+    record = mocker.spy(service.notification, '_record_on_users')
+    bookkeeping = _Bookkeeping(notification_id, batch_size=100)
+    for i in range(25):
+        bookkeeping.add([{'token': f'token {i}-{j}', 'status': 'error' if j == 0 else 'ok'} for j in range(10)],
+                        last_user_id=ObjectId())
+    bookkeeping.flush()
+
+    assert bookkeeping.counts == {False: 225, True: 25}
+    assert [(len(c.args[1][False]), len(c.args[1][True])) for c in record.call_args_list] == [(108, 12), (108, 12),
+                                                                                            (9, 1)]
+    assert conn.users.count_documents({'notifications': {'$size': 1}}) == 250
+    assert conn.users.count_documents({'notifications.error': True}) == 25
+    notification = conn.notifications.find_one({'_id': notification_id})
+    assert notification['notifications_sent'] == 225
+    assert notification['notifications_error'] == 25
+    assert notification['resume_after'] == bookkeeping.last_user_id
+
+    # A resumed send does not record the notification twice
+    service.notification._record_on_users(notification_id, {False: ['token 1-1'], True: []})
+    assert len(conn.users.find_one({'expo_token': 'token 1-1'})['notifications']) == 1
+
+
+@verify_environment
+def test_send_notification_job(mongo_empty, mongo_insert_dummy_users, fake_expo):
+    fake_expo.rejected_tokens = {'test expo token 2'}
+    notification = service.notification.create('title', 'body', 'url')
+    job = jobs.claim('test worker')
+    assert job['payload'] == {'notification_id': notification['_id']}
+    assert service.notification._send_status(notification) == 'sending'
+
+    jobs.run(job, 'test worker')
+    assert conn.jobs.find_one({'_id': job['_id']})['status'] == 'done'
+    notification = conn.notifications.find_one({'_id': notification['_id']})
+    assert notification['notifications_sent'] == 1
+    assert notification['notifications_error'] == 1
+    assert notification['sent_at'] is not None
+    assert service.notification._send_status(notification) == 'sent'
+    user = conn.users.find_one({'expo_token': 'test expo token 2'})
+    assert user['notifications'][0]['notification_id'] == notification['_id']
+    assert user['notifications'][0]['error']
+
+
+@verify_environment
+def test_send_notification_job_resumes(mongo_empty, mongo_insert_dummy_users, fake_expo):
+    first_user = conn.users.find_one(sort=[('_id', 1)])
+    notification = service.notification.create('title', 'body', 'url')
+    conn.notifications.update_one({'_id': notification['_id']},
+                                  {'$set': {'resume_after': first_user['_id'], 'notifications_sent': 1}})
+
+    jobs.run(jobs.claim('test worker'), 'test worker')
+    assert fake_expo.requests == [['test expo token 2']]
+    assert conn.notifications.find_one({'_id': notification['_id']})['notifications_sent'] == 2
+
+
+@verify_environment
+def test_send_notification_job_saves_progress_on_failure(mongo_empty, fake_expo, mocker):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(250)]
+    conn.users.insert_many([{'expo_token': token} for token in tokens])
+    notification = service.notification.create('title', 'body', 'url')
+    post = utils.notifications._post
+
+    def fail_after_first_chunk(expo_tokens, *args):
+        if expo_tokens[0] != tokens[0]:
+            raise ExpoUnavailable('status 503 after 5 retries')
+        return post(expo_tokens, *args)
+
+    mocker.patch('utils.notifications._post', side_effect=fail_after_first_chunk)
+    with pytest.raises(ExpoUnavailable):
+        service.notification._send_job({'notification_id': notification['_id']})
+    notification = conn.notifications.find_one({'_id': notification['_id']})
+    assert notification['notifications_sent'] == EXPO_CHUNK_SIZE
+    assert notification['send_error'] == 'status 503 after 5 retries'
+    assert service.notification._send_status(notification) == 'sending'
+
+    # The retry resumes after the tokens already sent
+    mocker.patch('utils.notifications._post', side_effect=post)
+    service.notification._send(conn.notifications.find_one({'_id': notification['_id']}))
+    sent = [token for request in fake_expo.requests for token in request]
+    assert sorted(sent) == sorted(tokens)
+    notification = conn.notifications.find_one({'_id': notification['_id']})
+    assert notification['notifications_sent'] == len(tokens)
+    assert 'send_error' not in notification
+
+
+@verify_environment
+def test_send_notification_job_duplicate_tokens(mongo_empty, fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(250)]
+    tokens[2] = tokens[1]
+    user_ids = conn.users.insert_many([{'expo_token': token} for token in tokens]).inserted_ids
+    notification = service.notification.create('title', 'body', 'url')
+
+    # The users that share a token do not hold back the last user sent
+    service.notification._send(notification)
+    notification = conn.notifications.find_one({'_id': notification['_id']})
+    assert notification['resume_after'] == user_ids[-1]
+    assert notification['notifications_sent'] == len(tokens)
+    assert sum(len(r) for r in fake_expo.requests) == len(tokens) - 1
+
+
+@verify_environment
+def test_scheduler(mongo_empty):
+    scheduler = service.notification.scheduler
+    scheduler.start()
+    try:
+        send_at = datetime.utcnow() + timedelta(seconds=1)
+        notification = service.notification.create('title', 'body', 'url', send_at=send_at)
+        assert conn.notifications.find_one({'_id': notification['_id']})['status'] == 'scheduled'
+
+        # The scheduler wakes up at send_at, not after SCHEDULER_MAX_SLEEP
+        time.sleep(2.5)
+        assert conn.notifications.find_one({'_id': notification['_id']})['status'] == 'sent'
+        assert conn.jobs.count_documents({'payload.notification_id': notification['_id']}) == 1
+    finally:
+        scheduler.stop()
+
+
+@verify_environment
+def test_send_scheduled_enqueues_lost_sends(mongo_empty):
+    conn.jobs.create_indexes(service.notification.jobs_indexes)
+    notification = service.notification.create('title', 'body', 'url')
+    lost = service.notification.create('title', 'body', 'url', send_at=datetime.utcnow() + timedelta(hours=1))
+    # The process stopped after claiming the scheduled notification, before enqueuing its send
+    conn.notifications.update_one({'_id': lost['_id']}, {'$set': {'status': 'sent'}})
+
+    assert [n['_id'] for n in service.notification.send_scheduled()] == [lost['_id']]
+    assert service.notification.send_scheduled() == []
+    for n in [notification, lost]:
+        assert conn.jobs.count_documents({'payload.notification_id': n['_id']}) == 1
+    assert not service.notification._enqueue_send(notification['_id'])
+
+
+@verify_environment
+def test_send_notification_job_fails(mongo_empty, mongo_insert_dummy_users, mocker):
+    conn.jobs.create_indexes(service.notification.jobs_indexes)
+    mocker.patch('utils.notifications._post', side_effect=ExpoUnavailable('status 503 after 5 retries'))
+    notification = service.notification.create('title', 'body', 'url')
+    for _ in range(jobs.MAX_ATTEMPTS):
+        conn.jobs.update_many({}, {'$set': {'run_at': datetime.utcnow()}})
+        jobs.run(jobs.claim('test worker'), 'test worker')
+
+    notification = conn.notifications.find_one({'_id': notification['_id']})
+    assert service.notification._send_status(notification) == 'failed'
+    assert notification['send_error'] == 'status 503 after 5 retries'
+    assert service.notification.send_scheduled() == []
+
+
+def test_get_receipts(fake_expo):
+    tokens = [f'ExponentPushToken[{i}]' for i in range(1500)]
+    fake_expo.unregistered_tokens = {tokens[3]}
+    ticket_ids = [r['id'] for r in send_notification('title', 'body', 'url', tokens)]
+
+    receipts = get_receipts(ticket_ids + ['unknown ticket'])
+    assert sorted(len(r) for r in fake_expo.receipts_requests) == [501, 1000]
+    assert len(receipts) == len(tokens)
+    assert receipts[ticket_ids[3]]['details']['error'] == 'DeviceNotRegistered'
+    assert [t for t in ticket_ids if receipts[t]['status'] == 'error'] == [ticket_ids[3]]
+
+
+@verify_environment
+def test_receipts_prune_unregistered_tokens(mongo_empty, mongo_insert_dummy_users, fake_expo):
+    fake_expo.unregistered_tokens = {'test expo token 2'}
+    notification = service.notification.create('title', 'body', 'url')
+    jobs.run(jobs.claim('test worker'), 'test worker')
+    assert conn.push_tickets.count_documents({'notification_id': notification['_id']}) == 2
+
+    # The receipts are not checked before RECEIPTS_DELAY
+    receipts = service.notification._Receipts()
+    assert receipts.check() == 0
+    conn.push_tickets.update_many({}, {'$set': {'check_after': datetime.utcnow()}})
+    assert receipts.check() == 2
+
+    assert conn.push_tickets.count_documents({}) == 0
+    assert conn.users.count_documents({'expo_token': 'test expo token 2'}) == 0
+    assert conn.users.count_documents({'expo_token': 'test expo token'}) == 1
+    assert receipts.metrics() == {'receipts_checked': 2, 'receipts_error': 1, 'tokens_pruned': 1}
+
+
+@verify_environment
+def test_receipts_claimed_by_one_process(mongo_empty, mongo_insert_dummy_users, fake_expo, mocker):
+    fake_expo.unregistered_tokens = {'test expo token 2'}
+    service.notification.create('title', 'body', 'url')
+    jobs.run(jobs.claim('test worker'), 'test worker')
+    conn.push_tickets.update_many({}, {'$set': {'check_after': datetime.utcnow()}})
+
+    # Another process polls while the receipts of the batch are fetched
+    other = service.notification._Receipts()
+    fetch = service.notification.get_receipts
+    mocker.patch('service.notification.get_receipts', side_effect=lambda ids: other.check() or fetch(ids))
+    receipts = service.notification._Receipts()
+    assert receipts.check() == 2
+    assert receipts.metrics() == {'receipts_checked': 2, 'receipts_error': 1, 'tokens_pruned': 1}
+    assert other.metrics() == {'receipts_checked': 0, 'receipts_error': 0, 'tokens_pruned': 0}
+    assert len(fake_expo.receipts_requests) == 1
+
+    # The tickets of a process that stopped are checked again after the lease
+    service.notification.create('title', 'body', 'url')
+    jobs.run(jobs.claim('test worker'), 'test worker')
+    conn.push_tickets.update_many({}, {'$set': {'check_after': datetime.utcnow()}})
+    _, tickets = service.notification._Receipts._claim(datetime.utcnow(), 10)
+    assert len(tickets) == 1
+    assert other.check() == 0
+    conn.push_tickets.update_many({}, {'$set': {'check_after': datetime.utcnow()}})
+    mocker.patch('service.notification.get_receipts', side_effect=fetch)
+    assert other.check() == 1
@@ -1,14 +1,31 @@
+import pytest
 from fastapi.testclient import TestClient
 from datetime import datetime
+from bson import ObjectId
 import json
+import base64
 
-from .conftest import verify_environment, DummyAdmins
+from .conftest import verify_environment, DummyAdmins, winning_plan_stages
 from config.db import conn
 from main import app
+from config.auth import invalidate_principal
+from utils.security import encode
+from exceptions.integration_exceptions import IntegrationUnavailable
+from utils.format import add_sort_stages_to_pipeline, ensure_null_last_sort
+import service
+from service import jobs, ethos
 
 client = TestClient(app)
 
 
+@pytest.fixture(scope='module', autouse=True)
+def app_lifespan():
+    # The requests share the event loop of the app, where its Motor client is opened, and the tests call the
+    # services in it through client.portal
+    with client:
+        yield
+
+
 @verify_environment
 def test_find_talents(mongo_empty, mongo_insert_dummy_talents):
     filters = json.dumps({'q': 'name'})
@@ -175,7 +192,12 @@ def test_create_ethos_instructor(mongo_empty, mongo_insert_dummy_talents, mock_t
     response = client.put(f'/talents/{talent_id}/create_ethos', headers={'Authorization': DummyAdmins.admin_token})
     assert response.status_code == 200
     assert response.json()['name'] == talent['name']
-    assert response.json()['ethos_id'] is not None
+    assert response.json()['ethos_sync']['status'] == 'pending'
+
+    ethos.sync(ethos.claim())
+    talent = conn.talents.find_one({'_id': talent['_id']})
+    assert talent['ethos_id'] is not None
+    assert talent['ethos_sync']['status'] == 'synced'
 
 
 @verify_environment
@@ -194,3 +216,291 @@ def test_create_ethos_instructor_not_found(mongo_empty, mongo_insert_dummy_talen
     talent_id = '63f1937484c3af471a5f044c'
     response = client.put(f'/talents/{talent_id}/create_ethos', headers={'Authorization': DummyAdmins.admin_token})
     assert response.status_code == 404
+
+
+@verify_environment
+def test_find_talents_sorted(mongo_empty, mongo_insert_dummy_talents):
+    ensure_null_last_sort(conn.talents, service.Talent.sort_fields, prefix=[('deleted', 1)])
+    for ascending in [True, False]:
+        response = client.get('/talents/', params={'sort_by': 'name', 'ascending': ascending},
+                              headers={'Authorization': DummyAdmins.admin_token})
+        assert response.status_code == 200
+        names = [t['name'] for t in response.json()['results']]
+        assert names == sorted(names, reverse=not ascending)
+
+
+@verify_environment
+def test_find_talents_sort_uses_index(mongo_empty, mongo_insert_dummy_talents):
+    ensure_null_last_sort(conn.talents, service.Talent.sort_fields, prefix=[('deleted', 1)])
+    for ascending in [True, False]:
+        pipeline = add_sort_stages_to_pipeline([{'$match': {'deleted': False}}], sort_by='name',
+                                               ascending=ascending, null_last_fields=service.Talent.sort_fields)
+        stages = winning_plan_stages('talents', pipeline + [{'$limit': 10}])
+        assert 'IXSCAN' in stages
+        assert 'SORT' not in stages
+
+
+@verify_environment
+def test_find_talents_cursor(mongo_empty, mongo_insert_dummy_talents):
+    ensure_null_last_sort(conn.talents, service.Talent.sort_fields, prefix=[('deleted', 1)])
+    response = client.get('/talents/', headers={'Authorization': DummyAdmins.admin_token})
+    all_names = [t['name'] for t in response.json()['results']]
+
+    names, cursor = [], None
+    while True:
+        params = {'limit': 1, 'cursor': cursor} if cursor else {'limit': 1}
+        response = client.get('/talents/', params=params, headers={'Authorization': DummyAdmins.admin_token})
+        assert response.status_code == 200
+        assert response.json()['paging']['total'] == len(all_names)
+        names.extend(t['name'] for t in response.json()['results'])
+        cursor = response.json()['paging']['next_cursor']
+        if not cursor:
+            break
+    assert names == all_names
+
+    response = client.get('/talents/', params={'limit': 1, 'cursor': 'invalid'},
+                          headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 400
+
+    # The cursors made by the client with an invalid id, or a value that is a query operator, are rejected
+    for tampered in [b'{"sort_by": "name", "ascending": true, "id": {"$oid": "bad"}}',
+                     b'{"sort_by": "name", "ascending": true, "has": false, "value": null, "id": "1"}',
+                     b'{"sort_by": "name", "ascending": true, "has": true, "value": {"$ne": null}, '
+                     b'"id": {"$oid": "63f1937484c3af471a5f044c"}}']:
+        response = client.get('/talents/', params={'limit': 1, 'cursor': base64.urlsafe_b64encode(tampered).decode()},
+                              headers={'Authorization': DummyAdmins.admin_token})
+        assert response.status_code == 400
+
+
+@verify_environment
+def test_search_talents(mongo_empty, mock_cms):
+    for name, slug in [('Music of Savej', 'slug-1'), ('Savej', 'slug-2'), ('Lucho', 'slug-3')]:
+        response = client.post('/talents/', json={'name': name, 'envision_festival': True, 'slug': slug},
+                               headers={'Authorization': DummyAdmins.admin_token})
+        assert response.status_code == 201
+
+    filters = json.dumps({'q': 'sav'})
+    response = client.get('/talents/', params=f'filter={filters}', headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 200
+    assert sorted(t['name'] for t in response.json()['results']) == ['Music of Savej', 'Savej']
+
+    filters = json.dumps({'q': 'savej'})
+    response = client.get('/talents/', params=f'filter={filters}&sort_by=relevance',
+                          headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 200
+    assert [t['name'] for t in response.json()['results']] == ['Savej', 'Music of Savej']
+    assert all('search_score' not in t for t in response.json()['results'])
+
+    # The description is searched too
+    client.portal.call(service.Talent().create, {'name': 'Tribute', 'envision_festival': True, 'slug': 'slug-4',
+                                                 'description': 'A tribute to Savej', 'picture': {'original': None},
+                                                 'ethos_instructor': False})
+    filters = json.dumps({'q': 'savej'})
+    response = client.get('/talents/', params=f'filter={filters}', headers={'Authorization': DummyAdmins.admin_token})
+    assert sorted(t['name'] for t in response.json()['results']) == ['Music of Savej', 'Savej', 'Tribute']
+
+
+@verify_environment
+def test_talent_admin_principal_cache(mongo_empty, mongo_insert_dummy_talents):
+    talents = list(conn.talents.find({'deleted': False}))
+    admin = {'name': 'talent admin', 'email': 'talent.admin@test.com', 'role': 'talent',
+             'talent_id': talents[0]['_id'], 'deleted': False}
+    admin_id = conn.admins.insert_one(admin).inserted_id
+    token = encode({'_id': admin_id, 'role': 'talent'})
+
+    response = client.get(f'/talents/{talents[0]["_id"]}', headers={'Authorization': token})
+    assert response.status_code == 200
+
+    # The talent of the admin is cached until the admin is invalidated
+    conn.admins.update_one({'_id': admin_id}, {'$set': {'talent_id': talents[1]['_id']}})
+    response = client.get('/talents/', headers={'Authorization': token})
+    assert [t['id'] for t in response.json()['results']] == [str(talents[0]['_id'])]
+
+    invalidate_principal(admin_id)
+    response = client.get('/talents/', headers={'Authorization': token})
+    assert [t['id'] for t in response.json()['results']] == [str(talents[1]['_id'])]
+
+    # A talent admin without a talent is not allowed to list the talents
+    conn.admins.update_one({'_id': admin_id}, {'$set': {'talent_id': None}})
+    invalidate_principal(admin_id)
+    response = client.get('/talents/', headers={'Authorization': token})
+    assert response.status_code == 403
+
+    # A talent_id claim in the token does not outlive the admin
+    token = encode({'_id': admin_id, 'role': 'talent', 'talent_id': talents[0]['_id']})
+    response = client.get('/talents/', headers={'Authorization': token})
+    assert response.status_code == 403
+    conn.admins.update_one({'_id': admin_id}, {'$set': {'talent_id': talents[0]['_id'], 'deleted': True}})
+    invalidate_principal(admin_id)
+    response = client.get('/talents/', headers={'Authorization': token})
+    assert response.status_code == 403
+    assert response.json()['detail'] == 'Invalid token'
+
+
+@verify_environment
+def test_find_missing_talents(mongo_empty, mongo_insert_dummy_talents):
+    talent_id = conn.talents.find_one({'deleted': False})['_id']
+    missing_id = ObjectId()
+    find_missing = service.Talent().find_missing
+    assert client.portal.call(find_missing, [talent_id, str(talent_id)]) == []
+    assert client.portal.call(find_missing, [talent_id, missing_id, str(missing_id), 'invalid']) == \
+        [missing_id, str(missing_id), 'invalid']
+
+
+@verify_environment
+def test_create_talent_picture_processed_later(mongo_empty, mock_cms, mocker):
+    talent = {
+        'name': 'Test name',
+        'envision_festival': False,
+        'slug': 'slug-1',
+        'picture': {'original': 'https://example.com/picture.jpg'}
+    }
+    create_image_obj = mocker.patch('service.picture.create_image_obj')
+    response = client.post('/talents/', json=talent, headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 201
+    assert response.json()['picture']['status'] == 'pending'
+    assert not create_image_obj.called
+
+    talent_db = conn.talents.find_one({'slug': 'slug-1'})
+    create_image_obj.return_value = {
+        'original': 'https://bucket/originals/talents/hash.jpg',
+        'thumbnail': 'https://bucket/renditions/talents/hash/480.jpg',
+        'renditions': [{'url': 'https://bucket/renditions/talents/hash/480.jpg', 'width': 480, 'height': 320,
+                        'format': 'jpeg'}]
+    }
+    jobs.run(jobs.claim('test worker'), 'test worker')
+
+    picture = conn.talents.find_one({'_id': talent_db['_id']})['picture']
+    assert picture['status'] == 'ready'
+    assert picture['original'] == 'https://bucket/originals/talents/hash.jpg'
+    assert picture['thumbnail'] == 'https://bucket/renditions/talents/hash/480.jpg'
+    assert conn.talents.find_one({'_id': talent_db['_id']})['last_modified'] > talent_db['last_modified']
+
+
+@verify_environment
+def test_ethos_sync_outbox(mongo_empty, mock_cms, mocker):
+    create_item = mocker.patch('utils.thinkific.create_item', return_value={'status': 201, 'response': {'id': 7}})
+    update_item = mocker.patch('utils.thinkific.update_item', side_effect=IntegrationUnavailable('Thinkific', ''))
+    delete_item = mocker.patch('utils.thinkific.delete_item', return_value={'status': 204})
+    talent = {'name': 'Test name', 'envision_festival': False, 'slug': 'slug-1', 'ethos_instructor': True}
+    response = client.post('/talents/', json=talent, headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 201
+    assert response.json()['ethos_sync']['status'] == 'pending'
+    assert not create_item.called
+
+    # A talent written while it is being synced is synced again, and the instructor is not created twice
+    claimed = ethos.claim()
+    assert ethos.claim() is None
+    client.put(f'/talents/{claimed["_id"]}', json={'name': 'new name'},
+               headers={'Authorization': DummyAdmins.admin_token})
+    ethos.sync(claimed)
+    talent = conn.talents.find_one({'_id': claimed['_id']})
+    assert talent['ethos_id'] == 7
+    assert talent['ethos_sync']['status'] == 'pending'
+
+    # Thinkific is unavailable, so the update is retried later
+    ethos.sync(ethos.claim())
+    talent = conn.talents.find_one({'_id': claimed['_id']})
+    assert update_item.call_args.args[2]['first_name'] == 'new name'
+    assert talent['ethos_sync']['status'] == 'pending'
+    assert talent['ethos_sync']['attempts'] == 1
+    assert talent['ethos_sync']['run_at'] > datetime.utcnow()
+    assert ethos.claim() is None
+
+    client.portal.call(service.Talent().delete, claimed['_id'])
+    ethos.sync(ethos.claim())
+    delete_item.assert_called_once_with(ethos.THINKIFIC_COLLECTION, 7)
+    talent = conn.talents.find_one({'_id': claimed['_id']})
+    assert talent['ethos_id'] is None
+    assert talent['ethos_sync']['status'] == 'synced'
+    assert create_item.call_count == 1
+
+
+@verify_environment
+def test_ethos_sync_recreates_deleted_instructor(mongo_empty, fake_thinkific):
+    talent = client.portal.call(service.Talent().create, {'name': 'Test name', 'envision_festival': False,
+                                                          'slug': 'slug-1', 'ethos_instructor': True,
+                                                          'picture': {'original': None}})
+    ethos.sync(ethos.claim())
+    ethos_id = conn.talents.find_one({'_id': talent['_id']})['ethos_id']
+    assert ethos_id in fake_thinkific.instructors
+
+    # The instructor is deleted in Thinkific, so the next sync creates it again
+    del fake_thinkific.instructors[ethos_id]
+    client.portal.call(service.Talent().update, talent['_id'], {'name': 'New name'})
+    ethos.sync(ethos.claim())
+    talent = conn.talents.find_one({'_id': talent['_id']})
+    assert talent['ethos_sync']['status'] == 'synced'
+    assert talent['ethos_id'] != ethos_id
+    assert fake_thinkific.instructors[talent['ethos_id']]['first_name'] == 'New name'
+
+
+@verify_environment
+def test_reconcile_ethos(mongo_empty, fake_thinkific, mocker):
+    mocker.patch('utils.thinkific.PAGE_SIZE', 2)
+    # The emails and slugs are compared regardless of their case
+    in_sync = fake_thinkific.add(first_name='In sync', last_name='In-Sync', slug='in-sync', email='A@test.com ')
+    outdated = fake_thinkific.add(first_name='Old name', last_name='outdated', slug='outdated')
+    by_email = fake_thinkific.add(first_name='By email', last_name='by-email', slug='by-email', email='b@test.com')
+    to_delete = fake_thinkific.add(first_name='Deleted', last_name='deleted', slug='deleted')
+    orphan = fake_thinkific.add(first_name='Orphan', last_name='orphan', slug='orphan')
+    talents = [
+        ({'name': 'In sync', 'slug': 'in-sync', 'email': 'a@test.com'}, {'ethos_id': in_sync['id']}),
+        ({'name': 'New name', 'slug': 'outdated'}, {'ethos_id': outdated['id']}),
+        ({'name': 'By email', 'slug': 'by-email', 'email': 'b@test.com'}, {'ethos_id': 1}),
+        ({'name': 'Missing', 'slug': 'missing'}, {'ethos_id': None}),
+        ({'name': 'Deleted', 'slug': 'deleted'}, {'ethos_id': to_delete['id'], 'deleted': True})
+    ]
+    ids = []
+    for talent, drift in talents:
+        talent = client.portal.call(service.Talent().create, {**talent, 'envision_festival': False,
+                                                              'ethos_instructor': True, 'picture': {'original': None}})
+        # The talents were synced once and drifted from Thinkific since then
+        conn.talents.update_one({'_id': talent['_id']},
+                                {'$set': {**drift, f'{ethos.SYNC_FIELD}.status': 'synced'}})
+        ids.append(talent['_id'])
+    client.portal.call(service.Talent().create, {'name': 'Not instructor', 'envision_festival': False,
+                                                 'slug': 'not-instructor', 'ethos_instructor': False,
+                                                 'picture': {'original': None}})
+    expected = {'talents': 5, 'instructors': 5, 'in_sync': 1, 'pending': [], 'create': [str(ids[3])],
+                'update': [str(ids[1])], 'delete': [str(ids[4])], 'link': [str(ids[2])], 'unlink': [],
+                'orphans': [orphan['id']]}
+
+    report = ethos.reconcile(dry_run=True)
+    assert report == {**expected, 'dry_run': True, 'applied': 0}
+    assert not [r for r in fake_thinkific.requests if r[0] != 'GET']
+    assert ethos.claim() is None
+
+    report = ethos.reconcile()
+    assert report == {**expected, 'dry_run': False, 'applied': 4}
+    assert conn.talents.find_one({'_id': ids[2]})['ethos_id'] == by_email['id']
+    ethos.dispatcher._tick()
+    assert fake_thinkific.instructors[outdated['id']]['first_name'] == 'New name'
+    assert to_delete['id'] not in fake_thinkific.instructors
+    created = conn.talents.find_one({'_id': ids[3]})
+    assert fake_thinkific.instructors[created['ethos_id']]['first_name'] == 'Missing'
+
+    report = ethos.reconcile(dry_run=True)
+    assert report['in_sync'] == 5
+    assert report['orphans'] == [orphan['id']]
+
+
+@verify_environment
+def test_reconcile_ethos_job(mongo_empty, fake_thinkific):
+    orphan = fake_thinkific.add(first_name='Orphan', last_name='orphan', slug='orphan')
+    response = client.post('/talents/ethos/reconcile', headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 202
+    job_id = response.json()['id']
+    response = client.get(f'/talents/ethos/reconcile/{job_id}', headers={'Authorization': DummyAdmins.admin_token})
+    assert response.json()['status'] == 'pending'
+    assert response.json()['report'] is None
+
+    # The reconcile runs in the job workers
+    jobs.run(jobs.claim('test worker'), 'test worker')
+    response = client.get(f'/talents/ethos/reconcile/{job_id}', headers={'Authorization': DummyAdmins.admin_token})
+    assert response.json()['status'] == 'done'
+    assert response.json()['dry_run']
+    assert response.json()['report']['orphans'] == [orphan['id']]
+
+    response = client.get(f'/talents/ethos/reconcile/{ObjectId()}', headers={'Authorization': DummyAdmins.admin_token})
+    assert response.status_code == 404
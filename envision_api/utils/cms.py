@@ -1,57 +1,65 @@
-import requests
+import math
 from datetime import datetime
+from typing import Optional, Iterator
+from functools import partial
 from bson import ObjectId
 
 from config.constants import CMS_API_KEY, CMS_SITE_ID
 from utils.logger import log_error
+from utils.http import IntegrationClient, iter_pages
 
 headers = {
     'Authorization': f'Bearer {CMS_API_KEY}',
     'accept-version': '1.0.0',
     'Content-Type': 'application/json',
     'Accept': '*/*',
-    'Cache-Control': 'no-cache',
-    'Host': 'api.webflow.com',
-    'Accept-Encoding': 'gzip, deflate, br',
-    'Connection': 'keep-alive'
+    'Cache-Control': 'no-cache'
 }
 
 url = 'https://api.webflow.com/'
+timeout = (3.05, 20)  # (connect, read) in seconds
+requests_per_second = 1  # Webflow allows 60 requests per minute
+PAGE_SIZE = 100  # Webflow has a maximum of 100 items per page
+
+# The session keeps the connections alive
+client = IntegrationClient('Webflow', url, headers, timeout=timeout, requests_per_second=requests_per_second)
 
 
 def get_collections():
-    r = requests.get(url + f'sites/{CMS_SITE_ID}/collections?live=true', headers=headers)
+    r = client.get(f'sites/{CMS_SITE_ID}/collections?live=true')
     return r.json()
 
 
 def get_schema(collection_id):
-    r = requests.get(url + f'collections/{collection_id}?live=true', headers=headers)
+    r = client.get(f'collections/{collection_id}?live=true')
     return r.json()
 
 
 def get_sites():
-    r = requests.get(url + 'sites?live=true', headers=headers)
+    r = client.get('sites?live=true')
     return r.text
 
 
-def get_items(collection_id):
-    r = requests.get(url + f'collections/{collection_id}/items?live=true', headers=headers)
-    response = r.json()
-    items = response['items']
-    missing_items = response['total'] - response['count']
-    reached_items = response['count']
-    while missing_items > 0:
-        offset = reached_items
-        r = requests.get(url + f'collections/{collection_id}/items?live=true&offset={offset}', headers=headers)
-        response = r.json()
-        missing_items = missing_items - response['count']
-        reached_items = reached_items + response['count']
-        items.extend(response['items'])
-    return items
+def _get_page(collection_id: str, page: int) -> Optional[dict]:
+    r = client.get(f'collections/{collection_id}/items?live=true&offset={page * PAGE_SIZE}&limit={PAGE_SIZE}')
+    if r.status_code >= 400:
+        log_error(f'CMS ERROR trying to get items: {r.text}')
+        return None
+    return r.json()
+
+
+def iter_items(collection_id: str) -> Iterator[dict]:
+    """Yields the items of the collection while its pages are fetched concurrently"""
+    for response in iter_pages(partial(_get_page, collection_id), lambda r: math.ceil(r['total'] / PAGE_SIZE)):
+        yield from response['items']
+
+
+def get_items(collection_id: str) -> list:
+    return list(iter_items(collection_id))
 
 
 def get_item(collection_id, item_id):
-    r = requests.get(url + f'collections/{collection_id}/items/{item_id}?live=true', headers=headers)
+    r = client.get(f'collections/{collection_id}/items/{item_id}?live=true')
     response = r.json()
     return response
 
@@ -63,7 +71,7 @@ def create_item(collection_id, item):
     payload = {
         'fields': item
     }
-    r = requests.post(url + f'collections/{collection_id}/items?live=true', json=payload, headers=headers)
+    r = client.post(f'collections/{collection_id}/items?live=true', json=payload)
     response = {'status': r.status_code}
     if r.status_code >= 400:
         error_name = r.json()['name']
@@ -81,7 +89,7 @@ def update_item(collection_id, item_id, item):
     payload = {
         'fields': item
     }
-    r = requests.patch(url + f'collections/{collection_id}/items/{item_id}?live=true', json=payload, headers=headers)
+    r = client.patch(f'collections/{collection_id}/items/{item_id}?live=true', json=payload)
     response = {'status': r.status_code}
     if r.status_code >= 400:
         error_name = r.json()['name']
@@ -94,7 +102,7 @@ def update_item(collection_id, item_id, item):
 
 
 def delete_item(collection_id, item_id):
-    r = requests.delete(url + f'collections/{collection_id}/items/{item_id}', headers=headers)
+    r = client.delete(f'collections/{collection_id}/items/{item_id}')
     response = {'status': r.status_code}
     if r.status_code >= 400:
         error_name = r.json()['name']
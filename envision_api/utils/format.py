@@ -1,8 +1,17 @@
-from typing import List
+import base64
+from typing import List, Optional
 from copy import deepcopy
+from datetime import datetime
+from bson import json_util, ObjectId
+from bson.errors import BSONError
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from pymongo.collection import Collection
+from motor.motor_asyncio import AsyncIOMotorCollection
 
 from models.response import ListModel, Paging
+from exceptions.resource_exceptions import InvalidCursor
+
+CURSOR_VALUE_TYPES = (str, int, float, datetime, ObjectId, type(None))  # the values a cursor can be after
 
 
 class PaginationQueryParams:
@@ -34,39 +43,181 @@ def format_dict(old_dict, to_delete: list = None, to_rename: dict = None, to_ext
     return new_dict
 
 
+class _Pagination:
+    """Builds the stages of a paginated query, shared by the sync and the async implementations"""
+
+    def __init__(self, *, query: dict, pipeline: List[dict], limit: int, offset: int, cursor: str, sort_by: str,
+                 ascending: bool, page_stages: List[dict], null_last_fields: List[str]):
+        if query is not None and pipeline is not None:
+            raise TypeError('create_response_paginated() takes only one argument')
+        if query is None and pipeline is None:
+            raise TypeError('one of the following arguments should not be None: query, pipeline')
+
+        pipeline = list(pipeline) if pipeline else [{'$match': query}]
+        self.count_pipeline = pipeline + [{'$count': 'count'}]
+
+        sort_by = '_id' if sort_by == 'id' or (cursor and not sort_by) else sort_by
+        if cursor:
+            cursor_data = decode_cursor(cursor, sort_by=sort_by, ascending=ascending)
+            pipeline.append({'$match': cursor_query(cursor_data, sort_by=sort_by, ascending=ascending,
+                                                    null_last_fields=null_last_fields)})
+        if sort_by:
+            pipeline = add_sort_stages_to_pipeline(pipeline, sort_by=sort_by, ascending=ascending,
+                                                   null_last_fields=null_last_fields)
+
+        page_pipeline = []
+        if offset is not None and not cursor:
+            page_pipeline.append({'$skip': offset})
+        else:
+            offset = 0
+        if limit is not None:
+            page_pipeline.append({'$limit': limit})
+        page_pipeline.extend(page_stages or [])
+
+        self.limit, self.offset, self.cursor = limit, offset, cursor
+        self.sort_by, self.ascending = sort_by, ascending
+        self.pipeline, self.page_pipeline = pipeline, page_pipeline
+        # A $facet is avoided when the whole result set is requested because its output is a single document
+        # (limited to 16MB), and with a cursor because the keyset $match has to run before the sort to use an index
+        self.use_facet = limit is not None and not cursor
+
+    @property
+    def documents_pipeline(self) -> List[dict]:
+        return self.pipeline + self.page_pipeline
+
+    @property
+    def facet_pipeline(self) -> List[dict]:
+        return self.pipeline + [{
+            '$facet': {
+                'results': self.page_pipeline,
+                'total': [{'$count': 'count'}]
+            }
+        }]
+
+    @staticmethod
+    def parse_facet(r: list) -> tuple:
+        facet = r[0] if r else {'results': [], 'total': []}
+        return facet['results'], facet['total'][0]['count'] if facet['total'] else 0
+
+    @staticmethod
+    def parse_count(r: list) -> int:
+        return r[0]['count'] if r else 0
+
+    def total_from_documents(self, documents: list) -> Optional[int]:
+        """Returns the total when it can be taken from the documents, None when it has to be counted"""
+        if self.limit is None and not self.cursor and (documents or not self.offset):
+            return self.offset + len(documents)
+
+    def response(self, documents: list, total: int, format_func: callable = None) -> ListModel:
+        next_cursor = None
+        if self.sort_by and self.limit and len(documents) == self.limit:
+            next_cursor = encode_cursor(documents[-1], sort_by=self.sort_by, ascending=self.ascending)
+        results = list(map(format_func, documents)) if format_func else documents
+
+        return create_list_response(results, total=total, limit=self.limit if self.limit is not None else total,
+                                    offset=self.offset, next_cursor=next_cursor)
+
+
 def create_response_paginated(collection: Collection, *,
                               query: dict = None, pipeline: List[dict] = None,
-                              limit: int = None, offset: int = None,
+                              limit: int = None, offset: int = None, cursor: str = None,
                               sort_by: str = None, ascending: bool = True,
-                              format_func: callable = None) -> ListModel:
-    if query is not None and pipeline is not None:
-        raise TypeError('create_response_paginated() takes only one argument')
-    if query is None and pipeline is None:
-        raise TypeError('one of the following arguments should not be None: query, pipeline')
-
-    pipeline = pipeline if pipeline else [{'$match': query}]
+                              format_func: callable = None, page_stages: List[dict] = None,
+                              null_last_fields: List[str] = None) -> ListModel:
+    """
+    Returns the page and the total count in a single round trip (`$facet`).
+    `page_stages` run only on the documents of the returned page (e.g. `$lookup` stages).
+    When `cursor` is given the page starts right after the cursor document (keyset pagination) and `offset`
+    is ignored. A `next_cursor` is returned whenever there may be more results.
+    """
+    p = _Pagination(query=query, pipeline=pipeline, limit=limit, offset=offset, cursor=cursor, sort_by=sort_by,
+                    ascending=ascending, page_stages=page_stages, null_last_fields=null_last_fields)
+    if p.use_facet:
+        documents, total = p.parse_facet(list(collection.aggregate(p.facet_pipeline)))
+    else:
+        documents = list(collection.aggregate(p.documents_pipeline))
+        total = p.total_from_documents(documents)
+        if total is None:
+            total = p.parse_count(list(collection.aggregate(p.count_pipeline)))
 
-    r = list(collection.aggregate(pipeline + [{'$count': 'count'}]))
-    total = r[0]['count'] if r else 0
+    return p.response(documents, total, format_func)
 
-    if sort_by:
-        sort_by = '_id' if sort_by == 'id' else sort_by
-        pipeline = add_sort_stages_to_pipeline(pipeline, sort_by=sort_by, ascending=ascending)
 
-    if offset is not None:
-        pipeline.append({'$skip': offset})
+async def create_response_paginated_async(collection: AsyncIOMotorCollection, *,
+                                          query: dict = None, pipeline: List[dict] = None,
+                                          limit: int = None, offset: int = None, cursor: str = None,
+                                          sort_by: str = None, ascending: bool = True,
+                                          format_func: callable = None, page_stages: List[dict] = None,
+                                          null_last_fields: List[str] = None) -> ListModel:
+    """Same as create_response_paginated, for a Motor collection"""
+    p = _Pagination(query=query, pipeline=pipeline, limit=limit, offset=offset, cursor=cursor, sort_by=sort_by,
+                    ascending=ascending, page_stages=page_stages, null_last_fields=null_last_fields)
+    if p.use_facet:
+        documents, total = p.parse_facet(await collection.aggregate(p.facet_pipeline).to_list(None))
     else:
-        offset = 0
-    if limit is not None:
-        pipeline.append({'$limit': limit})
-    else:
-        limit = total
+        documents = await collection.aggregate(p.documents_pipeline).to_list(None)
+        total = p.total_from_documents(documents)
+        if total is None:
+            total = p.parse_count(await collection.aggregate(p.count_pipeline).to_list(None))
 
-    cursor = collection.aggregate(pipeline)
+    return p.response(documents, total, format_func)
 
-    results = list(map(format_func, cursor)) if format_func else list(cursor)
 
-    return create_list_response(results, total=total, limit=limit, offset=offset)
+def _get_field(document: dict, field: str):
+    for key in field.split('.'):
+        document = document.get(key) if isinstance(document, dict) else None
+    return document
+
+
+def encode_cursor(document: dict, sort_by: str, ascending: bool) -> str:
+    value = _get_field(document, sort_by)
+    payload = {
+        'sort_by': sort_by,
+        'ascending': ascending,
+        'has': value is not None,
+        'value': value,
+        'id': document['_id']
+    }
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_by: str, ascending: bool) -> dict:
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, BSONError):
+        raise InvalidCursor()
+    if not isinstance(payload, dict) or not isinstance(payload.get('id'), ObjectId):
+        raise InvalidCursor()
+    # The cursor is only valid for the sort it was created with
+    if payload.get('sort_by') != sort_by or payload.get('ascending') != ascending:
+        raise InvalidCursor()
+    # The value is used in the query, so it is a sort value and not an operator (e.g. {'$ne': None})
+    if not isinstance(payload.get('has'), bool) or not isinstance(payload.get('value'), CURSOR_VALUE_TYPES) \
+            or payload['has'] != (payload['value'] is not None):
+        raise InvalidCursor()
+    return payload
+
+
+def cursor_query(cursor: dict, sort_by: str, ascending: bool, null_last_fields: List[str] = None) -> dict:
+    op = '$gt' if ascending else '$lt'
+    if sort_by == '_id':
+        return {'_id': {op: cursor['id']}}
+
+    if null_last_fields and sort_by in null_last_fields:
+        has, has_not = {null_last_key(sort_by): True}, {null_last_key(sort_by): False}
+    else:
+        has, has_not = {sort_by: {'$ne': None}}, {sort_by: None}
+
+    # Documents without the field are always sorted last (and by _id between them)
+    if not cursor['has']:
+        return {**has_not, '_id': {op: cursor['id']}}
+    return {
+        '$or': [
+            {**has, sort_by: {op: cursor['value']}},
+            {**has, sort_by: cursor['value'], '_id': {op: cursor['id']}},
+            has_not
+        ]
+    }
 
 
 def paginate_list(results: list, limit: int = None, offset: int = None):
@@ -82,7 +233,8 @@ def paginate_list(results: list, limit: int = None, offset: int = None):
     return create_list_response(results[offset:offset + limit], total=total, limit=limit, offset=offset)
 
 
-def create_list_response(results: list, total: int = None, limit: int = None, offset: int = None) -> ListModel:
+def create_list_response(results: list, total: int = None, limit: int = None, offset: int = None,
+                         next_cursor: str = None) -> ListModel:
     if not total:
         total = len(results)
     if not limit:
@@ -92,11 +244,21 @@ def create_list_response(results: list, total: int = None, limit: int = None, of
 
     return ListModel(
         results=results,
-        paging=Paging(total=total, limit=limit, offset=offset)
+        paging=Paging(total=total, limit=limit, offset=offset, next_cursor=next_cursor)
     )
 
 
-def add_sort_stages_to_pipeline(pipeline: list, sort_by: str, ascending: bool) -> list:
+def add_sort_stages_to_pipeline(pipeline: list, sort_by: str, ascending: bool,
+                                null_last_fields: List[str] = None) -> list:
+    direction = ASCENDING if ascending else DESCENDING
+    if sort_by == '_id':
+        pipeline.append({'$sort': {'_id': direction}})
+        return pipeline
+    if null_last_fields and sort_by in null_last_fields:
+        # The documents keep a `_has_<field>` key (see set_null_last_keys) so the sort can use an index
+        pipeline.append({'$sort': {null_last_key(sort_by): DESCENDING, sort_by: direction, '_id': direction}})
+        return pipeline
+
     pipeline.extend([
         {
             '$fill': {
@@ -113,7 +275,8 @@ def add_sort_stages_to_pipeline(pipeline: list, sort_by: str, ascending: bool) -
         }, {
             '$sort': {
                 'has_field': -1,
-                sort_by: 1 if ascending else -1
+                sort_by: direction,
+                '_id': direction
             }
         }, {
             '$unset': 'has_field'
@@ -121,3 +284,36 @@ def add_sort_stages_to_pipeline(pipeline: list, sort_by: str, ascending: bool) -
     ])
 
     return pipeline
+
+
+def null_last_key(field: str) -> str:
+    return f'_has_{field.replace(".", "_")}'
+
+
+def set_null_last_keys(document: dict, fields: List[str]) -> dict:
+    for field in fields:
+        if field in document:
+            document[null_last_key(field)] = document[field] is not None
+    return document
+
+
+def null_last_indexes(field: str, prefix: List[tuple] = None) -> List[IndexModel]:
+    prefix = prefix or []
+    return [
+        IndexModel(prefix + [(null_last_key(field), DESCENDING), (field, direction), ('_id', direction)])
+        for direction in [ASCENDING, DESCENDING]
+    ]
+
+
+def backfill_null_last_keys(collection: Collection, fields: List[str]) -> None:
+    for field in fields:
+        key = null_last_key(field)
+        collection.update_many(
+            {key: {'$exists': False}},
+            [{'$set': {key: {'$ne': [{'$ifNull': [f'${field}', None]}, None]}}}]
+        )
+
+
+def ensure_null_last_sort(collection: Collection, fields: List[str], prefix: List[tuple] = None) -> None:
+    collection.create_indexes([index for field in fields for index in null_last_indexes(field, prefix)])
+    backfill_null_last_keys(collection, fields)
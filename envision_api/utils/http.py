@@ -0,0 +1,195 @@
+import time
+import random
+from collections import deque
+from threading import Lock
+from typing import Optional, Tuple, Union, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from exceptions.integration_exceptions import IntegrationUnavailable
+from utils.logger import logger
+
+DEFAULT_TIMEOUT = (3.05, 10)  # (connect, read) in seconds
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # in seconds, doubled on every retry
+MAX_RETRY_DELAY = 10  # in seconds
+FAILURE_THRESHOLD = 5  # consecutive failures that open the circuit
+RESET_TIMEOUT = 30  # in seconds, the circuit lets a request through after this
+POOL_SIZE = 10
+PAGE_WORKERS = 4  # pages fetched concurrently
+# The requests that can be sent again after a server error without a risk of duplicating their effect
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+
+class RateLimiter:
+    """Spaces the requests so that no more than `rate` requests (or items) per second are sent"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, n: int = 1) -> None:
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an integration after FAILURE_THRESHOLD consecutive failures, so the requests fail fast instead
+    of waiting on it. After RESET_TIMEOUT a single request is let through: the circuit closes if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class IntegrationClient:
+    """
+    HTTP client of an external API: a pooled keep-alive session, timeouts, retries with jittered backoff on
+    429 and 5xx (server errors are retried for idempotent methods only), a circuit breaker and, if the API has a
+    rate limit, requests spaced to `requests_per_second`.
+    Raises IntegrationUnavailable when the API cannot be reached, so the request fails with a 503.
+    """
+
+    def __init__(self, name: str, base_url: str, headers: dict = None,
+                 timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT, max_retries: int = MAX_RETRIES,
+                 retry_backoff: float = RETRY_BACKOFF, circuit_breaker: CircuitBreaker = None,
+                 pool_size: int = POOL_SIZE, requests_per_second: float = None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _retry_delay(self, r: Optional[requests.Response], attempt: int) -> float:
+        retry_after = r.headers.get('Retry-After') if r is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_DELAY)
+        return min(self.retry_backoff * 2 ** attempt * (1 + random.random()), MAX_RETRY_DELAY)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        if not self.circuit_breaker.allow():
+            raise IntegrationUnavailable(self.name, 'Too many failed requests, try again later')
+
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout)
+        url = f'{self.base_url}/{path.lstrip("/")}'
+        reason = None
+        for attempt in range(self.max_retries + 1):
+            r = None
+            self.rate_limiter.acquire()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                reason = f'{type(e).__name__}: {e}'
+                # A request that may have reached the server is only sent again if it is idempotent
+                retry = method in IDEMPOTENT_METHODS or isinstance(e, requests.exceptions.ConnectTimeout)
+            else:
+                if r.status_code != 429 and r.status_code < 500:
+                    self.circuit_breaker.success()
+                    return r
+                reason = f'status {r.status_code}'
+                retry = r.status_code == 429 or method in IDEMPOTENT_METHODS
+            logger.warning(f'{self.name}: {method} {url} failed ({reason}), attempt {attempt + 1}')
+            if not retry or attempt == self.max_retries:
+                break
+            time.sleep(self._retry_delay(r, attempt))
+
+        self.circuit_breaker.failure()
+        raise IntegrationUnavailable(self.name, reason)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+
+    def patch(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+
+
+def iter_pages(fetch_page: Callable[[int], Optional[dict]], total_pages: Callable[[dict], int],
+               max_workers: int = PAGE_WORKERS) -> Iterator[dict]:
+    """
+    Yields the pages of a paginated API in order. The first page (0) gives the number of pages (`total_pages`),
+    then the other pages are fetched concurrently, with up to `max_workers` requests in flight.
+    `fetch_page` returns None when a page cannot be fetched, which ends the pages.
+    """
+    first = fetch_page(0)
+    if first is None:
+        return
+    yield first
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for page in range(1, total_pages(first)):
+                pending.append(executor.submit(fetch_page, page))
+                if len(pending) < max_workers:
+                    continue
+                response = pending.popleft().result()
+                if response is None:
+                    return
+                yield response
+            while pending:
+                response = pending.popleft().result()
+                if response is None:
+                    return
+                yield response
+        finally:
+            # The pages not fetched yet are not fetched when the pages end or stop being consumed
+            for future in pending:
+                future.cancel()
@@ -1,183 +1,288 @@
+import io
 import os
+import json
+import hashlib
 import requests
-import shutil
 import boto3
-import base64
-import random
-import string
-from typing import Optional
-from botocore.exceptions import NoCredentialsError
+import multiprocessing
+from threading import Lock
+from typing import Optional, List
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import NoCredentialsError, ClientError
 
 import PIL
 from PIL import Image
 
-from config.constants import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_S3_BUCKET
+from config.constants import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_S3_BUCKET, IMAGE_PROCESSES
 from utils.logger import logger
 
+S3_REGION = 'us-east-2'
+MAX_IMAGE_SIZE = 20 * 1024 * 1024  # in bytes, larger downloads are dropped
+DOWNLOAD_TIMEOUT = 30  # in seconds
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_WIDTH = 480
+RENDITION_WIDTHS = [320, 480, 960, 1600]
+RENDITION_QUALITY = 80
+FORMAT_EXTENSIONS = {'AVIF': 'avif', 'WEBP': 'webp', 'JPEG': 'jpg'}
+CONTENT_TYPES = {'AVIF': 'image/avif', 'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+S3_MAX_CONNECTIONS = 16
+IMAGE_THREADS = 16  # for the uploads, which wait on S3
 
-def get_size_format(b, factor=1024, suffix='B'):
-    """
-    Scale bytes to its proper byte format
-    e.g:
-        1253656 => '1.20MB'
-        1253656678 => '1.17GB'
-    """
-    for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
-        if b < factor:
-            return f'{b:.2f}{unit}{suffix}'
-        b /= factor
-    return f'{b:.2f}Y{suffix}'
+
+def _supported_formats() -> List[str]:
+    """The formats of the renditions, from the smallest. AVIF depends on the Pillow build (or its plugin)"""
+    Image.init()
+    return [f for f in ['AVIF', 'WEBP', 'JPEG'] if f in Image.SAVE]
+
+
+RENDITION_FORMATS = _supported_formats()
+
+_s3 = None
+_threads = None
+_processes = None
+_futures = set()  # the work submitted and not done, which is cancelled on shutdown
+_lock = Lock()
+
+
+def _get_s3():
+    """A single S3 client (boto3 clients are thread safe), so its connections are reused between uploads"""
+    global _s3
+    with _lock:
+        if _s3 is None:
+            _s3 = boto3.client('s3', region_name=S3_REGION, aws_access_key_id=AWS_ACCESS_KEY_ID,
+                               aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                               config=Config(max_pool_connections=S3_MAX_CONNECTIONS))
+        return _s3
+
+
+def _get_threads() -> ThreadPoolExecutor:
+    global _threads
+    with _lock:
+        if _threads is None:
+            _threads = ThreadPoolExecutor(max_workers=IMAGE_THREADS, thread_name_prefix='image')
+        return _threads
+
+
+def _get_processes() -> ProcessPoolExecutor:
+    """The image compression is CPU bound, so it runs in other processes to not hold the GIL of the API"""
+    global _processes
+    with _lock:
+        if _processes is None:
+            # The API process has threads, which are not safe to fork
+            _processes = ProcessPoolExecutor(max_workers=IMAGE_PROCESSES,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return _processes
+
+
+def _submit(executor: Executor, fn, *args) -> Future:
+    future = executor.submit(fn, *args)
+    with _lock:
+        _futures.add(future)
+    future.add_done_callback(_futures.discard)
+    return future
 
 
-def compress_img(image_name, folder=None, suffix='compressed', new_size_ratio=1.0, quality=90,
-                 width=None, height=None, to_jpg=True):
+def shutdown() -> None:
+    global _threads, _processes
+    with _lock:
+        # The work that did not start is cancelled here, as shutdown(cancel_futures=True) needs Python 3.9
+        for future in list(_futures):
+            future.cancel()
+        for executor in [_threads, _processes]:
+            if executor:
+                executor.shutdown(wait=False)
+        _threads, _processes = None, None
+
+
+def _open(content: bytes) -> Optional[Image.Image]:
     try:
-        # load the image to memory
-        img = Image.open(image_name)
+        return Image.open(io.BytesIO(content))
     except PIL.UnidentifiedImageError:
-        return
-    # print the original image shape
-    print('[*] Image shape:', img.size)
-    # get the original image size in bytes
-    image_size = os.path.getsize(image_name)
-    # print the size before compression/resizing
-    print('[*] Size before compression:', get_size_format(image_size))
-    if width:
-        current_width = img.size[0]
-        new_size_ratio = width / current_width if width < current_width else 1
-
-    if new_size_ratio < 1.0:
-        # if resizing ratio is below 1.0, then multiply width & height with this ratio to reduce image size
-        img = img.resize((int(img.size[0] * new_size_ratio), int(img.size[1] * new_size_ratio)), Image.ANTIALIAS)
-        # print new image shape
-        print('[+] New Image shape:', img.size)
-    elif width and height:
-        # if width and height are set, resize with them instead
-        img = img.resize((width, height), Image.ANTIALIAS)
-        # print new image shape
-        print('[+] New Image shape:', img.size)
-
-    # split the filename and extension
-    filename, ext = os.path.splitext(image_name)
-    # make new filename appending _compressed to the original file name
-    if suffix:
-        filename = f'{filename}_{suffix}'
-    if to_jpg:
-        # change the extension to JPEG
-        new_filename = f'{filename}.jpg'
-    else:
-        # retain the same extension of the original image
-        new_filename = f'{filename}{ext}'
-    if folder:
-        new_filename = os.path.join(folder, new_filename.split('/')[-1])
-    try:
-        # save the image with the corresponding quality and optimize set to True
-        img.save(new_filename, quality=quality, optimize=True)
-    except OSError:
-        # convert the image to RGB mode first
+        return None
+
+
+def _draft(img: Image.Image, width: int) -> Image.Image:
+    """
+    Decodes the image for a target `width`: JPEGs are decoded at a reduced scale (draft) and other images are
+    reduced by an integer factor, so a large original is never decoded at its full size
+    """
+    if img.size[0] <= width:
+        return img
+    if img.format == 'JPEG':
+        img.draft('RGB', (width, round(img.size[1] * width / img.size[0])))
+    factor = img.size[0] // width
+    return img.reduce(factor) if factor >= 2 else img
+
+
+def _scale(img: Image.Image, width: int) -> Image.Image:
+    if img.size[0] <= width:
+        return img
+    return img.resize((width, round(img.size[1] * width / img.size[0])), Image.Resampling.LANCZOS)
+
+
+def _encode(img: Image.Image, image_format: str, quality: int) -> bytes:
+    if img.mode not in ['RGB', 'L']:
         img = img.convert('RGB')
-        # save the image with the corresponding quality and optimize set to True
-        img.save(new_filename, quality=quality, optimize=True)
-    print('[+] New file saved:', new_filename)
-    # get the new image size in bytes
-    new_image_size = os.path.getsize(new_filename)
-    # print the new size in a good format
-    print('[+] Size after compression:', get_size_format(new_image_size))
-    # calculate the saving bytes
-    saving_diff = new_image_size - image_size
-    # print the saving percentage
-    print(f'[+] Image size change: {saving_diff / image_size * 100:.2f}% of the original image size.')
-    return new_filename
-
-
-def create_thumbnail(filepath):
-    return compress_img(filepath, suffix='thumbnail', width=480)
-
-
-def download_image(image_url, filename, folder=None, replace_ext=True):
-    # Open the url image, set stream to True, this will return the stream content.
+    output = io.BytesIO()
+    img.save(output, format=image_format, quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def create_renditions(content: bytes, widths: List[int] = None, formats: List[str] = None) -> list:
+    """
+    Returns the renditions of the image in every width (not wider than the image) and format, from a single
+    decode of the image. Each rendition is a dict with its width, height, format and content.
+    """
+    widths = widths or RENDITION_WIDTHS
+    formats = formats or RENDITION_FORMATS
+    img = _open(content)
+    if not img:
+        return []
+    widths = sorted({min(width, img.size[0]) for width in widths}, reverse=True)
+    base = _draft(img, widths[0])
+    base.load()
+    renditions = []
+    for width in widths:
+        # Each width is scaled from the previous (larger) one, which is cheaper than scaling from the original
+        base = _scale(base, width)
+        for image_format in formats:
+            renditions.append({
+                'width': base.size[0],
+                'height': base.size[1],
+                'format': image_format,
+                'content': _encode(base, image_format, RENDITION_QUALITY)
+            })
+    return renditions
+
+
+def download_image(image_url: str, max_size: int = MAX_IMAGE_SIZE) -> Optional[bytes]:
+    """Downloads the image into memory. Returns None if it could not be downloaded or it is over `max_size`"""
     try:
-        r = requests.get(image_url, stream=True)
-    except requests.exceptions.MissingSchema:
-        logger.info('Could not download image')
+        r = requests.get(image_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema):
+        logger.warning('Could not download image: invalid url')
+        return
+    except requests.exceptions.RequestException as e:
+        logger.warning(f'Could not download image: {e}')
         return
 
-    # Check if the image was retrieved successfully
-    if r.status_code == 200:
-        # Set decode_content value to True, otherwise the downloaded image file's size will be zero.
-        r.raw.decode_content = True
-
-        # Open a local file with wb ( write binary ) permission.
-        extension = image_url.split('.')[-1] if '.' in image_url else ''
-        if len(extension) > 4:
-            extension = 'jpg'
-        if not folder:
-            folder = '/tmp'
-        if replace_ext:
-            filepath = os.path.join(folder, f'{filename}.{extension}')
-        else:
-            filepath = os.path.join(folder, filename)
-        with open(filepath, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-
-        print('Image successfully Downloaded: ', filepath)
-        return filepath
-
-    print('Image Could not be retrieved')
-
-
-def upload_to_s3(local_file: str, resource: str, filename: str) -> Optional[str]:
-    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID,
-                      aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+    with r:
+        if r.status_code != 200:
+            logger.warning(f'Could not download image: status {r.status_code}')
+            return
+        if int(r.headers.get('Content-Length') or 0) > max_size:
+            logger.info(f'Image too large: {r.headers["Content-Length"]} bytes')
+            return
+        buffer = io.BytesIO()
+        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            if buffer.tell() > max_size:
+                logger.info(f'Image too large: over {max_size} bytes')
+                return
+
+    logger.info(f'Image downloaded: {image_url}')
+    return buffer.getvalue()
+
+
+def s3_url(key: str) -> str:
+    return f'https://{AWS_S3_BUCKET}.s3.{S3_REGION}.amazonaws.com/{key}'
+
+
+def exists_in_s3(key: str) -> bool:
     try:
-        s3.upload_file(local_file, AWS_S3_BUCKET, os.path.join(resource, filename))
-        print('Upload Successful')
-        return os.path.join(f'https://{AWS_S3_BUCKET}.s3.us-east-2.amazonaws.com', resource, filename)
-    except FileNotFoundError:
-        print('The file was not found')
-        return None
+        _get_s3().head_object(Bucket=AWS_S3_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return False
+        raise
+    return True
+
+
+def upload_to_s3(content: bytes, resource: str, filename: str, content_type: str = None) -> Optional[str]:
+    key = os.path.join(resource, filename)
+    extra_args = {'ContentType': content_type} if content_type else None
+    try:
+        _get_s3().upload_fileobj(io.BytesIO(content), AWS_S3_BUCKET, key, ExtraArgs=extra_args)
+        logger.info(f'Image uploaded: {key}')
+        return s3_url(key)
     except NoCredentialsError:
-        print('Credentials not available')
+        logger.warning('Could not upload image: AWS credentials not available')
         return None
 
 
-def encode_image(filepath):
-    with open(filepath, 'rb') as image_file:
-        encoded_string = base64.b64encode(image_file.read())
-    return encoded_string
+def _upload_once(content: bytes, key: str, content_type: str = None) -> Optional[str]:
+    """Uploads the content unless the key already exists. The keys are content hashes, so it would be the same"""
+    if exists_in_s3(key):
+        return s3_url(key)
+    return upload_to_s3(content, os.path.dirname(key), os.path.basename(key), content_type)
+
+
+def _get_manifest(prefix: str) -> Optional[list]:
+    try:
+        r = _get_s3().get_object(Bucket=AWS_S3_BUCKET, Key=f'{prefix}/manifest.json')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return None
+        raise
+    return json.loads(r['Body'].read())
 
 
-def random_string(size=20):
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for _ in range(size))
+def _renditions_to_s3(content: bytes, resource: str, digest: str) -> list:
+    """
+    Creates and uploads the renditions of the image, unless they were already created for the same content.
+    The manifest (the list of renditions) is uploaded last, so it is only found when every rendition is uploaded.
+    """
+    prefix = f'renditions/{resource}/{digest}'
+    manifest = _get_manifest(prefix)
+    if manifest is not None:
+        return manifest
+
+    renditions = _submit(_get_processes(), create_renditions, content).result()
+    uploads = [
+        _submit(_get_threads(), upload_to_s3, r['content'], prefix, f'{r["width"]}.{FORMAT_EXTENSIONS[r["format"]]}',
+                CONTENT_TYPES[r['format']])
+        for r in renditions
+    ]
+    manifest = [{'url': upload.result(), 'width': r['width'], 'height': r['height'], 'format': r['format'].lower()}
+                for r, upload in zip(renditions, uploads)]
+    if manifest and all(r['url'] for r in manifest):
+        _get_s3().put_object(Bucket=AWS_S3_BUCKET, Key=f'{prefix}/manifest.json', Body=json.dumps(manifest),
+                             ContentType='application/json')
+    return [r for r in manifest if r['url']]
+
+
+def _thumbnail(renditions: list) -> Optional[str]:
+    """The JPEG rendition closest to THUMBNAIL_WIDTH, as the thumbnail for the clients without renditions"""
+    jpegs = [r for r in renditions if r['format'] == 'jpeg']
+    if not jpegs:
+        return None
+    return min(jpegs, key=lambda r: abs(r['width'] - THUMBNAIL_WIDTH))['url']
 
 
 def create_image_obj(picture: dict, resource: str) -> dict:
+    """
+    Uploads the original picture to S3 (if it is not there already) and its renditions, in parallel.
+    The objects are named by the hash of the picture, so a picture uploaded again is not processed again.
+    """
     image_url = picture['original']
     if not image_url:
         return picture
 
-    filename = random_string()
-    img_filepath = download_image(image_url, filename)
-    if not img_filepath:
+    content = download_image(image_url)
+    if not content:
         return picture
-    ext = img_filepath.split('.')[-1]
-    if len(ext) < 5:
-        filename = f'{filename}.{ext}'
+    digest = hashlib.sha256(content).hexdigest()
 
+    original = None
     if not f'{AWS_S3_BUCKET}.s3' in image_url:
-        original_image_url = upload_to_s3(img_filepath, f'originals/{resource}/', filename)
-    else:
-        filename = image_url.split('/')[-1]
-        original_image_url = image_url
-    thumbnail_image_url = f'https://{AWS_S3_BUCKET}.s3.us-east-2.amazonaws.com/thumbnails/{resource}/{filename}'
-    r = requests.get(thumbnail_image_url)
-    if r.status_code >= 400:
-        thumbnail_filepath = create_thumbnail(img_filepath)
-        if thumbnail_filepath:
-            thumbnail_image_url = upload_to_s3(thumbnail_filepath, f'thumbnails/{resource}/', filename)
-
-    picture['original'] = original_image_url
-    picture['thumbnail'] = thumbnail_image_url
+        ext = image_url.split('.')[-1] if '.' in image_url else ''
+        key = f'originals/{resource}/{digest}.{ext if 0 < len(ext) <= 4 else "jpg"}'
+        original = _submit(_get_threads(), _upload_once, content, key)
+    renditions = _renditions_to_s3(content, resource, digest)
+
+    picture['original'] = original.result() if original else image_url
+    picture['thumbnail'] = _thumbnail(renditions)
+    picture['renditions'] = renditions
 
     return picture
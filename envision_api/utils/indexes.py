@@ -0,0 +1,54 @@
+from typing import List
+from pymongo import IndexModel
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from utils.logger import logger
+
+
+def reconcile_indexes(collection: Collection, indexes: List[IndexModel], create: bool = True) -> dict:
+    """
+    Creates the declared indexes that are missing from the collection (it is idempotent) and reports:
+    - missing: declared indexes that did not exist
+    - conflicts: declared indexes that could not be created (e.g. an index with the same keys but other options)
+    - undeclared: indexes of the collection that are not declared
+    - unused: indexes with no accesses since the server started
+    """
+    existing = {index['name'] for index in collection.list_indexes()}
+    declared = {index.document['name'] for index in indexes}
+    report = {
+        'collection': collection.name,
+        'missing': [name for name in declared if name not in existing],
+        'conflicts': [],
+        'undeclared': [name for name in existing if name not in declared and name != '_id_'],
+        'unused': []
+    }
+
+    if create:
+        for index in indexes:
+            if index.document['name'] not in existing:
+                try:
+                    collection.create_indexes([index])
+                except OperationFailure as e:
+                    report['conflicts'].append(f"{index.document['name']}: {e.details.get('errmsg')}")
+
+    try:
+        report['unused'] = [s['name'] for s in collection.aggregate([{'$indexStats': {}}])
+                            if s['accesses']['ops'] == 0 and s['name'] != '_id_' and s['name'] in existing]
+    except OperationFailure:
+        # $indexStats is not available on every deployment
+        pass
+
+    return report
+
+
+def log_index_report(report: dict) -> None:
+    collection = report['collection']
+    if report['missing']:
+        logger.info(f'Indexes: {collection} missing {report["missing"]}')
+    if report['conflicts']:
+        logger.error(f'Indexes: {collection} could not create {report["conflicts"]}')
+    if report['undeclared']:
+        logger.warning(f'Indexes: {collection} has undeclared indexes {report["undeclared"]}')
+    if report['unused']:
+        logger.warning(f'Indexes: {collection} has unused indexes {report["unused"]}')
@@ -1,47 +1,265 @@
+import random
+import time
+from collections import deque, OrderedDict
+from threading import Lock
+from typing import Iterable, Iterator, Optional, Union, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
 from utils.logger import logger
+from utils.http import RateLimiter
 
+EXPO_PUSH_URL = 'https://exp.host/--/api/v2/push/send'
+EXPO_RECEIPTS_URL = 'https://exp.host/--/api/v2/push/getReceipts'
+EXPO_CHUNK_SIZE = 100  # Expo has a maximum of 100 notifications per request
+EXPO_RECEIPTS_CHUNK_SIZE = 1000  # Expo has a maximum of 1000 receipts per request
+EXPO_NOTIFICATIONS_PER_SECOND = 600  # Expo rate limit per project
+MAX_CONCURRENT_REQUESTS = 8
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5  # in seconds, doubled on every retry
+MAX_RETRY_DELAY = 60  # in seconds, a longer Retry-After fails the request so that it is retried later
+REQUEST_TIMEOUT = 30  # in seconds
+GROUPING_WINDOW = 1000  # tokens are grouped by experience id within windows of this number of tokens
+EXPERIENCE_IDS_CACHE_SIZE = 500000
 
-def send_notification(title: str, body: str, url: str, expo_tokens: list):
-    if not expo_tokens:
-        return []
-    response = []
-    c = 100  # Expo has a maximum of 100 notifications per request
-    for _expo_tokens in [expo_tokens[x:x + c] for x in range(0, len(expo_tokens), c)]:
-        r = requests.post('https://exp.host/--/api/v2/push/send', data={
-            'to': _expo_tokens,
-            'title': title,
-            'body': body,
-            'data.url': url
-        })
-        expo_response = r.json()
+_session = None
+_session_lock = Lock()
+
+
+def _get_session() -> requests.Session:
+    """A single keep-alive session, with a connection for each concurrent request"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS))
+            _session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS))
+        return _session
+
+
+rate_limiter = RateLimiter(EXPO_NOTIFICATIONS_PER_SECOND)
+
+
+class ExpoUnavailable(Exception):
+    pass
+
+
+class ExperienceIds:
+    """
+    Cache of the Expo experience id (project) of the tokens, learned from the PUSH_TOO_MANY_EXPERIENCE_IDS errors,
+    so that the chunks only have tokens of a project. The tokens learned are kept until they are saved (pop_learned).
+    """
+
+    def __init__(self, max_size: int = EXPERIENCE_IDS_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._learned = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.mixed_chunks = 0
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            experience_id = self._cache.get(token)
+            if experience_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache.move_to_end(token)
+            return experience_id
+
+    def hit(self) -> None:
+        """Counts a token whose experience id was already known by the caller"""
+        with self._lock:
+            self.hits += 1
+
+    def learn(self, details: dict) -> None:
+        with self._lock:
+            self.mixed_chunks += 1
+            for experience_id, tokens in details.items():
+                for token in tokens:
+                    self._cache[token] = experience_id
+                    self._cache.move_to_end(token)
+                self._learned.setdefault(experience_id, []).extend(tokens)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def pop_learned(self) -> dict:
+        with self._lock:
+            learned, self._learned = self._learned, {}
+            return learned
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'experience_id_hits': self.hits,
+                'experience_id_misses': self.misses,
+                'experience_id_hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'mixed_chunks': self.mixed_chunks,
+                'experience_ids_cached': len(self._cache)
+            }
+
+
+experience_ids = ExperienceIds()
+
+
+def push_metrics() -> dict:
+    return experience_ids.metrics()
+
+
+def _retry_delay(r: requests.Response, attempt: int) -> float:
+    """Raises ExpoUnavailable when Expo asks to wait longer than MAX_RETRY_DELAY"""
+    retry_after = r.headers.get('Retry-After') if r is not None else None
+    if retry_after and retry_after.isdigit():
+        if float(retry_after) > MAX_RETRY_DELAY:
+            raise ExpoUnavailable(f'status {r.status_code}, retry after {retry_after} seconds')
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    return min(RETRY_BACKOFF * 2 ** attempt * (1 + random.random()), MAX_RETRY_DELAY)
+
+
+def _request(endpoint: str, n: int, **kwargs) -> dict:
+    """
+    Posts to Expo, retrying when it is rate limited (429) or unavailable (5xx).
+    Raises ExpoUnavailable when it still fails after MAX_RETRIES (or Expo asks to wait over MAX_RETRY_DELAY), so
+    that the request can be retried later.
+    """
+    r = None
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire(n)
+        try:
+            r = _get_session().post(endpoint, timeout=REQUEST_TIMEOUT, **kwargs)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f'Expo: request failed ({e}), attempt {attempt + 1}')
+            r = None
+        else:
+            if r.status_code != 429 and r.status_code < 500:
+                return r.json()
+            logger.warning(f'Expo: status {r.status_code}, attempt {attempt + 1}')
+        if attempt < MAX_RETRIES:
+            time.sleep(_retry_delay(r, attempt))
+
+    raise ExpoUnavailable(f'status {r.status_code if r is not None else None} after {MAX_RETRIES} retries')
+
+
+def _post(expo_tokens, title: str, body: str, url: str) -> dict:
+    n = len(expo_tokens) if isinstance(expo_tokens, list) else 1
+    return _request(EXPO_PUSH_URL, n, data={
+        'to': expo_tokens,
+        'title': title,
+        'body': body,
+        'data.url': url
+    })
+
+
+def _send_chunk(title: str, body: str, url: str, expo_tokens: list) -> list:
+    """
+    Sends a chunk, and the requests it is split into, serially in the worker of the chunk so that there are no
+    more than MAX_CONCURRENT_REQUESTS requests in flight. A token repeated in the chunk (users that share a device)
+    is sent once. Returns a result for each token of the chunk, in order.
+    """
+    results = {}
+    to_send = [list(dict.fromkeys(expo_tokens))]
+    while to_send:
+        tokens = to_send.pop()
+        expo_response = _post(tokens, title, body, url)
         logger.info(expo_response)
         if 'data' in expo_response:
             data = expo_response['data'] if isinstance(expo_response['data'], list) else [expo_response['data']]
-            response.extend([{'token': token, 'status': data[i]['status']} for i, token in enumerate(_expo_tokens)])
+            # The ticket id is kept to fetch the push receipt later
+            results.update({token: {'token': token, 'status': data[i]['status'], 'id': data[i].get('id')}
+                            for i, token in enumerate(tokens)})
         elif errors := expo_response.get('errors'):
-            for error in errors:
-                if error.get('code') == 'PUSH_TOO_MANY_EXPERIENCE_IDS':
-                    for project, tokens in error.get('details', {}).items():
-                        response.extend(send_notification(title, body, url, tokens))
-        else:  # Most common error is PUSH_TOO_MANY_EXPERIENCE_IDS
-            result = send_notifications_individually(title, body, url, _expo_tokens)
-            response.extend(result)
-    return response
+            mixed = next((e for e in errors if e.get('code') == 'PUSH_TOO_MANY_EXPERIENCE_IDS'), None)
+            if mixed:
+                # The chunk is sent again as a request for each project
+                experience_ids.learn(mixed.get('details', {}))
+                to_send.extend(project_tokens for project_tokens in mixed.get('details', {}).values()
+                               if project_tokens)
+            else:
+                results.update({token: {'token': token, 'status': 'error'} for token in tokens})
+        elif len(tokens) > 1:
+            # Some of the tokens make Expo reject the whole request: the request is split in halves until the
+            # rejected tokens are isolated, which takes O(log n) requests for each rejected token
+            middle = len(tokens) // 2
+            to_send.extend([tokens[middle:], tokens[:middle]])
+        else:
+            results[tokens[0]] = {'token': tokens[0], 'status': 'error'}
+    return [results.get(token, {'token': token, 'status': 'error'}) for token in expo_tokens]
 
 
-def send_notifications_individually(title: str, body: str, url: str, expo_tokens: list):
+def _chunks(expo_tokens: Iterable[Union[str, Tuple[str, Optional[str]]]], size: int) -> Iterator[list]:
+    """
+    Chunks of tokens of a same experience id, when it is known (given with the token or cached).
+    The tokens are grouped within windows of GROUPING_WINDOW tokens, so that no token is held back for long.
+    """
+    groups = {}
+    for i, token in enumerate(expo_tokens, 1):
+        if isinstance(token, tuple):
+            token, experience_id = token
+            if experience_id:
+                experience_ids.hit()
+            else:
+                experience_id = experience_ids.get(token)
+        else:
+            experience_id = experience_ids.get(token)
+        group = groups.setdefault(experience_id, [])
+        group.append(token)
+        if len(group) == size:
+            yield groups.pop(experience_id)
+        if i % GROUPING_WINDOW == 0:
+            yield from groups.values()
+            groups = {}
+    yield from groups.values()
+
+
+def stream_notification(title: str, body: str, url: str,
+                        expo_tokens: Iterable[Union[str, Tuple[str, Optional[str]]]]) -> Iterator[list]:
+    """
+    Sends the notifications in chunks of 100 tokens of a same experience id as the tokens are read, with up to
+    MAX_CONCURRENT_REQUESTS requests in flight, and yields the results of each chunk in order.
+    The tokens are read ahead by at most MAX_CONCURRENT_REQUESTS chunks plus a grouping window, so the memory
+    does not depend on the number of tokens.
+    `expo_tokens` are tokens or (token, experience id) tuples.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        try:
+            for chunk in _chunks(expo_tokens, EXPO_CHUNK_SIZE):
+                pending.append(executor.submit(_send_chunk, title, body, url, chunk))
+                if len(pending) > MAX_CONCURRENT_REQUESTS:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        except BaseException:
+            # The chunks that were not sent yet are not sent when the send fails or stops being consumed
+            for future in pending:
+                future.cancel()
+            raise
+
+
+def send_notification(title: str, body: str, url: str, expo_tokens: list):
     if not expo_tokens:
         return []
-    response = []
-    for _expo_token in expo_tokens:
-        r = requests.post('https://exp.host/--/api/v2/push/send', data={
-            'to': _expo_token,
-            'title': title,
-            'body': body,
-            'data.url': url
-        })
-        expo_response = r.json()
-        logger.info(expo_response)
-        response.append({'token': _expo_token, 'status': expo_response['data']['status']})
-    return response
+    return [r for chunk_results in stream_notification(title, body, url, expo_tokens) for r in chunk_results]
+
+
+def _get_receipts_chunk(ticket_ids: list) -> dict:
+    # The receipts are not rate limited as the notifications are
+    return _request(EXPO_RECEIPTS_URL, 0, json={'ids': ticket_ids}).get('data') or {}
+
+
+def get_receipts(ticket_ids: list) -> dict:
+    """
+    Fetches the push receipts of the tickets (ticket id -> receipt) in chunks of 1000 ids, with up to
+    MAX_CONCURRENT_REQUESTS requests in flight. The receipts that are not ready yet are missing.
+    """
+    chunks = [ticket_ids[i:i + EXPO_RECEIPTS_CHUNK_SIZE] for i in range(0, len(ticket_ids), EXPO_RECEIPTS_CHUNK_SIZE)]
+    receipts = {}
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        for chunk_receipts in executor.map(_get_receipts_chunk, chunks):
+            receipts.update(chunk_receipts)
+    return receipts
@@ -0,0 +1,84 @@
+import re
+import unicodedata
+from typing import List
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from utils.format import regex_query
+
+SEARCH_KEYWORDS_FIELD = 'search_keywords'
+RELEVANCE_SORT = 'relevance'
+MAX_PREFIX_LENGTH = 20
+BACKFILL_BATCH_SIZE = 1000
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r'\w+', normalize(text)) if text else []
+
+
+def search_keywords(values: list) -> List[str]:
+    """
+    Returns every prefix of every word of the values (strings or lists of strings). The prefixes are stored in
+    the document so that a search is an index lookup instead of a collection scan.
+    """
+    keywords = set()
+    for value in values:
+        for text in value if isinstance(value, list) else [value]:
+            for token in tokenize(text) if isinstance(text, str) else []:
+                keywords.update(token[:i] for i in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1))
+    return sorted(keywords)
+
+
+def search_query(q: str, fields: List[str]) -> dict:
+    """
+    Matches the documents that have a word starting with each word of `q`.
+    Documents without search keywords (not backfilled yet) fall back to a regex over `fields`.
+    """
+    tokens = [t[:MAX_PREFIX_LENGTH] for t in tokenize(q)] or [normalize(q)]
+    return {
+        '$or': [
+            {SEARCH_KEYWORDS_FIELD: {'$all': tokens}},
+            {SEARCH_KEYWORDS_FIELD: {'$exists': False}, '$or': [regex_query(field, q) for field in fields]}
+        ]
+    }
+
+
+def relevance_stages(q: str, field: str) -> List[dict]:
+    """
+    Sorts the matched documents by relevance: whole words of `field` score more than prefixes
+    and a `field` starting with the query gets a bonus
+    """
+    tokens = tokenize(q)
+    value = {'$ifNull': [f'${field}', '']}
+    score = [
+        {'$cond': [{'$regexMatch': {'input': value, 'regex': rf'(^|\W){re.escape(t)}(\W|$)', 'options': 'i'}}, 2, 1]}
+        for t in tokens
+    ]
+    if tokens:
+        score.append({'$cond': [{'$regexMatch': {'input': value, 'regex': f'^{re.escape(tokens[0])}',
+                                                 'options': 'i'}}, 1, 0]})
+    return [
+        {'$addFields': {'search_score': {'$add': score}}},
+        {'$sort': {'search_score': -1, '_id': 1}},
+        {'$unset': 'search_score'}
+    ]
+
+
+def backfill_search_keywords(collection: Collection, fields: List[str]) -> int:
+    cursor = collection.find({SEARCH_KEYWORDS_FIELD: {'$exists': False}}, fields).batch_size(BACKFILL_BATCH_SIZE)
+    updated = 0
+    batch = []
+    for document in cursor:
+        keywords = search_keywords([document.get(f) for f in fields])
+        batch.append(UpdateOne({'_id': document['_id']}, {'$set': {SEARCH_KEYWORDS_FIELD: keywords}}))
+        if len(batch) == BACKFILL_BATCH_SIZE:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
@@ -1,7 +1,9 @@
-import requests
+from typing import Optional, Iterator
+from functools import partial
 
 from config.constants import THINKIFIC_API_KEY, THINKIFIC_SUBDOMAIN
 from utils.logger import logger
+from utils.http import IntegrationClient, iter_pages
 
 headers = {
     'X-Auth-API-Key': THINKIFIC_API_KEY,
@@ -10,38 +12,43 @@ headers = {
 }
 
 url = 'https://api.thinkific.com/api/public/v1'
+timeout = (3.05, 10)  # (connect, read) in seconds
+requests_per_second = 2  # Thinkific allows 120 requests per minute
+PAGE_SIZE = 50
 
+client = IntegrationClient('Thinkific', url, headers, timeout=timeout, requests_per_second=requests_per_second)
 
-def get_items(collection: str, query: dict = None):
-    params = {'limit': 50}
+
+def _get_page(collection: str, params: dict, page: int) -> Optional[dict]:
+    r = client.get(f'/{collection}', params={**params, 'page': page + 1})
+    if r.status_code >= 400:
+        return None
+    return r.json()
+
+
+def iter_items(collection: str, query: dict = None) -> Iterator[dict]:
+    """Yields the items of the collection while its pages are fetched concurrently"""
+    params = {'limit': PAGE_SIZE}
     if query:
         for k, v in query.items():
             params[f'query[{k}]'] = v
-    r = requests.get(f'{url}/{collection}', headers=headers, params=params)
-    if r.status_code >= 400:
-        return []
-    response = r.json()
-    items = response['items']
-    pagination_info = response['meta']['pagination']
-    while pagination_info['current_page'] < pagination_info['total_pages']:
-        params['page'] = params['page'] + 1 if 'page' in params else 2
-        r = requests.get(f'{url}/{collection}', headers=headers, params=params)
-        if r.status_code >= 400:
-            return items
-        response = r.json()
-        pagination_info = response['meta']['pagination']
-        items.extend(response['items'])
-    return items
+    for response in iter_pages(partial(_get_page, collection, params),
+                               lambda r: r['meta']['pagination']['total_pages']):
+        yield from response['items']
+
+
+def get_items(collection: str, query: dict = None) -> list:
+    return list(iter_items(collection, query))
 
 
 def get_item(collection, item_id):
-    r = requests.get(f'{url}/{collection}/{item_id}', headers=headers)
+    r = client.get(f'/{collection}/{item_id}')
     response = r.json()
     return response
 
 
 def create_item(collection, item):
-    r = requests.post(f'{url}/{collection}', json=item, headers=headers)
+    r = client.post(f'/{collection}', json=item)
     response = {'status': r.status_code}
     if r.status_code >= 400:
         r_json = r.json()
@@ -55,7 +62,7 @@ def create_item(collection, item):
 
 
 def update_item(collection, item_id, item):
-    r = requests.put(f'{url}/{collection}/{item_id}', json=item, headers=headers)
+    r = client.put(f'/{collection}/{item_id}', json=item)
     response = {'status': r.status_code}
     if r.status_code >= 400:
         response['error'] = r.json()['error']
@@ -64,7 +71,7 @@ def update_item(collection, item_id, item):
 
 
 def delete_item(collection, item_id):
-    r = requests.delete(f'{url}/{collection}/{item_id}', headers=headers)
+    r = client.delete(f'/{collection}/{item_id}')
     response = {'status': r.status_code}
     if r.status_code >= 400:
         response['error'] = r.json()['error'] if 'error' in r.json() else r.json()['errors']